@@ -0,0 +1,106 @@
+# Helpers shared by the bench/ scripts: sample statistics and the app loaded outside Streamlit.
+import io
+import json
+import logging
+import math
+import random
+import statistics
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+RESULTS = ROOT / "bench" / "results"
+sys.path[:0] = [str(ROOT), str(ROOT / "tests")]
+
+import streamlit as st
+from PIL import Image
+from streamlit.runtime.secrets import Secrets
+
+import cards
+
+def percentile(values: list[float], q: float) -> float:
+    # Nearest rank, so p95 of a handful of samples is an observed value.
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+def summary(samples: list[float], unit: str, scale: float) -> dict:
+    return {
+        "n": len(samples),
+        f"p50_{unit}": round(statistics.median(samples) * scale, 2),
+        f"p95_{unit}": round(percentile(samples, 0.95) * scale, 2),
+    }
+
+def use_secrets(values: dict) -> None:
+    # Module-level, so job and replica threads see them too.
+    secrets = Secrets()
+    secrets._secrets = values
+    st.secrets = secrets
+
+def scratch_secrets(tmp: Path, **sections) -> dict:
+    # Every directory the app writes under tmp; the page reads azure_app even when nothing is uploaded.
+    return {
+        "azure_app": {},
+        "photo_store": {"dir": str(tmp / "photos")},
+        "jobs": {"dir": str(tmp / "jobs")},
+        "pdf": {"cache_dir": str(tmp / "pdf")},
+        "storage": {"dir": str(tmp / "storage")},
+        **sections,
+    }
+
+def load_app(secrets: dict):
+    # Importing renders the page once outside a script run, which Streamlit warns about
+    # on every call (jobs do too); it also resets Streamlit's log levels.
+    use_secrets(secrets)
+    logging.disable(logging.WARNING)
+    try:
+        import idcode as app
+    finally:
+        logging.disable(logging.NOTSET)
+    logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").setLevel(logging.ERROR)
+    st.cache_resource.clear()
+    return app
+
+def write_report(report: dict, out: Path | None) -> None:
+    print(json.dumps(report, indent=2))
+    if out:
+        out.parent.mkdir(parents=True, exist_ok=True)
+        out.write_text(json.dumps(report, indent=2) + "\n")
+
+# ----------------------------------------------------
+# CORPUS
+# ----------------------------------------------------
+def _encode(img: Image.Image, fmt: str, **kw) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, format=fmt, **kw)
+    return buf.getvalue()
+
+def corpus(n: int) -> list[dict]:
+    # Phone camera JPEGs (some stored sideways with an EXIF orientation), gallery PNG
+    # screenshots and, when pillow_heif is installed, HEIC shots. Same photos every run.
+    try:
+        import pillow_heif  # type: ignore
+        pillow_heif.register_heif_opener()
+        heic = True
+    except ImportError:
+        heic = False
+    rng = random.Random(0)
+    photos = []
+    for i in range(n):
+        layout = cards.LAYOUTS[i % len(cards.LAYOUTS)]
+        kind = ("jpeg", "jpeg_exif", "png", "heic")[i % (4 if heic else 3)]
+        angle = rng.choice(cards.CAPTURE_ANGLES) if kind == "jpeg" else 0
+        if kind == "png":
+            img = cards.capture(layout, 0, (1170, 2532), seed=i)
+            photos.append({"name": f"{i:02d}.png", "data": _encode(img, "PNG"), "mime": "image/png", "source": "upload", "mobile": False})
+            continue
+        img = cards.capture(layout, angle, (4032, 3024), seed=i)
+        if kind == "heic":
+            photos.append({"name": f"{i:02d}.heic", "data": _encode(img, "HEIF", quality=80), "mime": "image/heic", "source": "upload", "mobile": False})
+        elif kind == "jpeg_exif":
+            exif = Image.Exif()
+            exif[0x0112] = 6  # viewers turn it 90° clockwise
+            data = _encode(img.transpose(Image.Transpose.ROTATE_90), "JPEG", quality=92, exif=exif.tobytes())
+            photos.append({"name": f"{i:02d}.jpg", "data": data, "mime": "image/jpeg", "source": "camera", "mobile": True})
+        else:
+            photos.append({"name": f"{i:02d}.jpg", "data": _encode(img, "JPEG", quality=92), "mime": "image/jpeg", "source": "camera", "mobile": True})
+    return photos
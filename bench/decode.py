@@ -0,0 +1,100 @@
+# Decode cost per format: wall time and peak memory of reading a phone-sized photo three
+# ways: the header alone (open_image, which is lazy: no pixels until load), the full
+# decode uploads use (EXIF-upright, as ProcessedImage.image) and the reduced decode of
+# previews and analysis (open_reduced at ORIENTATION_MAX_SIDE: JPEG DCT scaling, the
+# embedded thumbnail of a HEIC, a full decode for PNG). HEIC runs with and without an
+# embedded thumbnail, since phones write one and other encoders may not.
+#
+#   python bench/decode.py [--repeat 5] [--width 4032] [--height 3024] [--out bench/results/decode.json]
+#
+# Pillow allocates pixels outside the Python heap, so memory is the peak RSS of a fresh
+# process per format and mode over its RSS before decoding. The peak is reset first
+# (/proc/self/clear_refs), so imports do not hide it: Linux only.
+import argparse
+import io
+import json
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from PIL import Image, ImageOps
+
+from common import RESULTS, summary, write_report  # first: puts the app and tests/ on sys.path
+import cards
+import imaging
+
+MODES = ("header", "full", "reduced")
+
+def _decode(data: bytes, mode: str) -> Image.Image:
+    if mode == "header": return imaging.open_image(data)
+    if mode == "reduced": return imaging.open_reduced(data, imaging.ORIENTATION_MAX_SIDE)
+    img = ImageOps.exif_transpose(imaging.open_image(data))
+    img.load()
+    return img
+
+def _status_kb(field: str) -> int:
+    return int(re.search(rf"^{field}:\s+(\d+) kB", Path("/proc/self/status").read_text(), re.M).group(1))
+
+def measure(path: Path, mode: str, repeat: int) -> dict:
+    # Runs in the child process.
+    data = path.read_bytes()
+    imaging.open_image(data)  # plugins registered before the baseline
+    Path("/proc/self/clear_refs").write_text("5")  # VmHWM back to the current RSS
+    before = _status_kb("VmRSS")
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        img = _decode(data, mode)
+        times.append(time.perf_counter() - t)
+        size = img.size
+        del img
+    peak = _status_kb("VmHWM")
+    return {"times": times, "size": list(size), "peak_mb": round((peak - before) / 1024, 1)}
+
+def photos(size: tuple[int, int]) -> dict[str, bytes]:
+    img = cards.capture("ine_front", 0, size, seed=0)
+    out = {}
+    for name, fmt, kw in (
+        ("jpeg", "JPEG", {"quality": 92}),
+        ("png", "PNG", {}),
+        ("heic", "HEIF", {"quality": 80}),
+        ("heic_thumbnail", "HEIF", {"quality": 80, "thumbnails": [imaging.ORIENTATION_MAX_SIDE]}),
+    ):
+        if fmt == "HEIF" and not imaging.heif_ok(): continue
+        buf = io.BytesIO()
+        img.save(buf, format=fmt, **kw)
+        out[name] = buf.getvalue()
+    return out
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--width", type=int, default=4032)
+    ap.add_argument("--height", type=int, default=3024)
+    ap.add_argument("--out", type=Path, default=RESULTS / "decode.json")
+    ap.add_argument("--child", nargs=2, metavar=("PATH", "MODE"), help=argparse.SUPPRESS)
+    a = ap.parse_args()
+    if a.child:
+        print(json.dumps(measure(Path(a.child[0]), a.child[1], a.repeat)))
+        return
+    report = {"size": [a.width, a.height], "repeat": a.repeat, "heif": imaging.heif_ok(), "formats": {}}
+    with tempfile.TemporaryDirectory(prefix="idphotos-bench-") as tmp:
+        for name, data in photos((a.width, a.height)).items():
+            path = Path(tmp) / name
+            path.write_bytes(data)
+            row = report["formats"][name] = {"bytes": len(data)}
+            for mode in MODES:
+                out = subprocess.run(
+                    [sys.executable, __file__, "--child", str(path), mode, "--repeat", str(a.repeat)],
+                    check=True, capture_output=True, text=True,
+                )
+                r = json.loads(out.stdout)
+                row[mode] = {"decoded_size": r["size"], **summary(r["times"], "ms", 1000), "peak_mb": r["peak_mb"]}
+            print(f"{name:15} full {row['full']['p50_ms']:>8} ms {row['full']['peak_mb']:>6} MB   reduced {row['reduced']['p50_ms']:>8} ms {row['reduced']['peak_mb']:>6} MB")
+    write_report(report, a.out)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+# Storage encodings compared on the bench corpus (bench/common.py): stored bytes, time to
+# produce them from the uploaded photo (decode and orientation included, as in an upload)
+# and SSIM against the upright photo, per [storage_encoding] mode.
+#
+#   python bench/encodings.py [--photos 8] [--repeat 1] [--target-bytes 1500000] [--out bench/results/encodings.json]
+#
+# SSIM is computed on luma at SSIM_SIDE with 8x8 windows; 1.0 is identical. Viewers apply
+# the EXIF orientation "original" leaves in place, so the output is turned the same way first.
+import argparse
+import io
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from common import RESULTS, corpus, summary, write_report  # first: puts the app and tests/ on sys.path
+import imaging
+
+SSIM_SIDE = 1024
+MODES = {
+    "png": {"mode": "png"},
+    "original": {"mode": "original"},
+    "jpeg": {"mode": "jpeg"},
+    "webp": {"mode": "webp"},
+    "budget-jpeg": {"mode": "budget", "format": "jpeg"},
+    "budget-webp": {"mode": "budget", "format": "webp"},
+}
+
+def _luma(img: Image.Image, size: tuple[int, int]) -> np.ndarray:
+    return np.asarray(img.convert("L").resize(size, Image.BILINEAR), dtype=np.float64)
+
+def _window_mean(a: np.ndarray, k: int = 8) -> np.ndarray:
+    # Mean over every k x k window, from a summed-area table.
+    s = np.pad(a.cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+    return (s[k:, k:] - s[:-k, k:] - s[k:, :-k] + s[:-k, :-k]) / (k * k)
+
+def ssim(reference: Image.Image, stored: Image.Image) -> float:
+    size = reference.size
+    if max(size) > SSIM_SIDE:
+        scale = SSIM_SIDE / max(size)
+        size = (round(size[0] * scale), round(size[1] * scale))
+    x, y = _luma(reference, size), _luma(stored, size)
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    mx, my = _window_mean(x), _window_mean(y)
+    vx = _window_mean(x * x) - mx * mx
+    vy = _window_mean(y * y) - my * my
+    cov = _window_mean(x * y) - mx * my
+    s = ((2 * mx * my + c1) * (2 * cov + c2)) / ((mx * mx + my * my + c1) * (vx + vy + c2))
+    return float(s.mean())
+
+def bench_mode(photos: list[dict], policy: dict, repeat: int) -> dict:
+    times, sizes, scores, kept = [], [], [], 0
+    for ph in photos:
+        for _ in range(repeat):
+            p = imaging.ProcessedImage(ph["data"], ph["mime"], ph["source"], ph["mobile"])
+            t = time.perf_counter()
+            data, _, _ = p.storage(policy)
+            times.append(time.perf_counter() - t)
+        sizes.append(len(data))
+        kept += data is ph["data"]
+        out = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+        if out.size != p.image.size and out.size[::-1] == p.image.size:
+            scores.append(None)  # stored sideways: not comparable
+        else:
+            scores.append(ssim(p.image, out))
+        p.release()
+    comparable = [s for s in scores if s is not None]
+    return {
+        "bytes_total": sum(sizes),
+        "bytes_p50": int(np.median(sizes)),
+        "bytes_max": max(sizes),
+        "stored_as_uploaded": kept,
+        **summary(times, "ms", 1000),
+        "ssim_mean": round(float(np.mean(comparable)), 4) if comparable else None,
+        "ssim_min": round(min(comparable), 4) if comparable else None,
+        "sideways": len(scores) - len(comparable),
+    }
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--photos", type=int, default=8)
+    ap.add_argument("--repeat", type=int, default=1)
+    ap.add_argument("--quality", type=int, default=85)
+    ap.add_argument("--max-dim", type=int, default=3000)
+    ap.add_argument("--target-bytes", type=int, default=1_500_000)
+    ap.add_argument("--out", type=Path, default=RESULTS / "encodings.json")
+    a = ap.parse_args()
+    base = {"format": "jpeg", "quality": a.quality, "max_dim": a.max_dim, "target_bytes": a.target_bytes}
+    photos = corpus(a.photos)
+    report = {
+        "photos": len(photos),
+        "uploaded_bytes": sum(len(ph["data"]) for ph in photos),
+        "jpegtran": bool(imaging.shutil.which("jpegtran")),
+        "policy": base,
+        "modes": {name: bench_mode(photos, {**base, **mode}, a.repeat) for name, mode in MODES.items()},
+    }
+    write_report(report, a.out)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# Orientation accuracy and timing: imaging.camera_rotation against the _projection_score
+# heuristic it replaced, on the labelled synthetic set (tests/cards.py) and optionally on
+# real captures named "<anything>rot<0|90|180|270>.<ext>" (angle that makes them upright).
+#
+#   python bench/orientation.py [--seeds 3] [--photos DIR] [--out bench/results/orientation.json]
+import argparse
+import json
+import re
+import statistics
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(ROOT), str(ROOT / "tests")]
+
+import numpy as np
+from PIL import Image, ImageOps
+
+import cards
+import imaging
+
+def _projection_score(img):
+    g = img.convert("L")
+    g.thumbnail((480, 480), Image.BILINEAR)
+    arr = np.asarray(g, dtype=np.float32) / 255.0
+    return arr.mean(axis=1).var() - arr.mean(axis=0).var()
+
+def projection_rotation(img) -> int:
+    # The old normalize_camera_orientation_mobile, as the angle it applied.
+    return 270 if _projection_score(img.rotate(270, expand=True)) > _projection_score(img) else 0
+
+METHODS = {"projection_score": projection_rotation, "camera_rotation": imaging.camera_rotation}
+
+def real_photos(folder: Path):
+    for p in sorted(folder.iterdir()):
+        m = re.search(r"rot(0|90|180|270)\.\w+$", p.name)
+        if m:
+            yield p.name, ImageOps.exif_transpose(Image.open(p)).convert("RGB"), int(m.group(1))
+
+def evaluate(samples) -> dict:
+    out = {k: {"exact": 0, "axis": 0, "upside_down": 0, "ms": []} for k in METHODS}
+    n = 0
+    for _name, img, angle in samples:
+        n += 1
+        for key, fn in METHODS.items():
+            t = time.perf_counter()
+            got = fn(img)
+            out[key]["ms"].append((time.perf_counter() - t) * 1000)
+            left = (angle - got) % 360  # rotation still missing after the correction
+            out[key]["exact"] += left == 0
+            out[key]["axis"] += left in (0, 180)
+            out[key]["upside_down"] += left == 180
+    for r in out.values():
+        ms = sorted(r.pop("ms"))
+        r.update(n=n, p50_ms=round(statistics.median(ms), 2), p95_ms=round(ms[max(0, int(len(ms) * 0.95) - 1)], 2))
+    return out
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--seeds", type=int, default=3)
+    ap.add_argument("--width", type=int, default=4000)
+    ap.add_argument("--height", type=int, default=3000)
+    ap.add_argument("--photos", type=Path)
+    ap.add_argument("--out", type=Path, default=ROOT / "bench" / "results" / "orientation.json")
+    a = ap.parse_args()
+    report = {"synthetic": {"size": [a.width, a.height], "seeds": a.seeds, "layouts": list(cards.LAYOUTS),
+                            **evaluate(cards.labelled_set((a.width, a.height), a.seeds))}}
+    if a.photos:
+        report["photos"] = evaluate(real_photos(a.photos))
+    a.out.parent.mkdir(parents=True, exist_ok=True)
+    a.out.write_text(json.dumps(report, indent=2) + "\n")
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
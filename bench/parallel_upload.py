@@ -0,0 +1,80 @@
+# Serial against parallel uploads: wall clock of upload_batch for the same photos with
+# azure_app.upload_workers = 1 and = N, against the fake Graph server at several
+# request latencies. Each run uploads into a fresh folio folder, so nothing is deduplicated.
+#
+#   python bench/parallel_upload.py [--photos 8] [--workers 4] [--latency 0 0.05 0.3]
+#                                   [--repeat 2] [--mode original] [--out bench/results/parallel_upload.json]
+#
+# Each photo still has its PDF page encoded inside the batch, so at latency 0 the run is
+# all CPU and only more cores make parallel faster; with latency the threads overlap
+# their waits on the network.
+import argparse
+import io
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+from common import RESULTS, corpus, load_app, scratch_secrets, summary, use_secrets, write_report  # first: puts the app and tests/ on sys.path
+from fakegraph import FakeGraph
+
+BASE_FOLDER = "fotos_bench"
+
+def run_batch(app, records: list, runs: list[int]) -> float:
+    runs[0] += 1
+    folio = f"PAR{runs[0]:04d}"
+    target_id = app.storage_backend().ensure_folder([BASE_FOLDER, folio])
+    t = time.perf_counter()
+    app.upload_batch(target_id, folio, records, set())
+    return time.perf_counter() - t
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--photos", type=int, default=8)
+    ap.add_argument("--workers", type=int, default=4, help="upload_workers of the parallel runs")
+    ap.add_argument("--latency", type=float, nargs="+", default=[0.0, 0.05, 0.3])
+    ap.add_argument("--repeat", type=int, default=2)
+    ap.add_argument("--mode", default="original", help="[storage_encoding] mode")
+    ap.add_argument("--out", type=Path, default=RESULTS / "parallel_upload.json")
+    a = ap.parse_args()
+
+    photos = corpus(a.photos)
+    graph = FakeGraph()
+    tmp = Path(tempfile.mkdtemp(prefix="idphotos-bench-"))
+    try:
+        secrets = scratch_secrets(
+            tmp, azure_app={**graph.secrets(), "onedrive_base_folder": BASE_FOLDER},
+            image_pool={"workers": 0}, storage_encoding={"mode": a.mode},
+        )
+        app = load_app(secrets)
+        store, session = app.photo_store(), uuid.uuid4().hex
+        records = []
+        for ph in photos:
+            digest, size = store.put(session, io.BytesIO(ph["data"]))
+            records.append(app.PhotoRecord(digest, size, ph["mime"], ph["source"], store.path(digest), name=ph["name"], mobile=ph["mobile"]))
+        runs, results = [0], []
+        for latency in a.latency:
+            graph.latency = latency
+            row = {"latency_s": latency}
+            for label, workers in (("serial", 1), ("parallel", a.workers)):
+                secrets["azure_app"]["upload_workers"] = workers
+                use_secrets(secrets)
+                times = [run_batch(app, records, runs) for _ in range(a.repeat)]
+                row[label] = {"workers": workers, **summary(times, "s", 1)}
+            row["speedup"] = round(row["serial"]["p50_s"] / row["parallel"]["p50_s"], 2)
+            results.append(row)
+            print(f"latency {latency:>5}s  serial {row['serial']['p50_s']:>6}s  parallel({a.workers}) {row['parallel']['p50_s']:>6}s  x{row['speedup']}")
+        report = {
+            "config": {**{k: v for k, v in vars(a).items() if k != "out"}, "cores": os.cpu_count(), "corpus_bytes": sum(len(p["data"]) for p in photos),
+                       "requests_per_batch": sum(graph.calls.values()) // runs[0]},
+            "runs": results,
+        }
+    finally:
+        graph.close()
+        shutil.rmtree(tmp, ignore_errors=True)
+    write_report(report, a.out)
+
+if __name__ == "__main__":
+    main()
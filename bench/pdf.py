@@ -0,0 +1,79 @@
+# PDF assembly cost by page count: wall time and Python heap peak (tracemalloc) of
+# build_pdf_from_images, whose PdfPageWriter streams pages into a spooled file.
+# Pages are encoded first and the pixels released, as the upload path does
+# (_prepare_pdf_page, then ProcessedImage.release), so what is measured is the
+# assembly a job runs after its uploads. Photos cycle through the bench corpus.
+#
+#   python bench/pdf.py [--pages 5 15 50] [--repeat 3] [--photos 8] [--out bench/results/pdf.json]
+#
+# tracemalloc sees the page JPEGs and the spool buffer, not Pillow's pixel buffers,
+# which is why pixels are out of the picture before the build starts.
+import argparse
+import shutil
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from common import RESULTS, corpus, load_app, scratch_secrets, summary, write_report  # first: puts the app and tests/ on sys.path
+
+def encoded_pages(app, photos: list[dict], pages: int) -> list:
+    policy, out = app.pdf_policy(), []
+    for i in range(pages):
+        ph = photos[i % len(photos)]
+        p = app.ProcessedImage(ph["data"], ph["mime"], ph["source"], ph["mobile"])
+        p.pdf_page(policy)
+        p.release()
+        out.append(p)
+    return out
+
+def bench_pages(app, photos: list[dict], pages: int, repeat: int) -> dict:
+    t = time.perf_counter()
+    processed = encoded_pages(app, photos, pages)
+    encode_s = time.perf_counter() - t
+    page_bytes = sum(len(p.pdf_page(app.pdf_policy())[0]) for p in processed)
+    times, peaks = [], []
+    for _ in range(repeat):
+        tracemalloc.start()
+        t = time.perf_counter()
+        with app.build_pdf_from_images(processed) as f:
+            times.append(time.perf_counter() - t)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            size, spilled = f.seek(0, 2), f._rolled
+    return {
+        "pages": pages,
+        "encode_pages_s": round(encode_s, 2),
+        "page_bytes": page_bytes,
+        "pdf_bytes": size,
+        "spilled_to_disk": spilled,
+        **summary(times, "ms", 1000),
+        "pages_per_s": round(pages * len(times) / sum(times), 1),
+        "peak_heap_mb": round(max(peaks) / 1024 / 1024, 2),
+        # Above 1 the build held more than the PDF itself; below, it was streamed to disk.
+        "peak_over_pdf": round(max(peaks) / size, 2),
+    }
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--pages", type=int, nargs="+", default=[5, 15, 50])
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--photos", type=int, default=8)
+    ap.add_argument("--out", type=Path, default=RESULTS / "pdf.json")
+    a = ap.parse_args()
+    photos = corpus(a.photos)
+    tmp = Path(tempfile.mkdtemp(prefix="idphotos-bench-"))
+    try:
+        app = load_app(scratch_secrets(tmp))
+        policy = app.pdf_policy()
+        report = {
+            "config": {"repeat": a.repeat, "photos": len(photos), "pdf_policy": {k: v for k, v in policy.items() if k != "cache_dir"}},
+            "runs": [bench_pages(app, photos, n, a.repeat) for n in a.pages],
+            "process_peak_rss_mb": app.process_peak_rss_mb(),
+        }
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    write_report(report, a.out)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# Image worker scaling: photos per second through run_image_task for image_pool.workers
+# = 0 (in-process), 1, 2, 4 ... on card captures from tests/cards.py. Each task is what
+# encode_in_pool sends (encode_photo: orientation, storage and PDF page encodings), and
+# so is each thumbnail (make_thumbnail). Tasks come from as many threads as the upload
+# path would run, so the pool is kept busy.
+#
+#   python bench/pool.py [--workers 0 1 2 4] [--photos 12] [--threads 8] [--out bench/results/pool.json]
+#
+# Throughput can only grow with workers up to the number of cores; "cores" is recorded
+# next to the numbers for that reason.
+import argparse
+import io
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from common import RESULTS, load_app, scratch_secrets, summary, use_secrets, write_report  # first: puts the app and tests/ on sys.path
+import cards
+import imaging
+
+def card_photos(n: int, size: tuple[int, int]) -> list[bytes]:
+    out = []
+    for i in range(n):
+        img = cards.capture(cards.LAYOUTS[i % len(cards.LAYOUTS)], cards.CAPTURE_ANGLES[i % len(cards.CAPTURE_ANGLES)], size, seed=i)
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=92)
+        out.append(buf.getvalue())
+    return out
+
+def sweep(app, photos: list[bytes], threads: int, task) -> dict:
+    times = []
+    def one(data):
+        t = time.perf_counter()
+        task(data)
+        times.append(time.perf_counter() - t)
+    t = time.perf_counter()
+    with ThreadPoolExecutor(threads) as ex:
+        list(ex.map(one, photos))
+    wall = time.perf_counter() - t
+    return {"wall_s": round(wall, 2), "photos_per_s": round(len(photos) / wall, 2), **summary(times, "ms", 1000)}
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--workers", type=int, nargs="+", default=[0, 1, 2, 4])
+    ap.add_argument("--photos", type=int, default=12)
+    ap.add_argument("--threads", type=int, default=8)
+    ap.add_argument("--width", type=int, default=4032)
+    ap.add_argument("--height", type=int, default=3024)
+    ap.add_argument("--out", type=Path, default=RESULTS / "pool.json")
+    a = ap.parse_args()
+    photos = card_photos(a.photos, (a.width, a.height))
+    tmp = Path(tempfile.mkdtemp(prefix="idphotos-bench-"))
+    try:
+        secrets = scratch_secrets(tmp, storage_encoding={"mode": "jpeg"})
+        app = load_app(secrets)
+
+        def encode(data):
+            cfg = app.image_pool_config()
+            imaging.unshare_encodings(app.run_image_task(
+                imaging.encode_photo, data, "image/jpeg", "camera", True, False,
+                app.storage_policy(), app.pdf_policy(), cfg["shm_min_bytes"],
+            ))
+
+        def thumbnail(data):
+            app.run_image_task(imaging.make_thumbnail, data, "camera", True, app.THUMB_MAX_SIDE)
+
+        runs = []
+        for workers in a.workers:
+            secrets["image_pool"] = {"workers": workers}
+            use_secrets(secrets)
+            app.image_pool.clear()
+            t = time.perf_counter()
+            pool = app.image_pool()
+            if pool: pool.submit(os.getpid).result()  # start-up is paid once per server, not per photo
+            row = {"workers": workers, "start_s": round(time.perf_counter() - t, 2)}
+            row["encode_photo"] = sweep(app, photos, a.threads, encode)
+            row["make_thumbnail"] = sweep(app, photos, a.threads, thumbnail)
+            if pool: pool.shutdown()
+            runs.append(row)
+            print(f"workers {workers}: encode {row['encode_photo']['photos_per_s']}/s  thumbnail {row['make_thumbnail']['photos_per_s']}/s")
+        base = runs[0]
+        for row in runs:
+            row["scaling"] = {k: round(row[k]["photos_per_s"] / base[k]["photos_per_s"], 2) for k in ("encode_photo", "make_thumbnail")}
+        report = {
+            "config": {**{k: v for k, v in vars(a).items() if k != "out"}, "cores": os.cpu_count(),
+                       "storage_policy": app.storage_policy()},
+            "runs": runs,
+        }
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    write_report(report, a.out)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+# Quality gate accuracy and cost per photo, on the labelled synthetic set (tests/cards.py
+# quality_set) and optionally on real captures named "<anything>-<label>.<ext>", label one
+# of good/blurry/glare/dark/overexposed. Photos go through JPEG like a phone's, then the
+# same reduced decode and measurement ProcessedImage.quality() uses.
+#
+#   python bench/quality.py [--seeds 4] [--photos DIR] [--out bench/results/quality.json]
+import argparse
+import io
+import re
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from PIL import Image
+
+from common import RESULTS, load_app, scratch_secrets, summary, write_report  # first: puts the app and tests/ on sys.path
+import cards
+import imaging
+
+def jpeg(img: Image.Image) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=92)
+    return buf.getvalue()
+
+def real_photos(folder: Path):
+    for p in sorted(folder.iterdir()):
+        m = re.search(rf"-({'|'.join(cards.QUALITY_LABELS)})\.\w+$", p.name)
+        if m: yield p.name, p.read_bytes(), m.group(1)
+
+def evaluate(app, samples) -> dict:
+    # Per label: how often its issue was reported (no issue at all for "good"), which other
+    # issues came with it, and the range of each measurement, which is what thresholds are set from.
+    policy = app.quality_gate_policy()
+    labels, decode_t, measure_t = {}, [], []
+    for _name, data, label in samples:
+        t = time.perf_counter()
+        small = imaging.open_reduced(data, imaging.QUALITY_MAX_SIDE)
+        t1 = time.perf_counter()
+        q = imaging.capture_quality(small)
+        t2 = time.perf_counter()
+        decode_t.append(t1 - t)
+        measure_t.append(t2 - t1)
+        issues = app.quality_issues(q, policy)
+        expected = cards.QUALITY_LABELS[label]
+        r = labels.setdefault(label, {"n": 0, "detected": 0, "also_reported": {}, "ranges": {}})
+        r["n"] += 1
+        r["detected"] += (not issues) if expected is None else expected in issues
+        for issue in issues:
+            if issue != expected: r["also_reported"][issue] = r["also_reported"].get(issue, 0) + 1
+        for key, value in q.items():
+            lo, hi = r["ranges"].get(key, (value, value))
+            r["ranges"][key] = (min(lo, value), max(hi, value))
+    n = sum(r["n"] for r in labels.values())
+    return {
+        "n": n,
+        "accuracy": round(sum(r["detected"] for r in labels.values()) / n, 3),
+        # Good captures the block mode would have refused
+        "good_flagged": labels.get("good", {}).get("n", 0) - labels.get("good", {}).get("detected", 0),
+        "labels": labels,
+        "decode_reduced": summary(decode_t, "ms", 1000),
+        "capture_quality": summary(measure_t, "ms", 1000),
+        "per_photo": summary([a + b for a, b in zip(decode_t, measure_t)], "ms", 1000),
+    }
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--seeds", type=int, default=4)
+    ap.add_argument("--width", type=int, default=4000)
+    ap.add_argument("--height", type=int, default=3000)
+    ap.add_argument("--photos", type=Path)
+    ap.add_argument("--out", type=Path, default=RESULTS / "quality.json")
+    a = ap.parse_args()
+    tmp = Path(tempfile.mkdtemp(prefix="idphotos-bench-"))
+    try:
+        app = load_app(scratch_secrets(tmp))
+        synthetic = ((name, jpeg(img), label) for name, img, label in cards.quality_set((a.width, a.height), a.seeds))
+        report = {
+            "policy": app.quality_gate_policy(),
+            "synthetic": {"size": [a.width, a.height], "seeds": a.seeds, "layouts": list(cards.LAYOUTS), **evaluate(app, synthetic)},
+        }
+        if a.photos:
+            report["photos"] = evaluate(app, real_photos(a.photos))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    write_report(report, a.out)
+
+if __name__ == "__main__":
+    main()
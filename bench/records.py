@@ -0,0 +1,109 @@
+# Per-photo bookkeeping for a 50-photo batch, the part of an upload that is neither image
+# work nor network: storing each photo (hashing it on the way to disk), building the
+# session's PhotoRecords, deduplicating the batch (unique_photos), writing the job payload
+# and loading it back in the worker (JobStore.enqueue / load_photos). The dict records
+# and unique_items() PhotoRecord replaced run next to it for comparison.
+#
+#   python bench/records.py [--photos 50] [--duplicates 10] [--repeat 20] [--out bench/results/records.json]
+import argparse
+import io
+import shutil
+import tempfile
+import time
+import tracemalloc
+import uuid
+from pathlib import Path
+
+from common import RESULTS, load_app, scratch_secrets, summary, write_report  # first: puts the app and tests/ on sys.path
+import cards
+
+def unique_items(items: list[tuple[dict, str]]) -> list[tuple[dict, str, str]]:
+    # The dict-based dedup unique_photos replaced.
+    seen, out = set(), []
+    for item, src in items:
+        digest = item["sha256"]
+        if digest in seen: continue
+        seen.add(digest)
+        out.append((item, src, digest))
+    return out
+
+def jpegs(n: int, size: tuple[int, int]) -> list[bytes]:
+    out = []
+    for i in range(n):
+        buf = io.BytesIO()
+        cards.capture(cards.LAYOUTS[i % len(cards.LAYOUTS)], 0, size, seed=i).save(buf, format="JPEG", quality=90)
+        out.append(buf.getvalue())
+    return out
+
+def timed(fn, repeat: int) -> tuple[list[float], object]:
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        out = fn()
+        times.append(time.perf_counter() - t)
+    return times, out
+
+def allocated(fn) -> int:
+    tracemalloc.start()
+    kept = fn()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return size
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--photos", type=int, default=50)
+    ap.add_argument("--duplicates", type=int, default=10, help="camera shots that are also in the gallery")
+    ap.add_argument("--repeat", type=int, default=20)
+    ap.add_argument("--width", type=int, default=1600)
+    ap.add_argument("--height", type=int, default=1200)
+    ap.add_argument("--out", type=Path, default=RESULTS / "records.json")
+    a = ap.parse_args()
+    payloads = jpegs(a.photos, (a.width, a.height))
+    tmp = Path(tempfile.mkdtemp(prefix="idphotos-bench-"))
+    try:
+        app = load_app(scratch_secrets(tmp))
+        store = app.photo_store()
+
+        def put_all():
+            session = uuid.uuid4().hex
+            return [store.put(session, io.BytesIO(data)) for data in payloads]
+        put_t, stored = timed(put_all, 3)
+
+        def records():
+            return [app.PhotoRecord(d, n, "image/jpeg", "upload", store.path(d), name=f"{i:02d}.jpg") for i, (d, n) in enumerate(stored)]
+        def dicts():
+            return [(dict({"sha256": d, "mime": "image/jpeg", "size": n, "name": f"{i:02d}.jpg"}, path=store.path(d)), "upload") for i, (d, n) in enumerate(stored)]
+        batch = records() + records()[:a.duplicates]
+        old_batch = dicts() + dicts()[:a.duplicates]
+        build_t, _ = timed(records, a.repeat)
+        build_old_t, _ = timed(dicts, a.repeat)
+        unique_t, unique = timed(lambda: app.unique_photos(batch), a.repeat)
+        unique_old_t, _ = timed(lambda: unique_items(old_batch), a.repeat)
+
+        jobs = app.JobStore(tmp / "bench-jobs")
+        def enqueue():
+            return jobs.enqueue("fotos_bench", uuid.uuid4().hex[:12].upper(), unique)
+        enqueue_t, job_id = timed(enqueue, a.repeat)
+        load_t, loaded = timed(lambda: jobs.load_photos(job_id), a.repeat)
+        assert [p.sha256 for p in loaded] == [p.sha256 for p in unique]
+
+        report = {
+            "config": {**{k: v for k, v in vars(a).items() if k != "out"}, "photo_bytes": sum(map(len, payloads))},
+            "store_put_per_photo": summary([t / a.photos for t in put_t], "ms", 1000),
+            "build_records": summary(build_t, "us", 1e6),
+            "build_dicts": summary(build_old_t, "us", 1e6),
+            "unique_photos": summary(unique_t, "us", 1e6),
+            "unique_items": summary(unique_old_t, "us", 1e6),
+            "records_bytes": allocated(records),
+            "dicts_bytes": allocated(dicts),
+            "enqueue": summary(enqueue_t, "ms", 1000),
+            "load_photos": summary(load_t, "ms", 1000),
+        }
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    write_report(report, a.out)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# Start-up and rerun cost of the page: importing imaging in a fresh interpreter (and which
+# heavy modules that pulls in), then idcode.py under Streamlit's AppTest the way a new
+# session meets it: first run, plain reruns, and reruns with a folio typed in.
+#
+#   python bench/startup.py [--imports 5] [--reruns 10] [--out bench/results/startup.json]
+#
+# AppTest runs the script in this process, so the first run also pays the app's imports;
+# each rerun is the work one widget interaction costs on the server.
+import argparse
+import json
+import logging
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from common import RESULTS, ROOT, scratch_secrets, summary, write_report  # first: puts the app and tests/ on sys.path
+from streamlit.testing.v1 import AppTest
+
+FOLIO = "251215-0FF480"
+HEAVY = ("numpy", "reportlab", "pillow_heif")
+IMPORT_PROBE = f"""
+import json, sys, time
+sys.path.insert(0, {str(ROOT)!r})
+t = time.perf_counter()
+import imaging
+print(json.dumps({{"s": time.perf_counter() - t, "loaded": [m for m in {HEAVY!r} if m in sys.modules]}}))
+"""
+
+def bench_import(n: int) -> dict:
+    times, loaded = [], []
+    for _ in range(n):
+        out = json.loads(subprocess.run([sys.executable, "-c", IMPORT_PROBE], check=True, capture_output=True, text=True).stdout)
+        times.append(out["s"])
+        loaded = out["loaded"]
+    return {**summary(times, "ms", 1000), "heavy_modules_loaded": loaded}
+
+def timed(run) -> float:
+    t = time.perf_counter()
+    at = run()
+    if at.exception: raise RuntimeError(at.exception[0].message)
+    return time.perf_counter() - t
+
+def bench_app(secrets: dict, reruns: int) -> dict:
+    at = AppTest.from_file(str(ROOT / "idcode.py"), default_timeout=120)
+    for key, value in secrets.items(): at.secrets[key] = value
+    first = timed(at.run)
+    plain = [timed(at.run) for _ in range(reruns)]
+    at.text_input[0].input(FOLIO)
+    typed = timed(at.run)
+    with_folio = [timed(at.run) for _ in range(reruns)]
+    return {
+        "first_run_ms": round(first * 1000, 1),
+        "rerun": summary(plain, "ms", 1000),
+        "folio_typed_ms": round(typed * 1000, 1),
+        "rerun_with_folio": summary(with_folio, "ms", 1000),
+    }
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--imports", type=int, default=5)
+    ap.add_argument("--reruns", type=int, default=10)
+    ap.add_argument("--out", type=Path, default=RESULTS / "startup.json")
+    a = ap.parse_args()
+    tmp = Path(tempfile.mkdtemp(prefix="idphotos-bench-"))
+    logging.disable(logging.WARNING)  # Streamlit's deprecation notices, on every run
+    try:
+        report = {
+            "import_imaging": bench_import(a.imports),
+            "app": bench_app(scratch_secrets(tmp, azure_app={"onedrive_base_folder": "fotos_bench"}, image_pool={"workers": 0}), a.reruns),
+        }
+    finally:
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(tmp, ignore_errors=True)
+    write_report(report, a.out)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+# Replays a fixed photo corpus through the image stages and the whole upload flow,
+# against the fake Graph server in tests/fakegraph.py, and compares with a baseline.
+#
+#   python bench/upload.py [--photos 8] [--jobs 3] [--repeat 3] [--workers 2]
+#                          [--latency 0.005] [--throttle 0.02] [--fail 0.01]
+#                          [--save bench/results/baseline.json] [--compare bench/results/baseline.json]
+#
+# Timings depend on the machine: compare against a baseline saved on the same one.
+# Byte and request counts hardly do (only retries after injected faults move them).
+import argparse
+import io
+import json
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+from common import corpus, load_app, scratch_secrets, summary, write_report  # first: puts the app and tests/ on sys.path
+from fakegraph import FakeGraph
+
+BASE_FOLDER = "fotos_bench"
+# Lower is better for every compared metric; a run fails past tolerance over the baseline.
+COMPARED = ("p50_ms", "p95_ms", "p50_s", "p95_s", "bytes_sent", "bytes_received", "requests")
+
+# ----------------------------------------------------
+# STAGES
+# ----------------------------------------------------
+def bench_prepare(app, photos: list[dict], repeat: int) -> dict:
+    times, out = [], 0
+    for _ in range(repeat):
+        for ph in photos:
+            t = time.perf_counter()
+            data, _, _ = app.prepare_for_storage(ph["data"], ph["mime"], ph["source"])
+            times.append(time.perf_counter() - t)
+            out += len(data)
+    return {**summary(times, "ms", 1000), "photos_per_s": round(len(times) / sum(times), 2), "stored_bytes": out // repeat}
+
+def bench_orientation(photos: list[dict], repeat: int) -> dict:
+    import imaging
+    decoded = [imaging._open_img_safe(ph["data"]).convert("RGB") for ph in photos if ph["source"] == "camera"]
+    times = []
+    for _ in range(repeat):
+        for img in decoded:
+            t = time.perf_counter()
+            imaging.normalize_camera_orientation_mobile(img)
+            times.append(time.perf_counter() - t)
+    return {**summary(times, "ms", 1000), "photos_per_s": round(len(times) / sum(times), 2)}
+
+def bench_pdf(app, photos: list[dict], repeat: int) -> dict:
+    times, size = [], 0
+    for _ in range(repeat):
+        processed = [app.ProcessedImage(ph["data"], ph["mime"], ph["source"], ph["mobile"]) for ph in photos]
+        t = time.perf_counter()
+        with app.build_pdf_from_images(processed) as f:
+            times.append(time.perf_counter() - t)
+            size = f.seek(0, 2)
+    return {**summary(times, "s", 1), "pages_per_s": round(len(photos) * len(times) / sum(times), 2), "pdf_bytes": size}
+
+def bench_upload(app, graph: FakeGraph, photos: list[dict], jobs: int) -> dict:
+    # One job per folio, one after the other: latency is submit -> done as a session sees it.
+    store, runner, session = app.photo_store(), app.job_runner(), uuid.uuid4().hex
+    records = []
+    for ph in photos:
+        digest, size = store.put(session, io.BytesIO(ph["data"]))
+        records.append(app.PhotoRecord(digest, size, ph["mime"], ph["source"], store.path(digest), name=ph["name"], mobile=ph["mobile"]))
+    calls0, in0, out0 = sum(graph.calls.values()), graph.bytes_in, graph.bytes_out
+    times, failed, t_all = [], 0, time.perf_counter()
+    rss_start = app.rss_mb()
+    for j in range(jobs):
+        t = time.perf_counter()
+        job_id = runner.submit(BASE_FOLDER, f"BENCH{j:04d}", records)
+        while (job := runner.store.get(job_id))["status"] not in ("done", "failed"):
+            time.sleep(0.01)
+        times.append(time.perf_counter() - t)
+        failed += job["status"] == "failed"
+        for it in graph.drive.items.values():
+            if not it["folder"] and not it["name"].endswith((".pdf", ".json")): it["content"] = b""  # keep the fake's memory flat
+    total = time.perf_counter() - t_all
+    return {
+        "jobs": jobs, "failed": failed, "photos": len(records) * jobs, **summary(times, "s", 1),
+        "photos_per_s": round(len(records) * jobs / total, 2),
+        # Bodies on the wire, as the app sees them
+        "requests": sum(graph.calls.values()) - calls0, "bytes_sent": graph.bytes_in - in0, "bytes_received": graph.bytes_out - out0,
+        "rss_mb": {"start": rss_start, "end": app.rss_mb()},
+    }
+
+# ----------------------------------------------------
+# BASELINE
+# ----------------------------------------------------
+def compare(report: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for stage, now in report["stages"].items():
+        then = baseline.get("stages", {}).get(stage, {})
+        for key in COMPARED:
+            if key in now and then.get(key):
+                ratio = now[key] / then[key]
+                flag = ratio > 1 + tolerance
+                print(f"{stage:22} {key:10} {then[key]:>14} -> {now[key]:>14}  x{ratio:.2f}{'  REGRESSION' if flag else ''}")
+                if flag: regressions.append(f"{stage}.{key}")
+    return regressions
+
+def main() -> int:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--photos", type=int, default=8)
+    ap.add_argument("--jobs", type=int, default=3)
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--workers", type=int, default=2, help="image worker processes (0: in-process)")
+    ap.add_argument("--latency", type=float, default=0.005)
+    ap.add_argument("--throttle", type=float, default=0.02)
+    ap.add_argument("--fail", type=float, default=0.01)
+    ap.add_argument("--tolerance", type=float, default=0.2)
+    ap.add_argument("--save", type=Path)
+    ap.add_argument("--compare", type=Path)
+    a = ap.parse_args()
+
+    photos = corpus(a.photos)
+    graph = FakeGraph()
+    graph.latency, graph.throttle_rate, graph.fail_rate = a.latency, a.throttle, a.fail
+    tmp = Path(tempfile.mkdtemp(prefix="idphotos-bench-"))
+    try:
+        app = load_app(scratch_secrets(
+            tmp, azure_app={**graph.secrets(), "onedrive_base_folder": BASE_FOLDER}, image_pool={"workers": a.workers},
+        ))
+        report = {
+            "config": {**{k: v for k, v in vars(a).items() if k not in ("save", "compare")},
+                       "corpus_bytes": sum(len(p["data"]) for p in photos), "storage_policy": app.storage_policy()},
+            "stages": {
+                "prepare_for_storage": bench_prepare(app, photos, a.repeat),
+                "orientation": bench_orientation(photos, a.repeat),
+                "build_pdf": bench_pdf(app, photos, a.repeat),
+                "upload_flow": bench_upload(app, graph, photos, a.jobs),
+            },
+            "process_peak_rss_mb": app.process_peak_rss_mb(),
+        }
+    finally:
+        graph.close()
+        shutil.rmtree(tmp, ignore_errors=True)
+    write_report(report, a.save)
+    if a.compare:
+        regressions = compare(report, json.loads(a.compare.read_text()), a.tolerance)
+        if regressions:
+            print("Regresiones:", ", ".join(regressions))
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
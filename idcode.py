@@ -1,29 +1,53 @@
 import re
 import io
+import base64
+import os
+import mmap
+import time
+import uuid
+import bisect
+import resource
+import logging
+import random
+import shutil
+import json
+import zlib
+import sqlite3
 import hashlib
+import tempfile
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from importlib.machinery import ModuleSpec
 from pathlib import Path
 from datetime import datetime
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+from urllib.parse import quote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import streamlit as st
 import streamlit.components.v1 as components
 import requests
-from PIL import Image, ImageOps
+from requests.adapters import HTTPAdapter
+from PIL import Image
 
-import numpy as np
+# Optional cross-process folio locks (POSIX only)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
-# PDF
-from reportlab.pdfgen import canvas
-from reportlab.lib.utils import ImageReader
-from reportlab.lib.pagesizes import letter, landscape, portrait
-from reportlab.lib.units import mm
+from imaging import ProcessedImage, guess_suffix, page_layout, init_worker, encode_photo, make_thumbnail, unshare_encodings
 
-# Optional HEIC/HEIF support
-try:
-    import pillow_heif  # type: ignore
-    pillow_heif.register_heif_opener()
-    HEIF_OK = True
-except Exception:
-    HEIF_OK = False
+log = logging.getLogger("idphotos")
+
+# Streamlit runs this file as a bare "__main__" module; with a spec, multiprocessing
+# workers (see IMAGE WORKERS) start without re-running the whole app.
+__spec__ = ModuleSpec("__main__", None)
 
 # ----------------------------------------------------
 # STREAMLIT CONFIG
@@ -263,15 +287,33 @@ def scroll_to_top():
         height=0,
     )
 
+# ----------------------------------------------------
+# STATIC IMAGES
+# ----------------------------------------------------
+# Read and shrunk once per process to about twice their display width.
+@st.cache_resource
+def static_image(paths: tuple[str, ...], max_width: int) -> bytes | None:
+    for p in map(Path, paths):
+        if not p.exists(): continue
+        with Image.open(p) as img:
+            fmt = "PNG" if img.mode in ("RGBA", "LA", "P") else "JPEG"
+            if img.width > max_width:
+                img = img.resize((max_width, round(img.height * max_width / img.width)), Image.LANCZOS)
+            buf = io.BytesIO()
+            if fmt == "PNG": img.save(buf, format="PNG", optimize=True)
+            else: img.convert("RGB").save(buf, format="JPEG", quality=85, optimize=True)
+            return buf.getvalue()
+    return None
+
 # ----------------------------------------------------
 # BRAND HEADER
 # ----------------------------------------------------
 def render_header():
-    logo_path = Path(__file__).parent / "att_logo.png"
+    logo = static_image((str(Path(__file__).parent / "att_logo.png"),), 256)
     c1, c2 = st.columns([1, 5], vertical_alignment="center")
     with c1:
-        if logo_path.exists():
-            st.image(str(logo_path), use_container_width=True)
+        if logo:
+            st.image(logo, use_container_width=True)
     with c2:
         st.markdown(
             """
@@ -322,95 +364,517 @@ def is_mobile_device() -> bool:
 
 IS_MOBILE = is_mobile_device()
 
-def _guess_suffix(mime: str | None, fallback_name: str | None = None) -> str:
-    if fallback_name:
-        s = Path(fallback_name).suffix
-        if s: return s.lower()
-    if not mime: return ".jpg"
-    m = mime.lower()
-    if "png" in m: return ".png"
-    if "heic" in m: return ".heic"
-    return ".jpg"
+class _LRUCache:
+    # Thread-safe LRU bounded by entry count and, optionally, by total bytes of its values.
+    def __init__(self, max_entries: int, max_bytes: int = 0):
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.items: OrderedDict = OrderedDict()
+
+    def _size(self, value) -> int:
+        return len(value) if self.max_bytes else 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None: self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value) -> None:
+        with self.lock:
+            if key in self.items:
+                self.nbytes -= self._size(self.items[key])
+            self.items[key] = value
+            self.items.move_to_end(key)
+            self.nbytes += self._size(value)
+            while len(self.items) > self.max_entries or (self.max_bytes and self.nbytes > self.max_bytes and len(self.items) > 1):
+                _, old = self.items.popitem(last=False)
+                self.nbytes -= self._size(old)
+
+    def discard(self, key) -> None:
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None: self.nbytes -= self._size(old)
+
+HASH_BLOCK = 1024 * 1024
 
 def sha256_bytes(b: bytes) -> str:
     return hashlib.sha256(b).hexdigest()
 
-def _open_img_safe(b: bytes) -> Image.Image:
-    img = Image.open(io.BytesIO(b))
-    img = ImageOps.exif_transpose(img)
-    return img
-
-def _to_png_bytes(img: Image.Image) -> bytes:
-    if img.mode != "RGB":
-        img = img.convert("RGB")
-    buf = io.BytesIO()
-    img.save(buf, format="PNG", optimize=False)
-    buf.seek(0)
-    return buf.read()
-
-def _projection_score(img: Image.Image) -> float:
-    g = img.convert("L")
-    w, h = g.size
-    max_side = 480
-    if max(w, h) > max_side:
-        scale = max_side / max(w, h)
-        g = g.resize((max(1, int(w * scale)), max(1, int(h * scale))), Image.BILINEAR)
-    arr = np.asarray(g, dtype=np.float32) / 255.0
-    row = arr.mean(axis=1)
-    col = arr.mean(axis=0)
-    return float(row.var() - col.var())
-
-def normalize_camera_orientation_mobile(img: Image.Image) -> Image.Image:
+def sha256_stream(f) -> str:
+    h = hashlib.sha256()
+    buf = bytearray(HASH_BLOCK)
+    view = memoryview(buf)
+    while n := f.readinto(buf):
+        h.update(view[:n])
+    return h.hexdigest()
+
+def map_file(path: Path) -> memoryview:
+    # Read-only view backed by the page cache instead of a private copy.
+    with open(path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size: return memoryview(b"")
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+def link_or_copy(src: Path, dst: Path) -> None:
     try:
-        score0 = _projection_score(img)
-        img90 = img.rotate(270, expand=True)
-        score90 = _projection_score(img90)
-        if score90 > score0:
-            return img90
-        return img
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+@dataclass(slots=True)
+class PhotoRecord:
+    # One photo as sessions and jobs carry it; the bytes stay in the file at path.
+    sha256: str
+    size: int
+    mime: str | None
+    source: str  # "upload" (gallery) or "camera"
+    path: Path
+    name: str | None = None
+    file_id: str | None = None
+    mobile: bool = False
+    normalized: bool = False  # downscaled and rotated upright in the browser
+
+# ----------------------------------------------------
+# TELEMETRY
+# ----------------------------------------------------
+# [telemetry] in secrets:
+#   metrics_file (Prometheus text, e.g. for node_exporter's textfile collector)
+#   metrics_port / metrics_host (serves /metrics; host defaults to 127.0.0.1)
+#   trace_file (one JSON line per upload job; traces are also logged at INFO)
+STAGE_BUCKETS = (0.005, 0.025, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+METRIC_HELP = {
+    "idphotos_stage_seconds": "Duración de cada etapa de carga, en segundos.",
+    "idphotos_jobs_total": "Trabajos de carga terminados, por estado.",
+    "idphotos_graph_requests_total": "Respuestas de Microsoft Graph, por método y estado HTTP.",
+    "idphotos_graph_errors_total": "Llamadas a Microsoft Graph sin respuesta, por método y error.",
+    "idphotos_graph_retries_total": "Reintentos de llamadas a Microsoft Graph, por estado HTTP.",
+    "idphotos_token_fetches_total": "Tokens de acceso solicitados.",
+    "idphotos_upload_resumes_total": "Sesiones de carga reanudadas tras un fallo.",
+    "idphotos_delta_resyncs_total": "Índices de carpeta reconstruidos porque expiró su delta.",
+    "idphotos_replica_copies_total": "Copias locales enviadas a OneDrive.",
+    "idphotos_replica_failures_total": "Copias locales que fallaron al enviarse a OneDrive.",
+    "idphotos_replica_seeds_total": "Carpetas locales sembradas desde OneDrive.",
+    "idphotos_replica_dedup_hits_total": "Copias locales omitidas porque OneDrive ya tenía la foto.",
+    "idphotos_bytes_in_total": "Bytes de fotos leídos por los trabajos de carga.",
+    "idphotos_bytes_out_total": "Bytes enviados al almacenamiento por los trabajos de carga.",
+    "idphotos_photos_uploaded_total": "Fotos subidas.",
+    "idphotos_dedup_hits_total": "Fotos omitidas porque el folio ya las tenía.",
+    "idphotos_batch_replays_total": "Lotes que ya estaban terminados al volver a ejecutarse.",
+    "idphotos_pdf_failures_total": "PDFs que no se pudieron generar o subir.",
+    "idphotos_pdf_fetches_total": "PDFs de folio descargados para agregarles páginas.",
+    "idphotos_pdf_pages_appended_total": "Páginas agregadas a PDFs de folio existentes.",
+    "idphotos_quality_flagged_total": "Fotos subidas con advertencias de calidad.",
+}
+
+def telemetry_config() -> dict:
+    cfg = st.secrets.get("telemetry", {})
+    return {
+        "metrics_file": cfg.get("metrics_file") or None,
+        "metrics_host": str(cfg.get("metrics_host", "127.0.0.1")),
+        "metrics_port": int(cfg.get("metrics_port", 0)),
+        "trace_file": cfg.get("trace_file") or None,
+    }
+
+def _prom_help(name: str) -> str:
+    text = METRIC_HELP.get(name) or name.removeprefix("idphotos_").removesuffix("_total").replace("_", " ").capitalize() + "."
+    return f"# HELP {name} " + text.replace("\\", "\\\\").replace("\n", "\\n")
+
+def _prom_labels(labels: tuple) -> str:
+    if not labels: return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels) + "}"
+
+class Metrics:
+    # Process-wide counters plus a latency histogram per stage; cheap enough to leave on.
+    def __init__(self, path: str | None):
+        self.path = Path(path) if path else None
+        self.lock = threading.Lock()
+        self.counters: dict[str, dict[tuple, float]] = {}
+        self.stages: dict[str, dict] = {}  # stage -> {"buckets": [...], "sum": seconds}
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self.lock:
+            h = self.stages.setdefault(stage, {"buckets": [0] * (len(STAGE_BUCKETS) + 1), "sum": 0.0})
+            h["buckets"][bisect.bisect_left(STAGE_BUCKETS, seconds)] += 1
+            h["sum"] += seconds
+
+    def render(self) -> str:
+        out = []
+        with self.lock:
+            for name in sorted(self.counters):
+                out.append(_prom_help(name))
+                out.append(f"# TYPE {name} counter")
+                for labels, v in sorted(self.counters[name].items()):
+                    out.append(f"{name}{_prom_labels(labels)} {v}")
+            if self.stages:
+                out.append(_prom_help("idphotos_stage_seconds"))
+                out.append("# TYPE idphotos_stage_seconds histogram")
+            for stage, h in sorted(self.stages.items()):
+                total = 0
+                for bound, n in zip((*STAGE_BUCKETS, "+Inf"), h["buckets"]):
+                    total += n
+                    out.append(f"idphotos_stage_seconds_bucket{_prom_labels((('stage', stage), ('le', bound)))} {total}")
+                out.append(f"idphotos_stage_seconds_sum{_prom_labels((('stage', stage),))} {h['sum']:.6f}")
+                out.append(f"idphotos_stage_seconds_count{_prom_labels((('stage', stage),))} {total}")
+        return "\n".join(out) + "\n"
+
+    def flush(self) -> None:
+        if self.path is None: return
+        tmp = self.path.with_name(f".{self.path.name}.{threading.get_ident()}")
+        tmp.write_text(self.render())
+        os.replace(tmp, self.path)
+
+def serve_metrics(m: Metrics, host: str, port: int) -> None:
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = m.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+
+@st.cache_resource
+def metrics() -> Metrics:
+    cfg = telemetry_config()
+    m = Metrics(cfg["metrics_file"])
+    if cfg["metrics_port"]:
+        try:
+            serve_metrics(m, cfg["metrics_host"], cfg["metrics_port"])
+        except OSError:
+            log.warning("No se pudo abrir el puerto de métricas %s", cfg["metrics_port"], exc_info=True)
+    return m
+
+@contextmanager
+def timed(stage: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics().observe(stage, time.perf_counter() - t0)
+
+def process_peak_rss_mb() -> dict:
+    # Lifetime high-water marks in MiB for this process and its reaped children (recycled
+    # pool workers): they never go down, so they say nothing about any single job.
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return {"self": round(own / 1024, 1), "children": round(children / 1024, 1)}
+
+def rss_mb() -> float | None:
+    # Current resident set of this process in MiB (Linux only).
+    try:
+        with open("/proc/self/statm") as f:
+            return round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024, 1)
+    except (OSError, ValueError, IndexError):
+        return None
+
+class UploadTrace:
+    # One structured record per upload job; its stages and counts also feed the process metrics.
+    def __init__(self, job_id: str | None, folio: str, photos: int):
+        self.lock = threading.Lock()
+        self.t0 = time.perf_counter()
+        self.record = {
+            "job": job_id, "folio": folio, "photos": photos,
+            "started": datetime.now().isoformat(timespec="seconds"), "stages": {}, "counts": {},
+            # Process-wide, like everything RSS: jobs running side by side share one number.
+            "rss_mb": {"start": rss_mb()},
+        }
+
+    def add_time(self, stage: str, seconds: float) -> None:
+        metrics().observe(stage, seconds)
+        with self.lock:
+            stages = self.record["stages"]
+            stages[stage] = round(stages.get(stage, 0.0) + seconds, 6)
+
+    @contextmanager
+    def stage(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - t0)
+
+    def count(self, name: str, n: int = 1) -> None:
+        metrics().inc(f"idphotos_{name}_total", n)
+        with self.lock:
+            counts = self.record["counts"]
+            counts[name] = counts.get(name, 0) + n
+
+    def finish(self, status: str, error: str | None = None) -> None:
+        seconds = time.perf_counter() - self.t0
+        self.record.update(
+            status=status, error=error, seconds=round(seconds, 3),
+            photos_per_s=round(self.record["photos"] / seconds, 3) if seconds else None,
+            process_peak_rss_mb=process_peak_rss_mb(),
+        )
+        self.record["rss_mb"]["end"] = rss_mb()
+        metrics().inc("idphotos_jobs_total", status=status)
+        line = json.dumps(self.record, ensure_ascii=False)
+        log.info("upload trace %s", line)
+        path = telemetry_config()["trace_file"]
+        if path:
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        metrics().flush()
+
+# ----------------------------------------------------
+# IMAGE WORKERS
+# ----------------------------------------------------
+# [image_pool] in secrets:
+#   workers (0 keeps all image work in the server process), max_tasks_per_child,
+#   max_memory_mb (address space per worker), max_pixels, shm_min_bytes (photos sent to
+#   and encodings returned from workers at least this big go through shared memory)
+def image_pool_config() -> dict:
+    cfg = st.secrets.get("image_pool", {})
+    return {
+        "workers": int(cfg.get("workers", min(4, multiprocessing.cpu_count()))),
+        "max_tasks_per_child": int(cfg.get("max_tasks_per_child", 200)),
+        "max_memory_mb": int(cfg.get("max_memory_mb", 0)),
+        "max_pixels": int(cfg.get("max_pixels", 0)),
+        "shm_min_bytes": int(cfg.get("shm_min_bytes", 1024 * 1024)),
+    }
+
+@st.cache_resource
+def image_pool() -> ProcessPoolExecutor | None:
+    # Decoding, rotating and encoding run here, off the GIL the sessions share.
+    cfg = image_pool_config()
+    if cfg["workers"] <= 0: return None
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context("forkserver")
+        ctx.set_forkserver_preload(["imaging"])
+    else:
+        ctx = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(
+        cfg["workers"], mp_context=ctx, initializer=init_worker,
+        initargs=(cfg["max_pixels"], cfg["max_memory_mb"]), max_tasks_per_child=cfg["max_tasks_per_child"] or None,
+    )
+
+def run_image_task(fn, data: bytes, *args):
+    # fn(data, *args) in a worker process, or right here when the pool is off or broken.
+    pool = image_pool()
+    if pool is None: return fn(data, *args)
+    shm = None
+    try:
+        if len(data) >= image_pool_config()["shm_min_bytes"]:
+            shm = shared_memory.SharedMemory(create=True, size=len(data))
+            shm.buf[:len(data)] = data
+            payload = (shm.name, len(data))
+        else:
+            payload = bytes(data)
+        return pool.submit(fn, payload, *args).result()
+    except BrokenProcessPool:
+        log.warning("Se reinician los procesos de imagen", exc_info=True)
+        pool.shutdown(wait=False, cancel_futures=True)
+        image_pool.clear()
+        return fn(data, *args)
+    finally:
+        if shm:
+            shm.close()
+            shm.unlink()
+
+def encode_in_pool(photo: ProcessedImage, storage: bool) -> None:
+    # Storage and PDF page encodings from a worker; anything missing is redone in-process.
+    if image_pool() is None: return
+    try:
+        photo.adopt(unshare_encodings(run_image_task(
+            encode_photo, photo.data, photo.mime, photo.source, photo.mobile, photo.normalized,
+            storage_policy() if storage else None, pdf_policy(), image_pool_config()["shm_min_bytes"],
+        )))
     except Exception:
-        return img
+        log.warning("No se pudo procesar la foto en un proceso de imagen", exc_info=True)
+
+THUMB_MAX_SIDE = 480
 
-def prepare_for_storage(b: bytes, mime: str | None, source: str) -> tuple[bytes, str | None, str]:
+def normalize_for_preview(b: bytes, source: str, max_side: int = THUMB_MAX_SIDE) -> Image.Image | None:
     try:
-        img = _open_img_safe(b)
-        if source == "camera" and IS_MOBILE:
-            img = normalize_camera_orientation_mobile(img)
-        png_bytes = _to_png_bytes(img)
-        return png_bytes, "image/png", ".png"
+        return ProcessedImage(b, None, source, IS_MOBILE).preview(max_side)
     except Exception:
-        return b, mime, _guess_suffix(mime)
+        return None
 
-def normalize_for_preview(b: bytes, source: str) -> Image.Image | None:
+THUMB_CACHE_BYTES = 64 * 1024 * 1024
+
+@st.cache_resource
+def _thumb_cache() -> _LRUCache:
+    # Shared by every session: photo digest -> small upright JPEG.
+    return _LRUCache(4096, THUMB_CACHE_BYTES)
+
+@st.cache_resource
+def _quality_cache() -> _LRUCache:
+    # Photo digest -> capture quality measured while making its thumbnail.
+    return _LRUCache(4096)
+
+def preview_thumbnail(b: bytes, source: str, digest: str | None = None) -> bytes | None:
+    key = (digest or sha256_bytes(b), source, IS_MOBILE and source == "camera")
+    cache = _thumb_cache()
+    thumb = cache.get(key)
+    if thumb is not None: return thumb
     try:
-        img = _open_img_safe(b)
-        if source == "camera" and IS_MOBILE:
-            img = normalize_camera_orientation_mobile(img)
-        return img
+        thumb, quality = run_image_task(make_thumbnail, b, source, IS_MOBILE, THUMB_MAX_SIDE)
     except Exception:
         return None
+    cache.put(key, thumb)
+    if quality: _quality_cache().put(key[0], quality)
+    return thumb
+
+# ----------------------------------------------------
+# QUALITY GATE
+# ----------------------------------------------------
+# [quality_gate] in secrets:
+#   mode = "off" | "warn" (default: flag in the preview and the batch manifest) | "block" (no upload)
+#   min_sharpness, max_glare, min_brightness, max_brightness, max_shadows
+def quality_gate_policy() -> dict:
+    cfg = st.secrets.get("quality_gate", {})
+    return {
+        "mode": str(cfg.get("mode", "warn")).lower(),
+        "min_sharpness": float(cfg.get("min_sharpness", 100)),
+        "max_glare": float(cfg.get("max_glare", 0.05)),
+        "min_brightness": float(cfg.get("min_brightness", 0.25)),
+        "max_brightness": float(cfg.get("max_brightness", 0.85)),
+        "max_shadows": float(cfg.get("max_shadows", 0.3)),
+    }
+
+def quality_issues(q: dict | None, policy: dict) -> list[str]:
+    if not q or policy["mode"] == "off": return []
+    issues = []
+    if q["sharpness"] < policy["min_sharpness"]: issues.append("borrosa")
+    if q["glare"] > policy["max_glare"]: issues.append("con reflejos")
+    if q["brightness"] < policy["min_brightness"] or q["shadows"] > policy["max_shadows"]: issues.append("muy oscura")
+    elif q["brightness"] > policy["max_brightness"]: issues.append("sobreexpuesta")
+    return issues
+
+def photo_issues(digest: str, policy: dict) -> list[str]:
+    # Measured by preview_thumbnail(); nothing to report for photos it could not decode.
+    return quality_issues(_quality_cache().get(digest), policy)
+
+# ----------------------------------------------------
+# STORAGE ENCODING
+# ----------------------------------------------------
+# [storage_encoding] in secrets:
+#   mode = "png" | "original" | "jpeg" | "webp" | "budget"
+#   quality, max_dim, target_bytes, format ("jpeg"/"webp", used by "budget")
+def storage_policy() -> dict:
+    cfg = st.secrets.get("storage_encoding", {})
+    return {
+        "mode": str(cfg.get("mode", "png")).lower(),
+        "format": str(cfg.get("format", "jpeg")).lower(),
+        "quality": int(cfg.get("quality", 85)),
+        "max_dim": int(cfg.get("max_dim", 3000)),
+        "target_bytes": int(cfg.get("target_bytes", 1_500_000)),
+    }
+
+def prepare_for_storage(b: bytes, mime: str | None, source: str, normalized: bool = False) -> tuple[bytes, str | None, str]:
+    try:
+        return ProcessedImage(b, mime, source, IS_MOBILE, normalized).storage(storage_policy())
+    except Exception:
+        return b, mime, guess_suffix(mime)
 
 # ----------------------------------------------------
 # ONEDRIVE
 # ----------------------------------------------------
+# Refresh this many seconds before the token's real expiry.
+TOKEN_REFRESH_MARGIN_S = 300
+
+class _TokenCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.token = ""
+        self.expires_at = 0.0
+
+    def valid(self) -> bool:
+        return bool(self.token) and time.monotonic() < self.expires_at
+
+@st.cache_resource
+def _token_cache() -> _TokenCache:
+    return _TokenCache()
+
+@st.cache_resource
+def graph_session() -> requests.Session:
+    # One keep-alive pool per process, shared by every session and thread.
+    s = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32)
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+def authority_url() -> str:
+    return st.secrets["azure_app"].get("authority_url", "https://login.microsoftonline.com").rstrip("/")
+
+def graph_url() -> str:
+    return st.secrets["azure_app"].get("graph_url", "https://graph.microsoft.com/v1.0").rstrip("/")
+
+# Throttling / transient statuses worth another attempt.
+RETRY_STATUSES = {429, 502, 503, 504}
+GRAPH_MAX_RETRIES = 5
+
+def _retry_delay(r: requests.Response, attempt: int) -> float:
+    ra = (r.headers.get("Retry-After") or "").strip()
+    base = float(ra) if ra.isdigit() else min(2 ** attempt, 30)
+    return base + random.uniform(0, 0.25 * base + 0.5)
+
+def graph_request(method: str, url: str, **kwargs) -> requests.Response:
+    m = metrics()
+    for attempt in range(GRAPH_MAX_RETRIES + 1):
+        try:
+            r = graph_session().request(method, url, **kwargs)
+        except requests.RequestException as e:
+            m.inc("idphotos_graph_errors_total", method=method, error=type(e).__name__)
+            raise
+        m.inc("idphotos_graph_requests_total", method=method, status=r.status_code)
+        if r.status_code not in RETRY_STATUSES or attempt == GRAPH_MAX_RETRIES:
+            return r
+        m.inc("idphotos_graph_retries_total", status=r.status_code)
+        time.sleep(_retry_delay(r, attempt))
+    return r
+
 def graph_token() -> str:
-    tenant_id = st.secrets["azure_app"]["tenant_id"]
-    client_id = st.secrets["azure_app"]["client_id"]
-    client_secret = st.secrets["azure_app"]["client_secret"]
-    token_url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
-    data = {
-        "client_id": client_id,
-        "client_secret": client_secret,
-        "scope": "https://graph.microsoft.com/.default",
-        "grant_type": "client_credentials",
-    }
-    r = requests.post(token_url, data=data, timeout=30)
-    r.raise_for_status()
-    return r.json()["access_token"]
+    cache = _token_cache()
+    if cache.valid(): return cache.token
+    with cache.lock:
+        # Another session may have refreshed while we waited.
+        if cache.valid(): return cache.token
+        tenant_id = st.secrets["azure_app"]["tenant_id"]
+        client_id = st.secrets["azure_app"]["client_id"]
+        client_secret = st.secrets["azure_app"]["client_secret"]
+        token_url = f"{authority_url()}/{tenant_id}/oauth2/v2.0/token"
+        data = {
+            "client_id": client_id,
+            "client_secret": client_secret,
+            "scope": "https://graph.microsoft.com/.default",
+            "grant_type": "client_credentials",
+        }
+        with timed("token"):
+            r = graph_request("POST", token_url, data=data, timeout=30)
+        metrics().inc("idphotos_token_fetches_total")
+        r.raise_for_status()
+        payload = r.json()
+        ttl = int(payload.get("expires_in", 3599))
+        cache.token = payload["access_token"]
+        cache.expires_at = time.monotonic() + max(ttl - TOKEN_REFRESH_MARGIN_S, ttl // 2)
+        return cache.token
+
+def upload_workers() -> int:
+    return max(1, int(st.secrets["azure_app"].get("upload_workers", 4)))
 
 def drive_base_url() -> str:
     user = st.secrets["azure_app"]["onedrive_user"]
-    return f"https://graph.microsoft.com/v1.0/users/{user}/drive"
+    return f"{graph_url()}/users/{user}/drive"
 
 def graph_headers_binary(mime: str | None) -> dict:
     return {"Authorization": f"Bearer {graph_token()}", "Content-Type": mime or "application/octet-stream"}
@@ -418,80 +882,1567 @@ def graph_headers_binary(mime: str | None) -> dict:
 @st.cache_resource
 def root_id() -> str:
     url = f"{drive_base_url()}/root?$select=id"
-    r = requests.get(url, headers={"Authorization": f"Bearer {graph_token()}"}, timeout=30)
+    r = graph_request("GET", url, headers={"Authorization": f"Bearer {graph_token()}"}, timeout=30)
     r.raise_for_status()
     return r.json()["id"]
 
-def ensure_folder(parent_item_id: str, folder_name: str) -> str:
+# ----------------------------------------------------
+# GRAPH $BATCH
+# ----------------------------------------------------
+GRAPH_BATCH_MAX = 20
+
+class GraphBatch:
+    # Collects independent Graph requests and sends them as JSON $batch calls.
+    # Requests must be added after the ones they depend on.
+    def __init__(self):
+        self.requests: list[dict] = []
+        self.results: dict[str, dict] = {}
+
+    def add(self, method: str, url: str, body: dict | None = None, headers: dict | None = None, depends_on: list[str] | None = None) -> str:
+        rid = str(len(self.requests) + 1)
+        req = {"id": rid, "method": method, "url": _batch_relative_url(url)}
+        if body is not None:
+            req["body"] = body
+            headers = {"Content-Type": "application/json", **(headers or {})}
+        if headers: req["headers"] = headers
+        if depends_on:
+            known = {r["id"] for r in self.requests}
+            if not set(depends_on) <= known: raise ValueError("dependsOn debe referirse a solicitudes previas.")
+            req["dependsOn"] = list(depends_on)
+        self.requests.append(req)
+        return rid
+
+    def execute(self) -> dict[str, dict]:
+        for start in range(0, len(self.requests), GRAPH_BATCH_MAX):
+            chunk = []
+            for req in self.requests[start:start + GRAPH_BATCH_MAX]:
+                req = self._rebase(req, {r["id"] for r in chunk})
+                if req is not None: chunk.append(req)
+            if chunk: self._send(chunk)
+        return self.results
+
+    def result(self, rid: str) -> dict:
+        return self.results[rid]
+
+    def _rebase(self, req: dict, in_chunk: set[str]) -> dict | None:
+        # Dependencies already answered by an earlier call are dropped, or fail this request.
+        deps = req.get("dependsOn")
+        if not deps: return req
+        done = [d for d in deps if d not in in_chunk]
+        if any(self.results[d]["status"] >= 400 for d in done):
+            self.results[req["id"]] = {"id": req["id"], "status": 424, "headers": {}, "body": None}
+            return None
+        req = dict(req)
+        pending = [d for d in deps if d in in_chunk]
+        if pending: req["dependsOn"] = pending
+        else: req.pop("dependsOn")
+        return req
+
+    def _send(self, chunk: list[dict]) -> None:
+        headers = {"Authorization": f"Bearer {graph_token()}", "Content-Type": "application/json"}
+        for attempt in range(GRAPH_MAX_RETRIES + 1):
+            r = graph_request("POST", f"{graph_url()}/$batch", headers=headers, json={"requests": chunk}, timeout=60)
+            r.raise_for_status()
+            retry, delay = [], 0.0
+            by_id = {req["id"]: req for req in chunk}
+            for res in r.json().get("responses", []):
+                if res["status"] in RETRY_STATUSES and attempt < GRAPH_MAX_RETRIES:
+                    metrics().inc("idphotos_graph_retries_total", status=res["status"])
+                    retry.append(by_id[res["id"]])
+                    ra = str((res.get("headers") or {}).get("Retry-After", "")).strip()
+                    delay = max(delay, float(ra) if ra.isdigit() else min(2 ** attempt, 30))
+                else:
+                    self.results[res["id"]] = res
+            if not retry: return
+            time.sleep(delay + random.uniform(0, 0.25 * delay + 0.5))
+            retry_ids = {req["id"] for req in retry}
+            chunk = [q for q in (self._rebase(req, retry_ids) for req in retry) if q is not None]
+            if not chunk: return
+
+def _batch_relative_url(url: str) -> str:
+    base = graph_url()
+    return url[len(base):] if url.startswith(base) else url
+
+def batch_error(res: dict) -> requests.HTTPError:
+    err = (res.get("body") or {}).get("error", {}) if isinstance(res.get("body"), dict) else {}
+    return requests.HTTPError(f"Graph $batch {res['status']}: {err.get('code', '')} {err.get('message', '')}".strip())
+
+FOLDER_CACHE_SIZE = 1024
+
+@st.cache_resource
+def _folder_cache() -> _LRUCache:
+    # "base/folio" path -> drive item id.
+    return _LRUCache(FOLDER_CACHE_SIZE)
+
+def lookup_path(folder_parts: list[str]) -> str | None:
+    headers = {"Authorization": f"Bearer {graph_token()}"}
+    url = f"{drive_base_url()}/root:/{quote('/'.join(folder_parts))}?$select=id,folder"
+    r = graph_request("GET", url, headers=headers, timeout=30)
+    if r.status_code == 404: return None
+    r.raise_for_status()
+    item = r.json()
+    if item.get("folder") is None:
+        raise ValueError(f"'{'/'.join(folder_parts)}' existe pero no es una carpeta.")
+    return item["id"]
+
+def create_folder(parent_item_id: str, folder_name: str) -> str | None:
+    # None when someone else created it first (409); the caller re-resolves.
     headers = {"Authorization": f"Bearer {graph_token()}", "Content-Type": "application/json"}
-    list_url = f"{drive_base_url()}/items/{parent_item_id}/children?$select=id,name,folder"
-    r = requests.get(list_url, headers=headers, timeout=30)
-    for item in r.json().get("value", []):
-        if item.get("name") == folder_name and item.get("folder") is not None:
-            return item["id"]
     create_url = f"{drive_base_url()}/items/{parent_item_id}/children"
-    payload = {"name": folder_name, "folder": {}, "@microsoft.graph.conflictBehavior": "rename"}
-    r = requests.post(create_url, headers=headers, json=payload, timeout=30)
+    payload = {"name": folder_name, "folder": {}, "@microsoft.graph.conflictBehavior": "fail"}
+    r = graph_request("POST", create_url, headers=headers, json=payload, timeout=30)
+    if r.status_code == 409: return None
+    r.raise_for_status()
     return r.json()["id"]
 
+def ensure_paths(paths: list[list[str]]) -> list[str]:
+    # Resolves many folder paths with at most two $batch round-trips for the misses.
+    cache = _folder_cache()
+    resolved: dict[str, str] = {}
+    todo: dict[str, list[str]] = {}
+    for parts in paths:
+        key = "/".join(parts)
+        item_id = cache.get(key)
+        if item_id:
+            resolved[key] = item_id
+            continue
+        for n in range(1, len(parts) + 1):
+            todo.setdefault("/".join(parts[:n]), parts[:n])
+    if todo:
+        auth = {"Authorization": f"Bearer {graph_token()}"}
+        lookups = GraphBatch()
+        ids = {key: lookups.add("GET", f"{drive_base_url()}/root:/{quote(key)}?$select=id,folder", headers=auth) for key in todo}
+        lookups.execute()
+        missing = []
+        for key, rid in ids.items():
+            res = lookups.result(rid)
+            if res["status"] == 404:
+                missing.append(key)
+                continue
+            if res["status"] != 200: raise batch_error(res)
+            if (res["body"] or {}).get("folder") is None:
+                raise ValueError(f"'{key}' existe pero no es una carpeta.")
+            resolved[key] = res["body"]["id"]
+        creates = GraphBatch()
+        created: dict[str, str] = {}
+        for key in sorted(missing, key=lambda k: k.count("/")):
+            parent, _, name = key.rpartition("/")
+            parent_url = f"{drive_base_url()}/root:/{quote(parent)}:/children" if parent else f"{drive_base_url()}/root/children"
+            payload = {"name": name, "folder": {}, "@microsoft.graph.conflictBehavior": "fail"}
+            deps = [created[parent]] if parent in created else None
+            created[key] = creates.add("POST", parent_url, body=payload, headers=auth, depends_on=deps)
+        if created: creates.execute()
+        for key, rid in created.items():
+            res = creates.result(rid)
+            if res["status"] in (200, 201):
+                resolved[key] = res["body"]["id"]
+            elif res["status"] in (409, 424):
+                # Lost a create race (or its parent did): fall back to one-by-one.
+                parts = todo[key]
+                parent_id = resolved.get("/".join(parts[:-1])) if len(parts) > 1 else root_id()
+                item_id = lookup_path(parts) or create_folder(parent_id, parts[-1]) or lookup_path(parts)
+                if item_id is None:
+                    raise RuntimeError(f"No se pudo crear la carpeta '{key}'.")
+                resolved[key] = item_id
+            else:
+                raise batch_error(res)
+        for key, item_id in resolved.items():
+            cache.put(key, item_id)
+    return [resolved["/".join(parts)] for parts in paths]
+
 def ensure_path(folder_parts: list[str]) -> str:
-    current = root_id()
-    for name in folder_parts:
-        current = ensure_folder(current, name)
-    return current
+    if not folder_parts: return root_id()
+    return ensure_paths([folder_parts])[0]
 
-def upload_small_file_to_folder(folder_item_id: str, filename: str, file_bytes: bytes, mime_type: str | None) -> None:
+def forget_path(folder_parts: list[str]) -> None:
+    _folder_cache().discard("/".join(folder_parts))
+
+def upload_small_file_to_folder(folder_item_id: str, filename: str, file_bytes: bytes, mime_type: str | None) -> dict:
     url = f"{drive_base_url()}/items/{folder_item_id}:/{filename}:/content"
-    r = requests.put(url, headers=graph_headers_binary(mime_type), data=file_bytes, timeout=180)
+    r = graph_request("PUT", url, headers=graph_headers_binary(mime_type), data=file_bytes, timeout=180)
+    r.raise_for_status()
+    return r.json()
+
+# Graph rejects simple PUTs above ~4 MB; larger payloads go through an upload session.
+SIMPLE_UPLOAD_MAX = 4 * 1024 * 1024
+# Session chunks must be multiples of 320 KiB.
+UPLOAD_CHUNK = 10 * 320 * 1024
+UPLOAD_MAX_RESUMES = 8
+
+def _payload_size(data) -> int:
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return memoryview(data).nbytes
+    pos = data.tell()
+    size = data.seek(0, io.SEEK_END)
+    data.seek(pos)
+    return size
+
+def create_upload_session(folder_item_id: str, filename: str) -> str:
+    headers = {"Authorization": f"Bearer {graph_token()}", "Content-Type": "application/json"}
+    url = f"{drive_base_url()}/items/{folder_item_id}:/{filename}:/createUploadSession"
+    payload = {"item": {"@microsoft.graph.conflictBehavior": "replace"}}
+    r = graph_request("POST", url, headers=headers, json=payload, timeout=30)
     r.raise_for_status()
+    return r.json()["uploadUrl"]
+
+def _next_expected_offset(upload_url: str) -> int | None:
+    # None means the session is gone and the upload has to start over.
+    r = graph_request("GET", upload_url, timeout=30)
+    if r.status_code == 404: return None
+    r.raise_for_status()
+    ranges = r.json().get("nextExpectedRanges") or ["0-"]
+    return int(ranges[0].split("-")[0])
+
+def _read_chunk(source, buf: bytearray, offset: int, length: int) -> memoryview:
+    view = memoryview(buf)[:length]
+    source.seek(offset)
+    got = 0
+    while got < length:
+        n = source.readinto(view[got:])
+        if not n: raise IOError("Fin de archivo inesperado durante la carga.")
+        got += n
+    return view
+
+def upload_large_file_to_folder(folder_item_id: str, filename: str, source) -> dict:
+    # source: bytes-like (sliced through a memoryview, no copies) or a seekable binary file.
+    # An upload session takes no content type; Graph derives it from the file name.
+    size = _payload_size(source)
+    mem = memoryview(source).cast("B") if isinstance(source, (bytes, bytearray, memoryview)) else None
+    buf = bytearray(UPLOAD_CHUNK) if mem is None else None
+    upload_url = create_upload_session(folder_item_id, filename)
+    offset, resumes = 0, 0
+    while True:
+        end = min(offset + UPLOAD_CHUNK, size)
+        chunk = mem[offset:end] if mem is not None else _read_chunk(source, buf, offset, end - offset)
+        headers = {"Content-Length": str(end - offset), "Content-Range": f"bytes {offset}-{end - 1}/{size}"}
+        try:
+            r = graph_session().put(upload_url, headers=headers, data=chunk, timeout=180)
+            metrics().inc("idphotos_graph_requests_total", method="PUT", status=r.status_code)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            metrics().inc("idphotos_graph_errors_total", method="PUT", error=type(e).__name__)
+            r = None
+        if r is not None and r.status_code in (200, 201):
+            return r.json()
+        if r is not None and r.status_code == 202:
+            offset = int(r.json()["nextExpectedRanges"][0].split("-")[0])
+            continue
+        resumes += 1
+        metrics().inc("idphotos_upload_resumes_total")
+        if resumes > UPLOAD_MAX_RESUMES:
+            if r is not None: r.raise_for_status()
+            raise IOError(f"No se pudo completar la carga de {filename}.")
+        if r is not None and r.status_code in RETRY_STATUSES:
+            time.sleep(_retry_delay(r, resumes))
+        elif r is not None and r.status_code not in (404, 416):
+            r.raise_for_status()
+        # Dropped connection or range mismatch: continue where the server says.
+        nxt = _next_expected_offset(upload_url)
+        if nxt is None:
+            upload_url, nxt = create_upload_session(folder_item_id, filename), 0
+        offset = nxt
+
+def upload_file_to_folder(folder_item_id: str, filename: str, data, mime_type: str | None) -> dict:
+    if _payload_size(data) > SIMPLE_UPLOAD_MAX:
+        return upload_large_file_to_folder(folder_item_id, filename, data)
+    if not isinstance(data, (bytes, bytearray, memoryview)):
+        data.seek(0)
+        data = data.read()
+    return upload_small_file_to_folder(folder_item_id, filename, data, mime_type)
+
+# ----------------------------------------------------
+# DEDUP
+# ----------------------------------------------------
+# Every stored photo carries the SHA-256 of the bytes as captured, both in its
+# name (``__sha256_<digest>``) and in the item description (``sha256:<digest>``).
+HASH_DESCRIPTION_PREFIX = "sha256:"
+# Older uploads only carry the first 12 hex digits in their name.
+LEGACY_HASH_LEN = 12
+HASH_INDEX_TTL_S = 600
+_NAME_HASH_RE = re.compile(r"__(?:sha256_)?([0-9a-f]{64}|[0-9a-f]{12})(?=\.|$)")
+_DESC_HASH_RE = re.compile(r"sha256:([0-9a-f]{64})")
+
+def hashed_filename(folio: str, src_type: str, digest: str, suffix: str) -> str:
+    return f"{folio}_{src_type}_{datetime.now().strftime('%H%M%S')}__sha256_{digest}{suffix}"
+
+def hashes_from_item(item: dict) -> set[str]:
+    found = set()
+    m = _NAME_HASH_RE.search(item.get("name", ""))
+    if m: found.add(m.group(1))
+    m = _DESC_HASH_RE.search(item.get("description") or "")
+    if m: found.add(m.group(1))
+    return found
+
+def is_known_hash(digest: str, hashes: set[str]) -> bool:
+    return digest in hashes or digest[:LEGACY_HASH_LEN] in hashes
 
 def list_existing_hashes(folder_item_id: str) -> set[str]:
     hashes = set()
     headers = {"Authorization": f"Bearer {graph_token()}"}
-    url = f"{drive_base_url()}/items/{folder_item_id}/children?$select=name&$top=200"
-    for _ in range(10):
-        r = requests.get(url, headers=headers, timeout=30)
+    url = f"{drive_base_url()}/items/{folder_item_id}/children?$select=name,description&$top=200"
+    while url:
+        r = graph_request("GET", url, headers=headers, timeout=30)
+        r.raise_for_status()
         data = r.json()
         for it in data.get("value", []):
-            name = it.get("name", "")
-            m = re.search(r"__sha256_([0-9a-f]{12})", name)
-            if m: hashes.add(m.group(1))
-        if not data.get("@odata.nextLink"): break
-        url = data["@odata.nextLink"]
+            hashes |= hashes_from_item(it)
+        url = data.get("@odata.nextLink")
     return hashes
 
+def set_item_hashes(pairs: list[tuple[str, str]]) -> None:
+    # Writes (item_id, digest) metadata in $batch calls; best effort since
+    # the filename already carries the digest.
+    if not pairs: return
+    auth = {"Authorization": f"Bearer {graph_token()}"}
+    batch = GraphBatch()
+    for item_id, digest in pairs:
+        batch.add("PATCH", f"{drive_base_url()}/items/{item_id}", body={"description": HASH_DESCRIPTION_PREFIX + digest}, headers=auth)
+    try:
+        batch.execute()
+    except requests.RequestException:
+        pass
+
+# Statuses meaning the drive does not offer /delta on this folder (OneDrive for
+# Business only serves it on the root); listing pages are used instead.
+DELTA_UNSUPPORTED = {400, 403, 501}
+
+class _FolderIndex:
+    # One folder's children (item id -> digests), kept current through /delta.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items: dict[str, set[str]] = {}
+        self.uploaded: set[str] = set()  # ours, until a sync has seen them
+        self.delta_link: str | None = None
+        self.synced = 0.0
+
+    def hashes(self) -> set[str]:
+        return set().union(self.uploaded, *self.items.values())
+
+class _HashIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.folders: dict[str, _FolderIndex] = {}
+        self.delta_ok = True
+
+@st.cache_resource
+def _hash_index() -> _HashIndex:
+    return _HashIndex()
+
+def _delta_sync(folder_item_id: str, entry: _FolderIndex) -> bool:
+    # Applies the changes since entry.delta_link (everything when there is none);
+    # False if the drive has no delta for this folder.
+    headers = {"Authorization": f"Bearer {graph_token()}"}
+    first = f"{drive_base_url()}/items/{folder_item_id}/delta?$select=id,name,description,deleted,parentReference"
+    url, items = entry.delta_link or first, dict(entry.items) if entry.delta_link else {}
+    while url:
+        r = graph_request("GET", url, headers=headers, timeout=30)
+        if r.status_code == 410 and url != first:
+            # Token expired or the folder was reset: enumerate it again from scratch.
+            metrics().inc("idphotos_delta_resyncs_total")
+            url, items = first, {}
+            continue
+        if r.status_code in DELTA_UNSUPPORTED and url == first:
+            return False
+        r.raise_for_status()
+        data = r.json()
+        for it in data.get("value", []):
+            # Delta also reports the folder itself and anything moved out of it.
+            if it.get("deleted") or (it.get("parentReference") or {}).get("id") != folder_item_id:
+                items.pop(it["id"], None)
+            else:
+                items[it["id"]] = hashes_from_item(it)
+        url = data.get("@odata.nextLink")
+        if not url: entry.delta_link = data.get("@odata.deltaLink")
+    entry.items = items
+    return True
+
+def existing_hashes(folder_item_id: str, max_age_s: float = HASH_INDEX_TTL_S) -> set[str]:
+    idx = _hash_index()
+    with idx.lock:
+        entry = idx.folders.setdefault(folder_item_id, _FolderIndex())
+    with entry.lock:
+        if entry.synced and time.monotonic() - entry.synced < max_age_s:
+            return entry.hashes()
+        if idx.delta_ok and not _delta_sync(folder_item_id, entry):
+            log.info("Sin delta de Graph para carpetas; se listan sus páginas")
+            idx.delta_ok = False
+        if not idx.delta_ok:
+            entry.items, entry.delta_link = {"": list_existing_hashes(folder_item_id)}, None
+        entry.uploaded -= set().union(*entry.items.values())
+        entry.synced = time.monotonic()
+        return entry.hashes()
+
+def remember_hash(folder_item_id: str, digest: str) -> None:
+    idx = _hash_index()
+    with idx.lock:
+        entry = idx.folders.get(folder_item_id)
+    if entry:
+        with entry.lock:
+            entry.uploaded.add(digest)
+
+def unique_photos(photos: list[PhotoRecord]) -> list[PhotoRecord]:
+    # Drops repeats inside the batch (e.g. same photo in gallery and camera).
+    seen, out = set(), []
+    for p in photos:
+        if p.sha256 in seen: continue
+        seen.add(p.sha256)
+        out.append(p)
+    return out
+
+# ----------------------------------------------------
+# STORAGE BACKENDS
+# ----------------------------------------------------
+# [storage] in secrets:
+#   backend: "onedrive" (default), "local" (files under dir, no Graph at all, e.g. for
+#     load tests) or "write_behind" (jobs finish on local disk under dir; a durable queue
+#     copies each file to OneDrive, retrying until Graph takes it)
+#   dir, replicate_workers
+# A backend resolves folders to ids and reads/writes named files in them; put() takes
+# bytes or a seekable file of any size and returns the stored item (id, eTag, size).
+REPLICA_RETRY_MAX_S = 900
+
+class SeedPending(Exception):
+    # The file may exist only online; a seed step in the replica queue is fetching it first.
+    def __init__(self, folder_id: str, name: str):
+        super().__init__(f"{folder_id}/{name}")
+        self.folder_id = folder_id
+        self.name = name
+
+def storage_backend_config() -> dict:
+    cfg = st.secrets.get("storage", {})
+    return {
+        "backend": str(cfg.get("backend", "onedrive")).lower(),
+        "dir": Path(cfg.get("dir") or Path(tempfile.gettempdir()) / "idphotos" / "storage"),
+        "replicate_workers": max(1, int(cfg.get("replicate_workers", 2))),
+    }
+
+class OneDriveStorage:
+    # Folder ids are drive item ids.
+    def ensure_folder(self, parts: list[str]) -> str:
+        return ensure_path(parts)
+
+    def forget_folder(self, parts: list[str]) -> None:
+        forget_path(parts)
+
+    def hashes(self, folder_id: str, max_age_s: float = HASH_INDEX_TTL_S) -> set[str]:
+        return existing_hashes(folder_id, max_age_s)
+
+    def remember(self, folder_id: str, digest: str) -> None:
+        remember_hash(folder_id, digest)
+
+    def set_hashes(self, pairs: list[tuple[str, str]]) -> None:
+        set_item_hashes(pairs)
+
+    def put(self, folder_id: str, name: str, data, mime: str | None) -> dict:
+        return upload_file_to_folder(folder_id, name, data, mime)
+
+    def get(self, folder_id: str, name: str) -> bytes | None:
+        headers = {"Authorization": f"Bearer {graph_token()}"}
+        r = graph_request("GET", f"{drive_base_url()}/items/{folder_id}:/{quote(name)}:/content", headers=headers, timeout=30)
+        if r.status_code == 404: return None
+        r.raise_for_status()
+        return r.content
+
+    def stat(self, folder_id: str, name: str) -> dict | None:
+        headers = {"Authorization": f"Bearer {graph_token()}"}
+        r = graph_request("GET", f"{drive_base_url()}/items/{folder_id}:/{quote(name)}?$select=id,eTag,size", headers=headers, timeout=30)
+        if r.status_code == 404: return None
+        r.raise_for_status()
+        return r.json()
+
+    def download(self, folder_id: str, name: str, path: Path) -> None:
+        headers = {"Authorization": f"Bearer {graph_token()}"}
+        r = graph_request("GET", f"{drive_base_url()}/items/{folder_id}:/{quote(name)}:/content", headers=headers, timeout=180, stream=True)
+        r.raise_for_status()
+        tmp = path.with_name(path.name + ".part")
+        with open(tmp, "wb") as f:
+            for block in r.iter_content(HASH_BLOCK):
+                f.write(block)
+        os.replace(tmp, path)
+
+class LocalStorage:
+    # Folder ids are paths under root ("base/folio"); the digests come from the file names
+    # and the eTags from mtime and size. Files are replaced atomically and fsynced.
+    def __init__(self, root: Path):
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def path(self, folder_id: str, name: str) -> Path:
+        return self.root / folder_id / name
+
+    def _item(self, folder_id: str, name: str, info: os.stat_result) -> dict:
+        return {"id": f"{folder_id}/{name}", "name": name, "eTag": f"{info.st_mtime_ns:x}-{info.st_size:x}", "size": info.st_size}
+
+    def ensure_folder(self, parts: list[str]) -> str:
+        folder_id = "/".join(parts)
+        (self.root / folder_id).mkdir(parents=True, exist_ok=True)
+        return folder_id
+
+    def forget_folder(self, parts: list[str]) -> None:
+        pass
+
+    def hashes(self, folder_id: str, max_age_s: float = HASH_INDEX_TTL_S) -> set[str]:
+        # A directory listing is cheap enough to take every time.
+        found = set()
+        with os.scandir(self.root / folder_id) as it:
+            for e in it:
+                if not e.name.startswith("."): found |= hashes_from_item({"name": e.name})
+        return found
+
+    def remember(self, folder_id: str, digest: str) -> None:
+        pass
+
+    def set_hashes(self, pairs: list[tuple[str, str]]) -> None:
+        pass
+
+    def put(self, folder_id: str, name: str, data, mime: str | None) -> dict:
+        dest = self.path(folder_id, name)
+        tmp = tempfile.NamedTemporaryFile(dir=dest.parent, prefix=".in-", delete=False)
+        try:
+            with tmp:
+                if isinstance(data, (bytes, bytearray, memoryview)):
+                    tmp.write(data)
+                else:
+                    data.seek(0)
+                    shutil.copyfileobj(data, tmp, HASH_BLOCK)
+                tmp.flush()
+                os.fsync(tmp.fileno())
+            os.replace(tmp.name, dest)
+        finally:
+            Path(tmp.name).unlink(missing_ok=True)
+        return self._item(folder_id, name, dest.stat())
+
+    def get(self, folder_id: str, name: str) -> bytes | None:
+        try:
+            return self.path(folder_id, name).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def stat(self, folder_id: str, name: str) -> dict | None:
+        try:
+            return self._item(folder_id, name, self.path(folder_id, name).stat())
+        except FileNotFoundError:
+            return None
+
+    def download(self, folder_id: str, name: str, path: Path) -> None:
+        tmp = path.with_name(path.name + ".part")
+        shutil.copyfile(self.path(folder_id, name), tmp)
+        os.replace(tmp, path)
+
+class ReplicaQueue:
+    # SQLite list of local files still to copy to OneDrive, one row per file. Putting a
+    # file again bumps its version, so a copy that was already running does not clear it.
+    # A "seed" row goes the other way: it brings a file only the drive has into the local
+    # tree, and the seeds table remembers which files no longer need that check.
+    def __init__(self, path: Path):
+        self.path = path
+        with self._db() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                """CREATE TABLE IF NOT EXISTS replicas (
+                    folder TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    mime TEXT,
+                    kind TEXT NOT NULL DEFAULT 'copy',
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    version INTEGER NOT NULL DEFAULT 1,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    not_before REAL NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (folder, name)
+                )"""
+            )
+            if "kind" not in {r["name"] for r in db.execute("PRAGMA table_info(replicas)")}:
+                db.execute("ALTER TABLE replicas ADD COLUMN kind TEXT NOT NULL DEFAULT 'copy'")
+            db.execute("CREATE TABLE IF NOT EXISTS seeds (folder TEXT NOT NULL, name TEXT NOT NULL, PRIMARY KEY (folder, name))")
+
+    @contextmanager
+    def _db(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def add(self, folder: str, name: str, mime: str | None) -> None:
+        with self._db() as db:
+            db.execute(
+                "INSERT INTO replicas (folder, name, mime, created_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(folder, name) DO UPDATE SET mime = excluded.mime, kind = 'copy', version = version + 1, attempts = 0, error = NULL, not_before = 0",
+                (folder, name, mime, time.time()),
+            )
+
+    def add_seed(self, folder: str, name: str) -> None:
+        with self._db() as db:
+            db.execute(
+                "INSERT INTO replicas (folder, name, kind, created_at) VALUES (?, ?, 'seed', ?) ON CONFLICT(folder, name) DO NOTHING",
+                (folder, name, time.time()),
+            )
+
+    def seeded(self, folder: str, name: str) -> bool:
+        with self._db() as db:
+            return db.execute("SELECT 1 FROM seeds WHERE folder = ? AND name = ?", (folder, name)).fetchone() is not None
+
+    def mark_seeded(self, folder: str, name: str) -> None:
+        with self._db() as db:
+            db.execute("INSERT OR IGNORE INTO seeds (folder, name) VALUES (?, ?)", (folder, name))
+
+    def claim(self) -> dict | None:
+        # Oldest first, so a batch's photos go up before its PDF and final manifest.
+        with self._db() as db:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                "SELECT * FROM replicas WHERE status = 'queued' AND not_before <= ? ORDER BY created_at LIMIT 1", (time.time(),)
+            ).fetchone()
+            if row:
+                db.execute("UPDATE replicas SET status = 'running', attempts = attempts + 1 WHERE folder = ? AND name = ?", (row["folder"], row["name"]))
+            db.execute("COMMIT")
+        if not row: return None
+        item = dict(row)
+        item["attempts"] += 1
+        return item
+
+    def done(self, item: dict) -> None:
+        with self._db() as db:
+            db.execute("DELETE FROM replicas WHERE folder = ? AND name = ? AND version = ?", (item["folder"], item["name"], item["version"]))
+            # Put again while it was copying: copy the newer file too.
+            db.execute("UPDATE replicas SET status = 'queued' WHERE folder = ? AND name = ?", (item["folder"], item["name"]))
+
+    def fail(self, item: dict, error: str, delay: float) -> None:
+        with self._db() as db:
+            db.execute(
+                "UPDATE replicas SET status = 'queued', error = ?, not_before = ? WHERE folder = ? AND name = ?",
+                (error, time.time() + delay, item["folder"], item["name"]),
+            )
+
+    def pending(self) -> int:
+        with self._db() as db:
+            return db.execute("SELECT COUNT(*) FROM replicas").fetchone()[0]
+
+    def recover(self) -> None:
+        with self._db() as db:
+            db.execute("UPDATE replicas SET status = 'queued' WHERE status = 'running'")
+
+class WriteBehindStorage(LocalStorage):
+    # The local files are the source of truth and the drive a replica: every put is
+    # queued, and worker threads copy the files to the same folder paths in OneDrive.
+    # on_seeded(folder_id, name) runs once a seed step has brought a file in (or found none).
+    def __init__(self, root: Path, queue: ReplicaQueue, workers: int, on_seeded=None):
+        super().__init__(root)
+        self.queue = queue
+        self.on_seeded = on_seeded
+        self.wake = threading.Event()
+        queue.recover()
+        self.threads = [threading.Thread(target=self._loop, name=f"replicate-{i}", daemon=True) for i in range(workers)]
+        for t in self.threads: t.start()
+
+    def put(self, folder_id: str, name: str, data, mime: str | None) -> dict:
+        item = super().put(folder_id, name, data, mime)
+        self.queue.add(folder_id, name, mime)
+        self.wake.set()
+        return item
+
+    def stat(self, folder_id: str, name: str) -> dict | None:
+        # Local only, no Graph calls here. A file the drive may have (e.g. a folio PDF from
+        # before write-behind) is seeded by the replicator first, so appending to it locally
+        # never drops what is online; until then the caller gets SeedPending.
+        item = super().stat(folder_id, name)
+        if item is not None or self.queue.seeded(folder_id, name): return item
+        self.queue.add_seed(folder_id, name)
+        self.wake.set()
+        raise SeedPending(folder_id, name)
+
+    def seeded(self, folder_id: str, name: str) -> bool:
+        return self.queue.seeded(folder_id, name)
+
+    def _loop(self) -> None:
+        while True:
+            try:
+                item = self.queue.claim()
+            except sqlite3.Error:
+                log.exception("No se pudo leer la cola de réplicas")
+                item = None
+            if item is None:
+                self.wake.wait(JOB_IDLE_WAIT_S)
+                self.wake.clear()
+                continue
+            try:
+                if item["kind"] == "seed":
+                    with timed("seed"):
+                        self.seed(item)
+                    self.queue.done(item)
+                    if self.on_seeded: self.on_seeded(item["folder"], item["name"])
+                    continue
+                with timed("replicate"):
+                    self.replicate(item)
+                self.queue.done(item)
+                metrics().inc("idphotos_replica_copies_total")
+            except Exception as e:
+                # Graph down or throttling: the file waits on disk, backing off up to REPLICA_RETRY_MAX_S.
+                delay = min(REPLICA_RETRY_MAX_S, JOB_RETRY_BACKOFF_S * 2 ** (item["attempts"] - 1))
+                log.warning("No se pudo replicar %s/%s (intento %d); se reintenta en %.0f s", item["folder"], item["name"], item["attempts"], delay, exc_info=True)
+                metrics().inc("idphotos_replica_failures_total")
+                forget_path(item["folder"].split("/"))
+                self.queue.fail(item, f"{type(e).__name__}: {e}", delay)
+
+    def seed(self, item: dict) -> None:
+        # Nothing writes the local file while it is unseeded (stat raises), so no merge is needed.
+        remote_folder = lookup_path(item["folder"].split("/"))
+        if remote_folder is not None and OneDriveStorage().stat(remote_folder, item["name"]) is not None:
+            dest = self.path(item["folder"], item["name"])
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            OneDriveStorage().download(remote_folder, item["name"], dest)
+            metrics().inc("idphotos_replica_seeds_total")
+        self.queue.mark_seeded(item["folder"], item["name"])
+
+    def replicate(self, item: dict) -> None:
+        try:
+            f = open(self.path(item["folder"], item["name"]), "rb")
+        except FileNotFoundError:
+            return  # deleted locally since it was queued
+        with f:
+            target_id = ensure_path(item["folder"].split("/"))
+            digest = next(iter(hashes_from_item({"name": item["name"]})), None)
+            if digest and is_known_hash(digest, existing_hashes(target_id)):
+                # Already online under another name (an upload from before write-behind).
+                metrics().inc("idphotos_replica_dedup_hits_total")
+                return
+            uploaded = upload_file_to_folder(target_id, item["name"], f, item["mime"])
+        if digest:
+            remember_hash(target_id, digest)
+            set_item_hashes([(uploaded["id"], digest)])
+
+@st.cache_resource
+def storage_backend() -> OneDriveStorage | LocalStorage:
+    cfg = storage_backend_config()
+    if cfg["backend"] == "onedrive":
+        return OneDriveStorage()
+    if cfg["backend"] == "local":
+        return LocalStorage(cfg["dir"])
+    if cfg["backend"] == "write_behind":
+        cfg["dir"].mkdir(parents=True, exist_ok=True)
+        # Jobs waiting on a seed (see run_upload_job) go back in the queue once it is done.
+        queue = ReplicaQueue(cfg["dir"] / "replicas.sqlite3")
+        return WriteBehindStorage(cfg["dir"], queue, cfg["replicate_workers"], on_seeded=lambda folder_id, name: job_runner().resume(folder_id))
+    raise ValueError(f"Backend de almacenamiento desconocido: {cfg['backend']}")
+
+# ----------------------------------------------------
+# UPLOAD
+# ----------------------------------------------------
+def _prepare_pdf_page(photo: ProcessedImage) -> None:
+    # Encode the page while the pixels are still decoded; the PDF build reports failures.
+    try:
+        photo.pdf_page(pdf_policy())
+    except Exception:
+        log.warning("No se pudo preparar la página PDF", exc_info=True)
+    # Already measured by the image worker unless the pool is off; only flags the manifest.
+    if quality_gate_policy()["mode"] != "off":
+        try:
+            photo.quality()
+        except Exception:
+            log.debug("Sin medición de calidad", exc_info=True)
+
+def _absorb_timings(trace: UploadTrace, photo: ProcessedImage) -> None:
+    for stage, seconds in photo.take_timings().items():
+        trace.add_time(stage, seconds)
+
+def _process_and_upload(target_id: str, folio: str, rec: PhotoRecord, exist_hashes: set[str], trace: UploadTrace, in_pdf: set[str]) -> tuple[ProcessedImage, str | None]:
+    photo = ProcessedImage(map_file(rec.path), rec.mime, rec.source, rec.mobile, rec.normalized)
+    trace.count("bytes_in", rec.size)
+    try:
+        known = is_known_hash(rec.sha256, exist_hashes)
+        if known and rec.sha256 in in_pdf:
+            # Already stored and already a page of the folio PDF: nothing to encode.
+            trace.count("dedup_hits")
+            return photo, None
+        encode_in_pool(photo, storage=not known)
+        if known:
+            trace.count("dedup_hits")
+            _prepare_pdf_page(photo)
+            return photo, None
+        try:
+            sb, sm, ss = photo.storage(storage_policy())
+        except Exception:
+            log.warning("Codificación de almacenamiento fallida; se sube el original %s", rec.sha256[:12], exc_info=True)
+            sb, sm, ss = photo.data, photo.mime, guess_suffix(photo.mime)
+        _prepare_pdf_page(photo)
+        with trace.stage("put"):
+            uploaded = storage_backend().put(target_id, hashed_filename(folio, rec.source, rec.sha256, ss), sb, sm)
+        trace.count("bytes_out", _payload_size(sb))
+        trace.count("photos_uploaded")
+        storage_backend().remember(target_id, rec.sha256)
+        return photo, uploaded["id"]
+    finally:
+        # Only the encodings are kept from here on.
+        _absorb_timings(trace, photo)
+        photo.release()
+
+def upload_batch(target_id: str, folio: str, photos: list[PhotoRecord], exist_hashes: set[str], on_progress=None, trace: UploadTrace | None = None, in_pdf: set[str] = frozenset()) -> list[ProcessedImage]:
+    # Returns the processed photos in input order; on_progress fires in completion order.
+    # Photos in in_pdf that are already stored come back without PDF pages.
+    results: list[ProcessedImage] = [None] * len(photos)
+    if not photos: return results
+    trace = trace or UploadTrace(None, folio, len(photos))
+    uploaded: list[tuple[str, str]] = []
+    ex = ThreadPoolExecutor(max_workers=min(upload_workers(), len(photos)), thread_name_prefix="upload")
+    try:
+        futs = {ex.submit(_process_and_upload, target_id, folio, rec, exist_hashes, trace, in_pdf): i for i, rec in enumerate(photos)}
+        for done, fut in enumerate(as_completed(futs), 1):
+            i = futs[fut]
+            results[i], item_id = fut.result()
+            if item_id: uploaded.append((item_id, photos[i].sha256))
+            if on_progress: on_progress(done, len(photos))
+    finally:
+        ex.shutdown(wait=True, cancel_futures=True)
+    with trace.stage("set_hashes"):
+        storage_backend().set_hashes(uploaded)
+    return results
+
 # ----------------------------------------------------
 # PDF BUILDER
 # ----------------------------------------------------
-def build_pdf_from_images_high_quality(image_bytes_list: list[bytes]) -> bytes:
-    if not image_bytes_list: raise ValueError("No hay imágenes.")
-    out = io.BytesIO()
-    c = canvas.Canvas(out, pageCompression=0)
-    margin = 10 * mm
-    for b in image_bytes_list:
-        img = _open_img_safe(b)
-        if img.mode != "RGB": img = img.convert("RGB")
-        w_px, h_px = img.size
-        if w_px >= h_px: page_w, page_h = landscape(letter)
-        else: page_w, page_h = portrait(letter)
-        
-        png_buf = io.BytesIO()
-        img.save(png_buf, format="PNG", optimize=False)
-        png_buf.seek(0)
-        
-        max_w = page_w - 2 * margin
-        max_h = page_h - 2 * margin
-        scale = min(max_w / w_px, max_h / h_px, 1.0)
-        draw_w = w_px * scale
-        draw_h = h_px * scale
-        x = (page_w - draw_w) / 2
-        y = (page_h - draw_h) / 2
-        c.setPageSize((page_w, page_h))
-        c.drawImage(ImageReader(png_buf), x, y, width=draw_w, height=draw_h, mask="auto")
-        c.showPage()
-    c.save()
+# [pdf] in secrets: dpi, quality, spool_max_bytes,
+#   incremental (one <folio>_fotos.pdf per folio, new photos appended as pages), cache_dir
+def pdf_policy() -> dict:
+    cfg = st.secrets.get("pdf", {})
+    return {
+        "dpi": int(cfg.get("dpi", 150)),
+        "quality": int(cfg.get("quality", 85)),
+        "spool_max_bytes": int(cfg.get("spool_max_bytes", 8 * 1024 * 1024)),
+        "incremental": bool(cfg.get("incremental", False)),
+        "cache_dir": Path(cfg.get("cache_dir") or Path(tempfile.gettempdir()) / "idphotos" / "pdf"),
+    }
+
+class PdfPageWriter:
+    # Writes a PDF of one JPEG image per page straight to a binary file, page by
+    # page. Images are embedded as DCT streams and page contents are deflated.
+    def __init__(self, out):
+        self.out = out
+        self.start = out.tell()
+        self.offsets: dict[int, int] = {}
+        self.kids: list[int] = []
+        self.digests: list[str] = []  # sha256 of the photo behind each page, when known
+        self.prev_xref: int | None = None
+        self.next_id = 3  # 1: catalog, 2: page tree, both written on close()
+        out.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    @classmethod
+    def append_to(cls, f) -> "PdfPageWriter":
+        # Continues a PDF written by this class as an incremental update: the
+        # bytes already there stay untouched and new pages go after them.
+        self = cls.__new__(cls)
+        self.out, self.start, self.offsets = f, 0, {}
+        self.prev_xref, self.next_id, self.kids, self.digests = read_pdf_state(f)
+        f.seek(0, io.SEEK_END)
+        return self
+
+    def _new_id(self) -> int:
+        self.next_id += 1
+        return self.next_id - 1
+
+    def _write_obj(self, oid: int, head: bytes, stream=None) -> None:
+        self.offsets[oid] = self.out.tell() - self.start
+        self.out.write(b"%d 0 obj\n" % oid + head)
+        if stream is not None:
+            self.out.write(b"\nstream\n")
+            self.out.write(stream)
+            self.out.write(b"\nendstream")
+        self.out.write(b"\nendobj\n")
+
+    def add_jpeg_page(self, jpeg: bytes, size_px: tuple[int, int], gray: bool, upright: tuple[int, int], digest: str | None = None) -> None:
+        page_w, page_h, x, y, draw_w, draw_h = page_layout(*upright)
+        img_id, content_id, page_id = self._new_id(), self._new_id(), self._new_id()
+        cs = b"/DeviceGray" if gray else b"/DeviceRGB"
+        self._write_obj(
+            img_id,
+            b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s /BitsPerComponent 8 /Filter /DCTDecode /Length %d >>"
+            % (size_px[0], size_px[1], cs, memoryview(jpeg).nbytes),
+            jpeg,
+        )
+        content = zlib.compress(b"q %.3f 0 0 %.3f %.3f %.3f cm /Im0 Do Q" % (draw_w, draw_h, x, y))
+        self._write_obj(content_id, b"<< /Length %d /Filter /FlateDecode >>" % len(content), content)
+        self._write_obj(
+            page_id,
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.3f %.3f] /Resources << /XObject << /Im0 %d 0 R >> /ProcSet [/PDF /ImageB /ImageC] >> /Contents %d 0 R >>"
+            % (page_w, page_h, img_id, content_id),
+        )
+        self.kids.append(page_id)
+        if digest: self.digests.append(digest)
+
+    def close(self) -> None:
+        kids = b" ".join(b"%d 0 R" % k for k in self.kids)
+        extra = b" /IDphotosDigests [%s]" % b" ".join(b"(%s)" % d.encode() for d in self.digests) if self.digests else b""
+        self._write_obj(2, b"<< /Type /Pages /Kids [%s] /Count %d%s >>" % (kids, len(self.kids), extra))
+        if self.prev_xref is None:
+            self._write_obj(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+        xref = self.out.tell() - self.start
+        if self.prev_xref is None:
+            self.out.write(b"xref\n0 %d\n0000000000 65535 f \n" % self.next_id)
+            for oid in range(1, self.next_id):
+                self.out.write(b"%010d 00000 n \n" % self.offsets[oid])
+            self.out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (self.next_id, xref))
+            return
+        # Incremental section: the new page tree plus the objects added since the last one.
+        self.out.write(b"xref\n0 1\n0000000000 65535 f \n2 1\n%010d 00000 n \n" % self.offsets[2])
+        added = sorted(oid for oid in self.offsets if oid > 2)
+        if added:
+            self.out.write(b"%d %d\n" % (added[0], len(added)))
+            for oid in added:
+                self.out.write(b"%010d 00000 n \n" % self.offsets[oid])
+        self.out.write(
+            b"trailer\n<< /Size %d /Root 1 0 R /Prev %d >>\nstartxref\n%d\n%%%%EOF\n" % (self.next_id, self.prev_xref, xref)
+        )
+
+def read_pdf_state(f) -> tuple[int, int, list[int], list[str]]:
+    # (last xref offset, /Size, page ids, page digests) of a PDF written by
+    # PdfPageWriter; ValueError for anything else.
+    end = f.seek(0, io.SEEK_END)
+    f.seek(max(0, end - 1024))
+    m = re.search(rb"startxref\s+(\d+)\s+%%EOF\s*$", f.read())
+    if not m: raise ValueError("PDF sin startxref.")
+    xref = int(m.group(1))
+    f.seek(xref)
+    table, _, trailer = f.read(end - xref).partition(b"trailer")
+    tokens = table.split()
+    if not tokens or tokens[0] != b"xref": raise ValueError("PDF sin tabla xref.")
+    offsets, i = {}, 1
+    while i + 1 < len(tokens):
+        first, count = int(tokens[i]), int(tokens[i + 1])
+        for n in range(count):
+            offsets[first + n] = int(tokens[i + 2 + 3 * n])
+        i += 2 + 3 * count
+    size = re.search(rb"/Size (\d+)", trailer)
+    if 2 not in offsets or not size: raise ValueError("PDF sin árbol de páginas.")
+    f.seek(offsets[2])
+    pages = f.read(xref - offsets[2]).partition(b"endobj")[0]
+    kids = re.search(rb"/Kids \[([^\]]*)\]", pages)
+    if not kids: raise ValueError("PDF sin árbol de páginas.")
+    digests = re.search(rb"/IDphotosDigests \[([^\]]*)\]", pages)
+    return (
+        xref, int(size.group(1)),
+        [int(k) for k in re.findall(rb"(\d+) 0 R", kids.group(1))],
+        [d.decode() for d in re.findall(rb"\(([0-9a-f]{64})\)", digests.group(1))] if digests else [],
+    )
+
+def build_pdf_from_images(photos: list[ProcessedImage]) -> tempfile.SpooledTemporaryFile:
+    # Spills to disk past spool_max_bytes; the caller uploads and closes it.
+    if not photos: raise ValueError("No hay imágenes.")
+    policy = pdf_policy()
+    out = tempfile.SpooledTemporaryFile(max_size=policy["spool_max_bytes"])
+    try:
+        writer = PdfPageWriter(out)
+        for p in photos:
+            writer.add_jpeg_page(*p.pdf_page(policy))
+        writer.close()
+    except Exception:
+        out.close()
+        raise
     out.seek(0)
-    return out.read()
+    return out
+
+def upload_pdf(target_id: str, folio: str, photos: list[ProcessedImage], trace: UploadTrace | None = None, name: str | None = None) -> bool:
+    # The photos are already up, so a failed PDF is reported but does not fail the job.
+    trace = trace or UploadTrace(None, folio, len(photos))
+    ok = False
+    try:
+        with trace.stage("pdf_build"):
+            pdf_f = build_pdf_from_images(photos)
+        with pdf_f:
+            pdf_n = name or f"{folio}_fotos_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
+            with trace.stage("pdf_put"):
+                storage_backend().put(target_id, pdf_n, pdf_f, "application/pdf")
+            trace.count("bytes_out", _payload_size(pdf_f))
+        ok = True
+    except Exception as e:
+        log.exception("No se pudo generar o subir el PDF del folio %s", folio)
+        trace.count("pdf_failures")
+        trace.record["pdf_error"] = f"{type(e).__name__}: {e}"
+    for i, p in enumerate(photos):
+        _absorb_timings(trace, p)
+        log.debug("folio %s foto %d: %s", folio, i + 1, p.stats())
+    return ok
+
+# Incremental mode keeps a local copy of each folio PDF; the stored file's (eTag, size)
+# tells whether that copy is still the current one.
+def _folio_pdf_writer(target_id: str, name: str, path: Path, meta_path: Path, trace: UploadTrace):
+    # (open file, writer) positioned after the PDF online, fetched again if the local copy is stale.
+    remote = storage_backend().stat(target_id, name)
+    if remote is None:
+        f = open(path, "w+b")
+        return f, PdfPageWriter(f)
+    try:
+        local = json.loads(meta_path.read_text()) if path.exists() else None
+    except (OSError, ValueError):
+        local = None
+    online = {"eTag": remote.get("eTag"), "size": remote.get("size")}
+    if local != online:
+        with trace.stage("pdf_fetch"):
+            storage_backend().download(target_id, name, path)
+        meta_path.write_text(json.dumps(online))
+        trace.count("pdf_fetches")
+    f = open(path, "r+b")
+    try:
+        return f, PdfPageWriter.append_to(f)
+    except Exception:
+        f.close()
+        raise
+
+def _folio_pdf_paths(target_id: str, name: str) -> tuple[Path, Path]:
+    cache_dir = pdf_policy()["cache_dir"]
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    key = hashlib.sha256(f"{target_id}/{name}".encode()).hexdigest()[:32]
+    return cache_dir / f"{key}.pdf", cache_dir / f"{key}.json"
+
+def folio_pdf_digests(target_id: str, folio: str, trace: UploadTrace) -> set[str]:
+    # Photos already paged into <folio>_fotos.pdf; also refreshes the local copy for the append.
+    name = f"{folio}_fotos.pdf"
+    try:
+        f, writer = _folio_pdf_writer(target_id, name, *_folio_pdf_paths(target_id, name), trace)
+    except Exception:
+        log.debug("Sin páginas previas para %s", name, exc_info=True)
+        return set()
+    with f:
+        return set(writer.digests)
+
+def upload_folio_pdf(target_id: str, folio: str, records: list[PhotoRecord], photos: list[ProcessedImage], trace: UploadTrace, fallback_name: str) -> str | None:
+    # Appends pages for photos not yet in <folio>_fotos.pdf and uploads it; returns the
+    # PDF name, or None if it failed (like upload_pdf, that does not fail the job).
+    # Raises SeedPending while the storage is still fetching the online copy.
+    name = f"{folio}_fotos.pdf"
+    policy = pdf_policy()
+    path, meta_path = _folio_pdf_paths(target_id, name)
+    try:
+        f, writer = _folio_pdf_writer(target_id, name, path, meta_path, trace)
+    except SeedPending:
+        raise  # the caller keeps this batch's pages for later
+    except ValueError:
+        # Not a PDF this app can append to (edited by hand?): leave it and write this batch's own.
+        log.warning("No se puede extender %s; se genera un PDF del lote", name, exc_info=True)
+        return fallback_name if upload_pdf(target_id, folio, photos, trace=trace, name=fallback_name) else None
+    except Exception as e:
+        log.exception("No se pudo leer el PDF del folio %s", folio)
+        trace.count("pdf_failures")
+        trace.record["pdf_error"] = f"{type(e).__name__}: {e}"
+        return None
+    with f:
+        end = f.seek(0, io.SEEK_END)
+        try:
+            known = set(writer.digests)
+            new = [(r.sha256, p) for r, p in zip(records, photos) if r.sha256 not in known]
+            if new:
+                with trace.stage("pdf_build"):
+                    for digest, p in new:
+                        writer.add_jpeg_page(*p.pdf_page(policy), digest=digest)
+                        known.add(digest)
+                    writer.close()
+                with trace.stage("pdf_put"):
+                    item = storage_backend().put(target_id, name, f, "application/pdf")
+                trace.count("bytes_out", _payload_size(f))
+                trace.count("pdf_pages_appended", len(new))
+                meta_path.write_text(json.dumps({"eTag": item.get("eTag"), "size": item.get("size", f.seek(0, io.SEEK_END))}))
+        except Exception as e:
+            # Back to the last uploaded state, so the local copy still matches the drive.
+            f.truncate(end)
+            log.exception("No se pudo generar o subir el PDF del folio %s", folio)
+            trace.count("pdf_failures")
+            trace.record["pdf_error"] = f"{type(e).__name__}: {e}"
+            return None
+        finally:
+            for p in photos:
+                _absorb_timings(trace, p)
+    return name
+
+# ----------------------------------------------------
+# PHOTO STORE
+# ----------------------------------------------------
+# [photo_store] in secrets: dir, ttl_s (idle session lifetime), session_quota_mb,
+#   max_mb (whole store; past it gc evicts unheld photos oldest first, 0: no cap)
+PHOTO_GC_INTERVAL_S = 600
+
+def photo_store_config() -> dict:
+    cfg = st.secrets.get("photo_store", {})
+    return {
+        "dir": Path(cfg.get("dir") or Path(tempfile.gettempdir()) / "idphotos" / "photos"),
+        "ttl_s": float(cfg.get("ttl_s", 2 * 3600)),
+        "quota_bytes": int(float(cfg.get("session_quota_mb", 200)) * 1024 * 1024),
+        "max_bytes": int(float(cfg.get("max_mb", 0)) * 1024 * 1024),
+    }
+
+class PhotoStore:
+    # Photo files named by their sha256; sessions only keep handles (digest, mime, size).
+    def __init__(self, root: Path, ttl_s: float, quota_bytes: int, max_bytes: int = 0):
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.ttl_s = ttl_s
+        self.quota_bytes = quota_bytes
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.sessions: dict[str, dict] = {}  # session id -> {"seen": ts, "digests": {digest: size}}
+        self.next_gc = 0.0
+
+    def path(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest
+
+    def has(self, digest: str) -> bool:
+        return self.path(digest).exists()
+
+    def read(self, digest: str) -> memoryview:
+        return map_file(self.path(digest))
+
+    def put(self, session_id: str, f) -> tuple[str, int]:
+        # Streams f to disk while hashing it; raises ValueError past the session quota.
+        h, size = hashlib.sha256(), 0
+        buf = bytearray(HASH_BLOCK)
+        view = memoryview(buf)
+        tmp = tempfile.NamedTemporaryFile(dir=self.root, prefix=".in-", delete=False)
+        try:
+            with tmp:
+                f.seek(0)
+                while n := f.readinto(buf):
+                    h.update(view[:n])
+                    tmp.write(view[:n])
+                    size += n
+            digest = h.hexdigest()
+            with self.lock:
+                held = self._session(session_id)["digests"]
+                if digest not in held and sum(held.values()) + size > self.quota_bytes:
+                    raise ValueError("Se alcanzó el límite de fotos para esta sesión.")
+                held[digest] = size
+                dest = self.path(digest)
+                dest.parent.mkdir(exist_ok=True)
+                if dest.exists(): os.utime(dest)
+                else: os.replace(tmp.name, dest)
+        finally:
+            Path(tmp.name).unlink(missing_ok=True)
+        return digest, size
+
+    def _session(self, session_id: str) -> dict:
+        s = self.sessions.setdefault(session_id, {"seen": 0.0, "digests": {}})
+        s["seen"] = time.time()
+        return s
+
+    def touch(self, session_id: str, digests: list[str]) -> None:
+        # The photos this session still holds; anything else it put is released.
+        with self.lock:
+            s = self._session(session_id)
+            s["digests"] = {d: s["digests"].get(d, 0) for d in digests}
+
+    def gc(self) -> None:
+        # Forgets idle sessions, then deletes files no live session holds that are older than the
+        # TTL, and past max_bytes the least recently stored of the rest.
+        now = time.time()
+        with self.lock:
+            if now < self.next_gc: return
+            self.next_gc = now + PHOTO_GC_INTERVAL_S
+            for sid in [sid for sid, s in self.sessions.items() if now - s["seen"] > self.ttl_s]:
+                del self.sessions[sid]
+            live = {d for s in self.sessions.values() for d in s["digests"]}
+            total, unheld = 0, []
+            for path in self.root.glob("*/*"):
+                try:
+                    info = path.stat()
+                    if path.name not in live and now - info.st_mtime > self.ttl_s:
+                        path.unlink()
+                        continue
+                except FileNotFoundError:
+                    continue
+                total += info.st_size
+                if path.name not in live: unheld.append((info.st_mtime, info.st_size, path))
+            if not self.max_bytes: return
+            for _, size, path in sorted(unheld):
+                if total <= self.max_bytes: break
+                path.unlink(missing_ok=True)
+                total -= size
+
+@st.cache_resource
+def photo_store() -> PhotoStore:
+    cfg = photo_store_config()
+    return PhotoStore(cfg["dir"], cfg["ttl_s"], cfg["quota_bytes"], cfg["max_bytes"])
+
+# ----------------------------------------------------
+# BACKGROUND JOBS
+# ----------------------------------------------------
+# [jobs] in secrets: dir (job store location), workers, max_attempts,
+#   file_locks (also lock each folio with a file under dir, for several processes sharing it)
+JOB_POLL_S = 1.0
+JOB_IDLE_WAIT_S = 5.0
+JOB_RETRY_BACKOFF_S = 30.0
+JOB_KEEP_DAYS = 7
+
+def jobs_config() -> dict:
+    cfg = st.secrets.get("jobs", {})
+    return {
+        "dir": Path(cfg.get("dir") or Path(tempfile.gettempdir()) / "idphotos"),
+        "workers": max(1, int(cfg.get("workers", 2))),
+        "max_attempts": max(1, int(cfg.get("max_attempts", 3))),
+        "file_locks": bool(cfg.get("file_locks", False)) and fcntl is not None,
+    }
+
+def batch_id(base_folder: str, folio: str, digests: list[str]) -> str:
+    # Same folio + same photos -> same id, so resubmits collapse into one job.
+    h = hashlib.sha256("\n".join([base_folder, folio, *sorted(digests)]).encode()).hexdigest()
+    return f"{folio}-{h[:16]}"
+
+class JobStore:
+    # SQLite table of upload jobs plus one payload directory per job.
+    def __init__(self, root: Path):
+        self.root = root
+        self.jobs_dir = root / "jobs"
+        self.jobs_dir.mkdir(parents=True, exist_ok=True)
+        self.path = root / "jobs.sqlite3"
+        with self._db() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    folio TEXT NOT NULL,
+                    base_folder TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    done INTEGER NOT NULL DEFAULT 0,
+                    total INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    not_before REAL NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )"""
+            )
+
+    @contextmanager
+    def _db(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def job_dir(self, job_id: str) -> Path:
+        return self.jobs_dir / job_id
+
+    def get(self, job_id: str) -> dict | None:
+        with self._db() as db:
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def enqueue(self, base_folder: str, folio: str, photos: list[PhotoRecord]) -> str:
+        job_id = batch_id(base_folder, folio, [p.sha256 for p in photos])
+        existing = self.get(job_id)
+        if existing and existing["status"] != "failed":
+            return job_id
+        if not self.job_dir(job_id).exists():
+            self._write_payload(job_id, photos)
+        now = time.time()
+        with self._db() as db:
+            db.execute(
+                "INSERT INTO jobs (id, folio, base_folder, status, total, created_at, updated_at) VALUES (?, ?, ?, 'queued', ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET status = 'queued', attempts = 0, error = NULL, not_before = 0, updated_at = excluded.updated_at",
+                (job_id, folio, base_folder, len(photos), now, now),
+            )
+        return job_id
+
+    def _write_payload(self, job_id: str, photos: list[PhotoRecord]) -> None:
+        # Written to a scratch dir and renamed, so a crash never leaves half a payload.
+        tmp = Path(tempfile.mkdtemp(prefix=f".{job_id}-", dir=self.jobs_dir))
+        manifest = []
+        for i, p in enumerate(photos):
+            name = f"{i:03d}_{p.sha256[:16]}.bin"
+            link_or_copy(p.path, tmp / name)
+            manifest.append({"file": name, "mime": p.mime, "source": p.source, "sha256": p.sha256, "size": p.size, "mobile": p.mobile, "normalized": p.normalized})
+        (tmp / "manifest.json").write_text(json.dumps(manifest))
+        try:
+            tmp.rename(self.job_dir(job_id))
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)  # another session wrote the same payload first
+
+    def load_photos(self, job_id: str) -> list[PhotoRecord]:
+        d = self.job_dir(job_id)
+        return [
+            PhotoRecord(m["sha256"], m.get("size", 0), m["mime"], m["source"], d / m["file"], mobile=m["mobile"], normalized=m.get("normalized", False))
+            for m in json.loads((d / "manifest.json").read_text())
+        ]
+
+    def claim(self) -> dict | None:
+        with self._db() as db:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' AND not_before <= ? ORDER BY created_at LIMIT 1", (time.time(),)
+            ).fetchone()
+            if row:
+                db.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ? WHERE id = ?", (time.time(), row["id"]))
+            db.execute("COMMIT")
+        if not row: return None
+        job = dict(row)
+        job["attempts"] += 1
+        return job
+
+    def progress(self, job_id: str, done: int, total: int) -> None:
+        with self._db() as db:
+            db.execute("UPDATE jobs SET done = ?, total = ?, updated_at = ? WHERE id = ?", (done, total, time.time(), job_id))
+
+    def finish(self, job_id: str) -> None:
+        with self._db() as db:
+            db.execute("UPDATE jobs SET status = 'done', error = NULL, updated_at = ? WHERE id = ?", (time.time(), job_id))
+        shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+
+    def wait(self, job_id: str) -> None:
+        # Photos stored but not all pages: sessions see it as done, the payload stays for resume().
+        with self._db() as db:
+            db.execute("UPDATE jobs SET status = 'waiting', error = NULL, updated_at = ? WHERE id = ?", (time.time(), job_id))
+
+    def resume(self, folder_id: str) -> int:
+        # Waiting jobs of the folio folder base_folder/folio go back in the queue.
+        with self._db() as db:
+            return db.execute(
+                "UPDATE jobs SET status = 'queued', attempts = 0, not_before = 0, updated_at = ? WHERE status = 'waiting' AND base_folder || '/' || folio = ?",
+                (time.time(), folder_id),
+            ).rowcount
+
+    def fail(self, job_id: str, error: str, retry: bool) -> None:
+        status, not_before = ("queued", time.time() + JOB_RETRY_BACKOFF_S) if retry else ("failed", 0)
+        with self._db() as db:
+            db.execute(
+                "UPDATE jobs SET status = ?, error = ?, not_before = ?, updated_at = ? WHERE id = ?",
+                (status, error, not_before, time.time(), job_id),
+            )
+
+    def recover(self) -> None:
+        # Jobs left 'running' by a previous process go back in the queue, and 'waiting' ones in
+        # case their seed finished while nothing was listening; old rows are pruned.
+        cutoff = time.time() - JOB_KEEP_DAYS * 86400
+        with self._db() as db:
+            db.execute("UPDATE jobs SET status = 'queued', updated_at = ? WHERE status IN ('running', 'waiting')", (time.time(),))
+            old = [r["id"] for r in db.execute("SELECT id FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?", (cutoff,))]
+            db.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?", (cutoff,))
+        for job_id in old:
+            shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+
+class JobRunner:
+    # Process-wide worker threads draining the job store.
+    def __init__(self, store: JobStore, workers: int, max_attempts: int):
+        self.store = store
+        self.max_attempts = max_attempts
+        self.wake = threading.Event()
+        store.recover()
+        self.threads = [threading.Thread(target=self._loop, name=f"upload-job-{i}", daemon=True) for i in range(workers)]
+        for t in self.threads: t.start()
+
+    def submit(self, base_folder: str, folio: str, photos: list[PhotoRecord]) -> str:
+        job_id = self.store.enqueue(base_folder, folio, photos)
+        self.wake.set()
+        return job_id
+
+    def retry(self, job_id: str) -> None:
+        job = self.store.get(job_id)
+        if job and job["status"] == "failed":
+            self.submit(job["base_folder"], job["folio"], self.store.load_photos(job_id))
+
+    def resume(self, folder_id: str) -> None:
+        if self.store.resume(folder_id): self.wake.set()
+
+    def _loop(self) -> None:
+        while True:
+            try:
+                job = self.store.claim()
+            except sqlite3.Error:
+                log.exception("No se pudo leer la cola de cargas")
+                job = None
+            if job is None:
+                self.wake.wait(JOB_IDLE_WAIT_S)
+                self.wake.clear()
+                continue
+            try:
+                run_upload_job(self.store, job)
+                self.store.finish(job["id"])
+            except SeedPending as e:
+                self.store.wait(job["id"])
+                # The seed may have finished before the job was marked waiting.
+                if storage_backend().seeded(e.folder_id, e.name): self.resume(e.folder_id)
+            except Exception as e:
+                log.exception("Falló la carga %s (intento %d)", job["id"], job["attempts"])
+                self.store.fail(job["id"], str(e), retry=job["attempts"] < self.max_attempts)
+
+@st.cache_resource
+def job_runner() -> JobRunner:
+    cfg = jobs_config()
+    return JobRunner(JobStore(cfg["dir"]), cfg["workers"], cfg["max_attempts"])
+
+# ----------------------------------------------------
+# FOLIO LOCKS & BATCH MANIFESTS
+# ----------------------------------------------------
+# One job at a time per folio: folder creation, the hash listing and the PDF
+# would otherwise race between sessions, job workers or processes.
+class _FolioLocks:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.held: dict[str, list] = {}  # key -> [lock, users]
+
+@st.cache_resource
+def _folio_locks() -> _FolioLocks:
+    return _FolioLocks()
+
+@contextmanager
+def _file_lock(path: Path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+@contextmanager
+def folio_lock(base_folder: str, folio: str):
+    # Yields True when the lock spans processes, i.e. cached folder state may be stale.
+    key = f"{base_folder}/{folio}"
+    table = _folio_locks()
+    with table.lock:
+        entry = table.held.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    cfg = jobs_config()
+    lock_path = cfg["dir"] / "locks" / f"{hashlib.sha256(key.encode()).hexdigest()[:32]}.lock"
+    try:
+        with entry[0], (_file_lock(lock_path) if cfg["file_locks"] else nullcontext()):
+            yield cfg["file_locks"]
+    finally:
+        with table.lock:
+            entry[1] -= 1
+            if not entry[1]: table.held.pop(key, None)
+
+def batch_names(folio: str, job_id: str) -> tuple[str, str]:
+    # (manifest, PDF) names derived from the batch id, so a retried batch overwrites its own files.
+    tag = job_id.rsplit("-", 1)[-1]
+    return f"{folio}_lote_{tag}.json", f"{folio}_fotos_{tag}.pdf"
+
+def read_manifest(folder_id: str, name: str) -> dict | None:
+    body = storage_backend().get(folder_id, name)
+    if body is None: return None
+    try:
+        return json.loads(body)
+    except ValueError:
+        return None
+
+def write_manifest(folder_id: str, name: str, manifest: dict) -> None:
+    manifest["updated"] = datetime.now().isoformat(timespec="seconds")
+    body = json.dumps(manifest, ensure_ascii=False, indent=1).encode("utf-8")
+    storage_backend().put(folder_id, name, body, "application/json")
+
+def run_upload_job(store: JobStore, job: dict) -> None:
+    folio, folder = job["folio"], [job["base_folder"], job["folio"]]
+    records = store.load_photos(job["id"])
+    trace = UploadTrace(job["id"], folio, len(records))
+    manifest_name, pdf_name = batch_names(folio, job["id"])
+    try:
+        with folio_lock(job["base_folder"], folio) as shared:
+            with trace.stage("ensure_path"):
+                target_id = storage_backend().ensure_folder(folder)
+            with trace.stage("manifest"):
+                manifest = read_manifest(target_id, manifest_name)
+            if manifest and manifest.get("state") == "done":
+                # Finished earlier (e.g. by another process, or before a crash): nothing to resend.
+                trace.count("batch_replays")
+                store.progress(job["id"], len(records), len(records))
+                trace.finish("ok")
+                return
+            with trace.stage("existing_hashes"):
+                # Another process may have uploaded to this folio since our listing was cached.
+                exist_hashes = storage_backend().hashes(target_id, max_age_s=0 if shared else HASH_INDEX_TTL_S)
+            manifest = {
+                "batch": job["id"], "folio": folio, "base_folder": job["base_folder"], "state": "uploading",
+                "created": (manifest or {}).get("created") or datetime.now().isoformat(timespec="seconds"),
+                "photos": [
+                    {"sha256": r.sha256, "source": r.source, "size": r.size, "state": "existing" if is_known_hash(r.sha256, exist_hashes) else "pending"}
+                    for r in records
+                ],
+                "pdf": None,
+            }
+            with trace.stage("manifest"):
+                write_manifest(target_id, manifest_name, manifest)
+            incremental = pdf_policy()["incremental"]
+            photos = upload_batch(
+                target_id, folio, records, exist_hashes,
+                on_progress=lambda done, total: store.progress(job["id"], done, total),
+                trace=trace,
+                in_pdf=folio_pdf_digests(target_id, folio, trace) if incremental else frozenset(),
+            )
+            gate = quality_gate_policy()
+            for entry, photo in zip(manifest["photos"], photos):
+                if entry["state"] == "pending": entry["state"] = "uploaded"
+                if photo is not None and photo.known_quality:
+                    entry["quality"] = photo.known_quality
+                    entry["issues"] = quality_issues(photo.known_quality, gate)
+                    if entry["issues"]: trace.count("quality_flagged")
+            if incremental:
+                try:
+                    manifest["pdf"] = upload_folio_pdf(target_id, folio, records, photos, trace, pdf_name)
+                except SeedPending:
+                    # Photos are stored; the pages go in when the job runs again after the seed.
+                    manifest["state"] = "pdf_pending"
+                    with trace.stage("manifest"):
+                        write_manifest(target_id, manifest_name, manifest)
+                    trace.finish("waiting")
+                    raise
+            elif upload_pdf(target_id, folio, photos, trace=trace, name=pdf_name):
+                manifest["pdf"] = pdf_name
+            manifest["state"] = "done"
+            with trace.stage("manifest"):
+                write_manifest(target_id, manifest_name, manifest)
+    except SeedPending:
+        raise
+    except Exception as e:
+        # The folio folder may have been moved or deleted; resolve it again next time.
+        storage_backend().forget_folder(folder)
+        trace.finish("error", f"{type(e).__name__}: {e}")
+        raise
+    trace.finish("ok")
+
+# ----------------------------------------------------
+# CLIENT RESIZE
+# ----------------------------------------------------
+# [client_resize] in secrets: enabled, max_dim, quality (0-1).
+# When enabled the gallery picker shrinks photos in the browser before they are sent.
+def client_resize_config() -> dict:
+    cfg = st.secrets.get("client_resize", {})
+    return {
+        "enabled": bool(cfg.get("enabled", False)),
+        "max_dim": int(cfg.get("max_dim", 2048)),
+        "quality": float(cfg.get("quality", 0.85)),
+    }
+
+client_photos = components.declare_component("client_photos", path=str(Path(__file__).parent / "client_photos"))
+
+class ClientUpload(io.BytesIO):
+    # One photo from the client_photos component, shaped like Streamlit's UploadedFile.
+    def __init__(self, batch: str, index: int, photo: dict):
+        super().__init__(base64.b64decode(photo["data"], validate=True))
+        self.file_id = f"client-{batch}-{index}"
+        self.name = photo.get("name")
+        self.type = photo.get("type")
+        self.normalized = bool(photo.get("normalized"))
+
+def client_uploads(picked: dict | None, known: dict[str, PhotoRecord] | None = None) -> list[ClientUpload | PhotoRecord]:
+    # Photos already in the gallery come back as their PhotoRecord, without decoding them again.
+    if not picked: return []
+    known = known or {}
+    out = []
+    for i, photo in enumerate(picked.get("photos") or []):
+        record = known.get(f"client-{picked.get('batch')}-{i}")
+        if record:
+            out.append(record)
+            continue
+        try:
+            out.append(ClientUpload(picked["batch"], i, photo))
+        except (KeyError, ValueError):
+            log.warning("Foto del navegador inválida: %s", photo.get("name"))
+            continue
+        if photo.get("normalized"):
+            log.debug(
+                "%s reducida en el navegador: %sx%s (%s bytes) -> %sx%s (%s bytes)", photo.get("name"),
+                photo.get("original_width"), photo.get("original_height"), photo.get("original_bytes"),
+                photo.get("width"), photo.get("height"), out[-1].getbuffer().nbytes,
+            )
+    return out
 
 # ----------------------------------------------------
 # STATE & FLOW
@@ -501,12 +2452,30 @@ if "gallery_photos" not in st.session_state: st.session_state.gallery_photos = [
 if "uploaded_ok" not in st.session_state: st.session_state.uploaded_ok = False
 if "uploaded_folio" not in st.session_state: st.session_state.uploaded_folio = ""
 if "final_screen" not in st.session_state: st.session_state.final_screen = False
+if "upload_job" not in st.session_state: st.session_state.upload_job = st.query_params.get("job", "")
+if "photo_session" not in st.session_state: st.session_state.photo_session = uuid.uuid4().hex
+if "client_photos_round" not in st.session_state: st.session_state.client_photos_round = 0
+
+def sync_photo_store():
+    # Drops handles whose file is gone and tells the store what this session still holds.
+    store = photo_store()
+    for key in ("gallery_photos", "camera_photos"):
+        st.session_state[key] = [p for p in st.session_state[key] if store.has(p.sha256)]
+    held = [p.sha256 for key in ("gallery_photos", "camera_photos") for p in st.session_state[key]]
+    store.touch(st.session_state.photo_session, held)
+    store.gc()
+
+sync_photo_store()
+# Write-behind picks up the copies a previous process left queued.
+storage_backend()
 
 def reset_flow():
     st.session_state.camera_photos = []
     st.session_state.gallery_photos = []
     st.session_state.uploaded_ok = False
     st.session_state.final_screen = False
+    st.session_state.upload_job = ""
+    st.query_params.pop("job", None)
 
 # ----------------------------------------------------
 # SCREENS
@@ -542,6 +2511,36 @@ if st.session_state.uploaded_ok:
         st.rerun()
     st.stop()
 
+if st.session_state.upload_job:
+    render_header()
+    job = job_runner().store.get(st.session_state.upload_job)
+    if job is None:
+        st.session_state.upload_job = ""
+        st.query_params.pop("job", None)
+        st.rerun()
+    if job["status"] in ("done", "waiting"):
+        st.session_state.upload_job = ""
+        st.query_params.pop("job", None)
+        st.session_state.uploaded_ok = True
+        st.session_state.uploaded_folio = job["folio"]
+        st.rerun()
+    if job["status"] == "failed":
+        st.error(f"Error: {job['error']}")
+        if st.button("🔁 Reintentar", type="primary"):
+            job_runner().retry(job["id"])
+            st.rerun()
+        if st.button("⬅️ Volver"):
+            st.session_state.upload_job = ""
+            st.query_params.pop("job", None)
+            st.rerun()
+        st.stop()
+    st.markdown(f"⏳ **Subiendo...** Folio **{job['folio']}**")
+    st.progress(job["done"] / job["total"] if job["total"] else 0)
+    if job["error"]:
+        st.caption("Reintentando la carga...")
+    time.sleep(JOB_POLL_S)
+    st.rerun()
+
 # MAIN
 render_header()
 scroll_to_top()
@@ -567,26 +2566,59 @@ st.success(f"Folio válido: **{folio}**")
 base_folder = st.secrets["azure_app"].get("onedrive_base_folder", "fotos_cotizaciones")
 
 # ✅ ADDED: INE PHOTO INSTRUCTIONS IMAGE (just above Galería)
-instrucciones_path = Path(__file__).parent / "ineCorrecto.jpeg"
-if not instrucciones_path.exists():
-    instrucciones_path = Path("/mnt/data/ineCorrecto.jpeg")
+instrucciones = static_image((str(Path(__file__).parent / "ineCorrecto.jpeg"), "/mnt/data/ineCorrecto.jpeg"), 1024)
 
-if instrucciones_path.exists():
-    st.image(str(instrucciones_path), use_container_width=True)
+if instrucciones:
+    st.image(instrucciones, use_container_width=True)
 else:
     st.warning("No se encontró la imagen de instrucciones (ineCorrecto.jpeg).")
 
 st.subheader("📁 Galería")
-uploaded_files = st.file_uploader("Sube fotos", type=["jpg","png","heic"], accept_multiple_files=True)
+client_cfg = client_resize_config()
+if client_cfg["enabled"]:
+    # The component keeps returning its last value (every photo, base64) until its key changes.
+    picker_key = f"client_photos_{st.session_state.client_photos_round}"
+    picked = client_photos(max_dim=client_cfg["max_dim"], quality=client_cfg["quality"], label="Sube fotos", key=picker_key, default=None)
+    uploaded_files = client_uploads(picked, {p.file_id: p for p in st.session_state.gallery_photos if p.file_id})
+else:
+    uploaded_files = st.file_uploader("Sube fotos", type=["jpg","png","heic"], accept_multiple_files=True)
 if uploaded_files:
-    st.session_state.gallery_photos = [{"bytes": f.getvalue(), "mime": f.type, "name": f.name} for f in uploaded_files]
+    # Reuse the previous run's records (and digests) for files that did not change.
+    known = {p.file_id: p for p in st.session_state.gallery_photos if p.file_id}
+    gallery = []
+    for f in uploaded_files:
+        fid = getattr(f, "file_id", None)
+        if fid and fid in known:
+            gallery.append(known[fid])
+            continue
+        try:
+            digest, size = photo_store().put(st.session_state.photo_session, f)
+        except ValueError as e:
+            st.error(str(e))
+            break
+        gallery.append(PhotoRecord(
+            digest, size, f.type, "upload", photo_store().path(digest),
+            name=f.name, file_id=fid, normalized=getattr(f, "normalized", False),
+        ))
+    st.session_state.gallery_photos = gallery
+    if client_cfg["enabled"]:
+        # Consumed: the photos are in the PhotoStore, so drop the payload and start a new picker.
+        st.session_state.pop(picker_key, None)
+        st.session_state.client_photos_round += 1
 
 # --- 2. AUTO-EXPAND GALLERY PREVIEW ---
+gate = quality_gate_policy()
+flagged: list[str] = []  # "where: issues" for the photos the quality gate flags
 if st.session_state.gallery_photos:
     with st.expander("Ver vista previa de fotos seleccionadas", expanded=True):
         cols = st.columns(3)
         for idx, item in enumerate(st.session_state.gallery_photos):
-            cols[idx % 3].image(item["bytes"], caption=f"Foto #{idx+1}", use_container_width=True)
+            data = photo_store().read(item.sha256)
+            thumb = preview_thumbnail(data, "upload", item.sha256)
+            issues = photo_issues(item.sha256, gate)
+            if issues: flagged.append(f"Galería #{idx+1}: {', '.join(issues)}")
+            caption = f"Foto #{idx+1}" + (f" ⚠️ {', '.join(issues)}" if issues else "")
+            cols[idx % 3].image(thumb or bytes(data), caption=caption, use_container_width=True)
 
 st.markdown("---")
 st.subheader("📸 Cámara")
@@ -607,9 +2639,15 @@ camera_photo = st.camera_input("Toma foto", key="camera_input")
 c1, c2, c3 = st.columns(3)
 if c1.button("➕ Agregar foto"):
     if camera_photo:
-        st.session_state.camera_photos.append({"bytes": camera_photo.getvalue(), "mime": camera_photo.type})
-        st.success("Foto agregada")
-        st.rerun()
+        try:
+            digest, size = photo_store().put(st.session_state.photo_session, camera_photo)
+            st.session_state.camera_photos.append(
+                PhotoRecord(digest, size, camera_photo.type, "camera", photo_store().path(digest), mobile=IS_MOBILE)
+            )
+            st.success("Foto agregada")
+            st.rerun()
+        except ValueError as e:
+            st.error(str(e))
 if c2.button("🗑️ Borrar fotos"):
     st.session_state.camera_photos = []
     st.rerun()
@@ -620,53 +2658,30 @@ if st.session_state.camera_photos:
     with st.expander("Ver fotos tomadas", expanded=True):
         cols = st.columns(3)
         for i, p in enumerate(st.session_state.camera_photos):
-            img = normalize_for_preview(p["bytes"], "camera")
-            if img: cols[i%3].image(img, use_container_width=True)
+            data = photo_store().read(p.sha256)
+            thumb = preview_thumbnail(data, "camera", p.sha256)
+            issues = photo_issues(p.sha256, gate)
+            if issues: flagged.append(f"Cámara #{i+1}: {', '.join(issues)}")
+            if thumb: cols[i%3].image(thumb, caption=f"⚠️ {', '.join(issues)}" if issues else None, use_container_width=True)
 
 st.markdown("---")
-if st.button("💾 Subir fotos", type="primary"):
+blocked = bool(flagged) and gate["mode"] == "block"
+if flagged:
+    msg = "Revisa estas fotos antes de subirlas:\n\n" + "\n".join(f"- {f}" for f in flagged)
+    if blocked:
+        st.error(msg + "\n\nVuelve a tomarlas o quítalas para poder continuar.")
+    else:
+        st.warning(msg)
+if st.button("💾 Subir fotos", type="primary", disabled=blocked):
     if not st.session_state.gallery_photos and not st.session_state.camera_photos:
         st.error("No hay fotos.")
         st.stop()
     
-    # PROGRESS LOGIC
-    status_text = st.empty()
-    bar = st.progress(0)
-    status_text.markdown("⏳ **Subiendo...**")
-    
     try:
-        target_id = ensure_path([base_folder, folio])
-        exist_hashes = list_existing_hashes(target_id)
-        
-        items = st.session_state.gallery_photos + st.session_state.camera_photos
-        pdf_imgs = []
-        
-        for i, item in enumerate(items):
-            src_type = "camera" if item in st.session_state.camera_photos else "upload"
-            sb, sm, ss = prepare_for_storage(item["bytes"], item.get("mime"), src_type)
-            pdf_imgs.append(sb)
-            
-            h = sha256_bytes(item["bytes"])[:12]
-            if h not in exist_hashes:
-                fname = f"{folio}_{src_type}_{datetime.now().strftime('%H%M%S')}__{h}{ss}"
-                upload_small_file_to_folder(target_id, fname, sb, sm)
-            
-            # Update bar
-            bar.progress((i+1)/len(items))
-            
-        # PDF
-        try:
-            pdf_b = build_pdf_from_images_high_quality(pdf_imgs)
-            pdf_n = f"{folio}_fotos_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
-            upload_small_file_to_folder(target_id, pdf_n, pdf_b, "application/pdf")
-        except Exception: 
-            pass
-        
-        bar.progress(100)
-        status_text.markdown("✅ **Finalizado**")
-        
-        st.session_state.uploaded_ok = True
-        st.session_state.uploaded_folio = folio
+        photos = unique_photos(st.session_state.gallery_photos + st.session_state.camera_photos)
+        job_id = job_runner().submit(base_folder, folio, photos)
+        st.session_state.upload_job = job_id
+        st.query_params["job"] = job_id
         st.rerun()
     except Exception as e:
         st.error(f"Error: {e}")
@@ -0,0 +1,541 @@
+# Image work shared by the Streamlit script and the image worker processes.
+# Worker processes import this module on its own, so nothing here may use streamlit.
+# numpy, reportlab and pillow_heif load on first use: most visitors never get that far.
+from __future__ import annotations
+
+import io
+import importlib
+import shutil
+import subprocess
+import time
+import threading
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from PIL import Image, ImageOps
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# Optional HEIC/HEIF support, registered the first time an ISO-BMFF ("ftyp") file shows up
+_heif_ok: bool | None = None
+
+def heif_ok() -> bool:
+    global _heif_ok
+    if _heif_ok is None:
+        try:
+            import pillow_heif  # type: ignore
+            pillow_heif.register_heif_opener()
+            _heif_ok = True
+        except Exception:
+            _heif_ok = False
+    return _heif_ok
+
+def open_image(data) -> Image.Image:
+    if bytes(data[4:8]) == b"ftyp": heif_ok()
+    return Image.open(io.BytesIO(data))
+
+# ----------------------------------------------------
+# HELPERS
+# ----------------------------------------------------
+def guess_suffix(mime: str | None, fallback_name: str | None = None) -> str:
+    if fallback_name:
+        s = Path(fallback_name).suffix
+        if s: return s.lower()
+    if not mime: return ".jpg"
+    m = mime.lower()
+    if "png" in m: return ".png"
+    if "heic" in m: return ".heic"
+    return ".jpg"
+
+def open_reduced(data, max_side: int) -> Image.Image:
+    # Decoded and EXIF-upright with the longer side still at least max_side, at the
+    # smallest scale the format can decode directly: JPEG DCT scaling (1/2, 1/4, 1/8)
+    # or an embedded HEIF thumbnail. Other formats decode in full.
+    img = open_image(data)
+    w, h = img.size
+    if max(w, h) > max_side:
+        scale = max_side / max(w, h)
+        img.draft(None, (max(1, int(w * scale)), max(1, int(h * scale))))
+    img = ImageOps.exif_transpose(img)
+    img.load()
+    return img
+
+def _open_img_safe(b: bytes, max_side: int | None = None) -> Image.Image:
+    if max_side: return open_reduced(b, max_side)
+    img = open_image(b)
+    img = ImageOps.exif_transpose(img)
+    return img
+
+def _to_png_bytes(img: Image.Image) -> bytes:
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    buf = io.BytesIO()
+    img.save(buf, format="PNG", optimize=False)
+    buf.seek(0)
+    return buf.read()
+
+ORIENTATION_MAX_SIDE = 480
+# Projection profiles only show the text axis: an upside-down capture scores exactly
+# like an upright one, and edge-mass position is no better (MRZ lines sit at the bottom
+# of an INE back). So only the two angles the old 0/90 heuristic used are ever chosen.
+ORIENTATION_ANGLES = (0, 270)
+_TRANSPOSE_FOR = {270: Image.Transpose.ROTATE_270}
+
+def _orientation_buffer(img: Image.Image) -> np.ndarray:
+    # One small grayscale buffer; reduce() box-filters before the colour conversion.
+    import numpy as np
+    factor = max(1, max(img.size) // ORIENTATION_MAX_SIDE)
+    small = img.reduce(factor) if factor > 1 else img
+    g = small.convert("L")
+    if max(g.size) > ORIENTATION_MAX_SIDE:
+        g = g.copy()
+        g.thumbnail((ORIENTATION_MAX_SIDE, ORIENTATION_MAX_SIDE), Image.BILINEAR)
+    return np.asarray(g, dtype=np.float32) / 255.0
+
+def text_axis_score(arr: np.ndarray) -> float:
+    # In [-1, 1]: positive when text lines run across (row means vary more than column
+    # means), negative when they run down the image.
+    row_var = arr.mean(axis=1).var()
+    col_var = arr.mean(axis=0).var()
+    return float((row_var - col_var) / (row_var + col_var + 1e-9))
+
+def detect_orientation(img: Image.Image) -> tuple[int, float]:
+    # (PIL rotate() angle counter-clockwise, confidence in [0, 1]). The confidence is
+    # only about the text axis; which way is up is never guessed (see ORIENTATION_ANGLES).
+    axis = text_axis_score(_orientation_buffer(img))
+    return ORIENTATION_ANGLES[0 if axis >= 0 else 1], min(1.0, abs(axis))
+
+def rotate_upright(img: Image.Image, rotation: int) -> Image.Image:
+    return img.transpose(_TRANSPOSE_FOR[rotation]) if rotation in _TRANSPOSE_FOR else img
+
+def camera_rotation(img: Image.Image) -> int:
+    # PIL rotate() angle (counter-clockwise) that puts a mobile capture upright.
+    try:
+        return detect_orientation(img)[0]
+    except Exception:
+        return 0
+
+def normalize_camera_orientation_mobile(img: Image.Image) -> Image.Image:
+    return rotate_upright(img, camera_rotation(img))
+
+# ----------------------------------------------------
+# CAPTURE QUALITY
+# ----------------------------------------------------
+QUALITY_MAX_SIDE = ORIENTATION_MAX_SIDE
+GLARE_LEVEL = 250 / 255
+SHADOW_LEVEL = 8 / 255
+
+def capture_quality(img: Image.Image) -> dict[str, float]:
+    # Sharpness (variance of the 4-neighbour Laplacian, 0-255 scale), glare (share of
+    # near-white pixels) and exposure (mean luminance, share of crushed shadows), all
+    # from the same small grayscale buffer the orientation check uses.
+    g = _orientation_buffer(img)
+    lap = g[:-2, 1:-1] + g[2:, 1:-1] + g[1:-1, :-2] + g[1:-1, 2:] - 4 * g[1:-1, 1:-1]
+    return {
+        "sharpness": round(float(lap.var()) * 255 * 255, 1),
+        "glare": round(float((g >= GLARE_LEVEL).mean()), 4),
+        "brightness": round(float(g.mean()), 3),
+        "shadows": round(float((g <= SHADOW_LEVEL).mean()), 4),
+    }
+
+# ----------------------------------------------------
+# STORAGE ENCODING
+# ----------------------------------------------------
+# [storage_encoding] in secrets:
+#   mode = "png" | "original" | "jpeg" | "webp" | "budget"
+#   quality, max_dim, target_bytes, format ("jpeg"/"webp", used by "budget")
+STORAGE_ENCODINGS = {
+    "png": ("PNG", "image/png", ".png"),
+    "jpeg": ("JPEG", "image/jpeg", ".jpg"),
+    "webp": ("WEBP", "image/webp", ".webp"),
+}
+_FORMAT_SUFFIX = {"JPEG": ".jpg", "MPO": ".jpg", "PNG": ".png", "HEIF": ".heic", "WEBP": ".webp"}
+BUDGET_QUALITY_RANGE = (40, 95)
+
+def _cap_dimensions(img: Image.Image, max_dim: int) -> Image.Image:
+    if max_dim and max(img.size) > max_dim:
+        img = img.copy()
+        img.thumbnail((max_dim, max_dim), Image.LANCZOS)
+    return img
+
+def _encode_lossy(img: Image.Image, fmt: str, quality: int) -> bytes:
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    buf = io.BytesIO()
+    if fmt == "webp": img.save(buf, format="WEBP", quality=quality, method=4)
+    else: img.save(buf, format="JPEG", quality=quality, optimize=True)
+    return buf.getvalue()
+
+def _encode_for_budget(img: Image.Image, fmt: str, target_bytes: int) -> bytes:
+    # Highest quality that fits; shrink the image until even the lowest does.
+    while True:
+        lo, hi = BUDGET_QUALITY_RANGE
+        best = None
+        while lo <= hi:
+            q = (lo + hi) // 2
+            data = _encode_lossy(img, fmt, q)
+            if len(data) <= target_bytes:
+                best, lo = data, q + 1
+            else:
+                hi = q - 1
+        if best is not None: return best
+        if max(img.size) == 1: return data  # a budget below the format's own headers
+        # The lowest quality's size goes roughly with the pixel count.
+        scale = min(0.75, (target_bytes / len(data)) ** 0.5)
+        img = img.resize((max(1, int(img.width * scale)), max(1, int(img.height * scale))), Image.LANCZOS)
+
+def _exif_orientation(img: Image.Image) -> int:
+    try:
+        return int(img.getexif().get(0x0112, 1))
+    except Exception:
+        return 1
+
+def _jpegtran_rotate(b: bytes, clockwise: int) -> bytes | None:
+    exe = shutil.which("jpegtran")
+    if not exe: return None
+    try:
+        r = subprocess.run([exe, "-copy", "all", "-rotate", str(clockwise), "-trim"], input=b, capture_output=True, timeout=60, check=True)
+        return r.stdout or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+# ----------------------------------------------------
+# PROCESSED IMAGE
+# ----------------------------------------------------
+class ProcessedImage:
+    # One photo: decoded and oriented at most once, each encoding produced at most once.
+    def __init__(self, data: bytes, mime: str | None, source: str, mobile: bool = False, normalized: bool = False):
+        self.data = data
+        self.mime = mime
+        self.source = source
+        # Whether the capture came from a phone; only mobile camera shots get auto-rotated.
+        self.mobile = mobile
+        # Claimed by the browser component: already an upright, downscaled JPEG.
+        self.normalized = normalized
+        self.counts: dict[str, int] = {}
+        # Seconds per stage, exclusive of nested stages (an encode that decodes counts once each).
+        self.timings: dict[str, float] = {}
+        self._nested = 0.0
+        self._lock = threading.RLock()
+        self._raw: Image.Image | None = None
+        self._image: Image.Image | None = None
+        self._small: Image.Image | None = None  # reduced decode for analysis and previews
+        self._rotation: int | None = None
+        self.orientation_confidence: float | None = None
+        self._quality: dict[str, float] | None = None
+        self._encodings: dict[tuple, tuple[bytes, str | None, str]] = {}
+
+    def _count(self, what: str) -> None:
+        self.counts[what] = self.counts.get(what, 0) + 1
+
+    @contextmanager
+    def _timed(self, stage: str):
+        t0, outer = time.perf_counter(), self._nested
+        self._nested = 0.0
+        try:
+            yield
+        finally:
+            dt = time.perf_counter() - t0
+            self.timings[stage] = self.timings.get(stage, 0.0) + dt - self._nested
+            self._nested = outer + dt
+
+    @property
+    def raw(self) -> Image.Image:
+        # Header only; pixels are not decoded until .image.
+        with self._lock:
+            if self._raw is None:
+                self._raw = open_image(self.data)
+            return self._raw
+
+    @property
+    def format(self) -> str:
+        return (self.raw.format or "").upper()
+
+    def _upright(self) -> Image.Image:
+        with self._timed("decode"):
+            img = ImageOps.exif_transpose(self.raw)
+            img.load()
+        self._count("decode")
+        return img
+
+    def _reduced(self, max_side: int) -> Image.Image:
+        # EXIF-upright but not auto-rotated; a full decode only for formats that cannot scale.
+        if self._small is None or max(self._small.size) < min(max_side, max(self.raw.size)):
+            with self._timed("decode_reduced"):
+                self._small = open_reduced(self.data, max_side)
+            self._count("decode_reduced")
+        return self._small
+
+    @property
+    def rotation(self) -> int:
+        with self._lock:
+            if self._rotation is None:
+                if self.source == "camera" and self.mobile:
+                    try:
+                        with self._timed("orientation"):
+                            small = self._reduced(ORIENTATION_MAX_SIDE)
+                            self._rotation, self.orientation_confidence = detect_orientation(small)
+                    except Exception:
+                        self._rotation = 0
+                else:
+                    self._rotation = 0
+            return self._rotation
+
+    @property
+    def image(self) -> Image.Image:
+        with self._lock:
+            rotation = self.rotation
+            if self._image is None:
+                self._image = self._upright()
+                if rotation:
+                    self._image = rotate_upright(self._image, rotation)
+            return self._image
+
+    def quality(self) -> dict[str, float]:
+        # Measured on the reduced decode, so previews and uploads agree on the numbers.
+        with self._lock:
+            if self._quality is None:
+                with self._timed("quality"):
+                    self._quality = capture_quality(self._reduced(QUALITY_MAX_SIDE))
+            return self._quality
+
+    @property
+    def known_quality(self) -> dict[str, float] | None:
+        return self._quality
+
+    def preview(self, max_side: int) -> Image.Image:
+        # Upright copy no larger than max_side, without a full decode when the format allows it.
+        with self._lock:
+            rotation = self.rotation
+            if self._image is not None:
+                img = self._image.copy()
+            else:
+                img = rotate_upright(self._reduced(max_side), rotation)
+                if img is self._small: img = img.copy()
+        img.thumbnail((max_side, max_side), Image.BILINEAR)
+        return img
+
+    def encoded(self, key: tuple, encode) -> tuple:
+        with self._lock:
+            if key not in self._encodings:
+                with self._timed(f"encode_{key[0]}"):
+                    self._encodings[key] = encode(self)
+                self._count("encode")
+            return self._encodings[key]
+
+    def storage(self, policy: dict) -> tuple[bytes, str | None, str]:
+        return self.encoded(("storage",) + tuple(sorted(policy.items())), lambda p: _encode_for_storage(p, policy))
+
+    def cached_storage(self) -> bytes | None:
+        # Stored bytes if some storage encoding already ran; never encodes.
+        with self._lock:
+            for key, value in self._encodings.items():
+                if key[0] == "storage": return value[0]
+            return None
+
+    def pdf_page(self, policy: dict) -> tuple[bytes, tuple[int, int], bool, tuple[int, int]]:
+        return self.encoded(("pdf", policy["dpi"], policy["quality"]), lambda p: _encode_pdf_page(p, policy))
+
+    def export(self) -> dict:
+        # What another process needs to skip the work already done here.
+        with self._lock:
+            return {
+                "encodings": dict(self._encodings),
+                "rotation": self._rotation,
+                "orientation_confidence": self.orientation_confidence,
+                "quality": self._quality,
+                "counts": dict(self.counts),
+                "timings": dict(self.timings),
+            }
+
+    def adopt(self, state: dict) -> None:
+        with self._lock:
+            self._encodings.update(state["encodings"])
+            if self._rotation is None and state["rotation"] is not None:
+                self._rotation = state["rotation"]
+                self.orientation_confidence = state["orientation_confidence"]
+            if self._quality is None: self._quality = state.get("quality")
+            for what, n in state["counts"].items():
+                self.counts[what] = self.counts.get(what, 0) + n
+            for stage, dt in state["timings"].items():
+                self.timings[stage] = self.timings.get(stage, 0.0) + dt
+
+    def take_timings(self) -> dict[str, float]:
+        # Timings gathered since the last call, so each stage is reported once.
+        with self._lock:
+            timings, self.timings = self.timings, {}
+            return timings
+
+    def release(self) -> None:
+        with self._lock:
+            self._image = None
+            self._small = None
+            self._raw = None
+
+    def stats(self) -> dict:
+        return {
+            "decodes": self.counts.get("decode", 0),
+            "reduced_decodes": self.counts.get("decode_reduced", 0),
+            "encodes": self.counts.get("encode", 0),
+            "rotation": self._rotation,
+            "orientation_confidence": self.orientation_confidence,
+        }
+
+def _stores_as_is(p: ProcessedImage, policy: dict) -> bool:
+    # A client-normalized JPEG that already meets the policy; checked from the header only.
+    if not p.normalized or p.format != "JPEG" or p.rotation or _exif_orientation(p.raw) != 1: return False
+    if policy["max_dim"] and max(p.raw.size) > policy["max_dim"]: return False
+    mode = policy["mode"]
+    if mode == "budget": return policy["format"] != "webp" and len(p.data) <= policy["target_bytes"]
+    return mode in ("jpeg", "original")
+
+def _encode_for_storage(p: ProcessedImage, policy: dict) -> tuple[bytes, str | None, str]:
+    mode = policy["mode"]
+    if _stores_as_is(p, policy):
+        return p.data, "image/jpeg", ".jpg"
+    if mode == "original":
+        # EXIF orientation is left for viewers to apply; only a pixel rotation forces work.
+        fmt = p.format
+        if not p.rotation:
+            return p.data, Image.MIME.get(fmt, p.mime), _FORMAT_SUFFIX.get(fmt, guess_suffix(p.mime))
+        if fmt in ("JPEG", "MPO") and _exif_orientation(p.raw) == 1:
+            rotated = _jpegtran_rotate(p.data, (360 - p.rotation) % 360)
+            if rotated: return rotated, "image/jpeg", ".jpg"
+        mode = "jpeg"
+    if mode not in ("jpeg", "webp", "budget"):
+        return _to_png_bytes(p.image), "image/png", ".png"
+    fmt_key = policy["format"] if mode == "budget" else mode
+    if fmt_key not in ("jpeg", "webp"): fmt_key = "jpeg"
+    img = _cap_dimensions(p.image, policy["max_dim"])
+    if mode == "budget": data = _encode_for_budget(img, fmt_key, policy["target_bytes"])
+    else: data = _encode_lossy(img, fmt_key, policy["quality"])
+    _, out_mime, out_suffix = STORAGE_ENCODINGS[fmt_key]
+    return data, out_mime, out_suffix
+
+# ----------------------------------------------------
+# PDF PAGES
+# ----------------------------------------------------
+PDF_MARGIN_MM = 10
+
+def page_layout(w_px: int, h_px: int) -> tuple[float, float, float, float, float, float]:
+    from reportlab.lib.pagesizes import letter, landscape, portrait
+    from reportlab.lib.units import mm
+    margin = PDF_MARGIN_MM * mm
+    if w_px >= h_px: page_w, page_h = landscape(letter)
+    else: page_w, page_h = portrait(letter)
+    max_w = page_w - 2 * margin
+    max_h = page_h - 2 * margin
+    scale = min(max_w / w_px, max_h / h_px, 1.0)
+    draw_w = w_px * scale
+    draw_h = h_px * scale
+    x = (page_w - draw_w) / 2
+    y = (page_h - draw_h) / 2
+    return page_w, page_h, x, y, draw_w, draw_h
+
+def _embeddable_jpeg(data: bytes, size: tuple[int, int], max_size: tuple[int, int]) -> bool:
+    # True when the bytes can go into the PDF as a DCT stream exactly as they are.
+    try:
+        im = open_image(data)
+        return (
+            im.format == "JPEG" and im.mode in ("RGB", "L") and im.size == size
+            and size[0] <= max_size[0] and size[1] <= max_size[1] and _exif_orientation(im) == 1
+        )
+    except Exception:
+        return False
+
+def _encode_pdf_page(p: ProcessedImage, policy: dict) -> tuple[bytes, tuple[int, int], bool, tuple[int, int]]:
+    # (jpeg, jpeg pixel size, grayscale, upright size the page layout is based on)
+    upright = p.image.size
+    *_, draw_w, draw_h = page_layout(*upright)
+    target = (max(1, round(draw_w / 72 * policy["dpi"])), max(1, round(draw_h / 72 * policy["dpi"])))
+    # The original bytes are in capture orientation; a square capture keeps its size when turned, so check it.
+    for data in (None if p.rotation else p.data, p.cached_storage()):
+        if data and _embeddable_jpeg(data, upright, target):
+            return data, upright, open_image(data).mode == "L", upright
+    img = p.image if p.image.mode in ("RGB", "L") else p.image.convert("RGB")
+    if upright[0] > target[0] or upright[1] > target[1]:
+        img = img.copy()
+        img.thumbnail(target, Image.LANCZOS, reducing_gap=3.0)
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=policy["quality"], optimize=True)
+    return buf.getvalue(), img.size, img.mode == "L", upright
+
+# ----------------------------------------------------
+# WORKER PROCESSES
+# ----------------------------------------------------
+def init_worker(max_pixels: int, max_memory_mb: int) -> None:
+    # Workers pay for the heavy imports at start-up instead of on their first photo.
+    for name in ("numpy", "reportlab.lib.pagesizes"):
+        importlib.import_module(name)
+    heif_ok()
+    if max_pixels: Image.MAX_IMAGE_PIXELS = max_pixels
+    if max_memory_mb:
+        import resource
+        limit = max_memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+def payload_bytes(payload, unlink: bool = False) -> bytes:
+    # Either the bytes themselves or (shared memory name, size) filled in by the other side.
+    if not isinstance(payload, tuple): return payload
+    name, size = payload
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return bytes(shm.buf[:size])
+    finally:
+        shm.close()
+        if unlink: shm.unlink()
+
+def _shared_payload(data: bytes):
+    shm = shared_memory.SharedMemory(create=True, size=len(data))
+    shm.buf[:len(data)] = data
+    shm.close()
+    return shm.name, len(data)
+
+def unshare_encodings(state: dict) -> dict:
+    # Copies the encodings encode_photo left in shared memory and frees the segments.
+    encodings = state["encodings"]
+    for key, value in encodings.items():
+        if isinstance(value[0], tuple):
+            encodings[key] = (payload_bytes(value[0], unlink=True),) + tuple(value[1:])
+    return state
+
+def encode_photo(payload, mime: str | None, source: str, mobile: bool, normalized: bool, storage_policy: dict | None, pdf_policy: dict, shm_min_bytes: int = 0) -> dict:
+    # Storage (unless storage_policy is None) and PDF page encodings, for ProcessedImage.adopt()
+    # after unshare_encodings(): encodings of shm_min_bytes or more come back through shared
+    # memory instead of being pickled through the result pipe.
+    p = ProcessedImage(payload_bytes(payload), mime, source, mobile, normalized)
+    if storage_policy is not None:
+        try:
+            p.storage(storage_policy)
+        except Exception:
+            pass  # left out; the caller retries in-process and reports it
+    try:
+        p.pdf_page(pdf_policy)
+    except Exception:
+        pass
+    try:
+        p.quality()
+    except Exception:
+        pass
+    state = p.export()
+    if shm_min_bytes:
+        for key, value in state["encodings"].items():
+            if len(value[0]) >= shm_min_bytes:
+                state["encodings"][key] = (_shared_payload(value[0]),) + tuple(value[1:])
+    return state
+
+def make_thumbnail(payload, source: str, mobile: bool, max_side: int) -> tuple[bytes, dict[str, float] | None]:
+    # (small upright JPEG, capture quality); both come from one reduced decode.
+    p = ProcessedImage(payload_bytes(payload), None, source, mobile)
+    img = p.preview(max_side)
+    try:
+        quality = p.quality()
+    except Exception:
+        quality = None
+    if img.mode != "RGB": img = img.convert("RGB")
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=80)
+    return buf.getvalue(), quality
@@ -0,0 +1,105 @@
+# Labelled synthetic ID-card captures for the orientation and quality gate tests and
+# the bench/ scripts. Text is drawn as rows of word blocks, which is all the projection
+# heuristics look at.
+import random
+
+from PIL import Image, ImageDraw, ImageFilter
+
+# ID-1 card (85.6 x 54 mm)
+CARD_RATIO = 85.6 / 54
+LAYOUTS = ("ine_front", "ine_back", "passport")
+# PIL rotate() angle (counter-clockwise) that puts a capture taken this way upright
+CAPTURE_ANGLES = (0, 90, 180, 270)
+
+def _words(draw, rng, x0, x1, y, h, density=1.0, ink=30):
+    x = x0
+    while x < x1:
+        w = int(rng.uniform(1.5, 7) * h)
+        if rng.random() < density:
+            draw.rectangle([x, y, min(x + w, x1), y + h], fill=ink + rng.randint(0, 40))
+        x += w + int(h * rng.uniform(0.6, 1.2))
+
+def _lines(draw, rng, x0, x1, y0, y1, n, density=1.0, short=False):
+    pitch = (y1 - y0) / n
+    for i in range(n):
+        end = x0 + (x1 - x0) * (rng.uniform(0.3, 0.7) if short else rng.uniform(0.8, 1.0))
+        _words(draw, rng, x0, int(end), int(y0 + i * pitch), max(2, int(pitch * 0.45)), density)
+
+def card(layout: str, width: int = 1712, seed: int = 0) -> Image.Image:
+    # One upright card, no background.
+    rng = random.Random(f"{layout}:{seed}")
+    w, h = width, int(width / CARD_RATIO)
+    img = Image.new("L", (w, h), rng.randint(205, 240))
+    d = ImageDraw.Draw(img)
+    m = w // 30
+    if layout == "ine_front":
+        d.rectangle([0, 0, w, h // 8], fill=rng.randint(150, 190))
+        _lines(d, rng, m, w // 2, m // 2, h // 8 - m // 4, 2, short=True)
+        d.rectangle([m, h // 5, m + w // 4, h // 5 + w // 3], fill=rng.randint(90, 140))
+        d.ellipse([m + w // 20, h // 5 + w // 14, m + w // 5, h // 5 + w // 4], fill=rng.randint(40, 80))
+        _lines(d, rng, m + w // 4 + m, w - m, h // 5, h - 2 * m, rng.randint(7, 9))
+    elif layout == "ine_back":
+        _lines(d, rng, m, w // 2, m, h // 5, 2, short=True)
+        for qx in (w - m - w // 5, w - 2 * m - 2 * w // 5):
+            for _ in range(120):
+                x, y = rng.randint(qx, qx + w // 5 - 12), rng.randint(m, m + w // 5 - 12)
+                d.rectangle([x, y, x + 12, y + 12], fill=20)
+        # Machine-readable zone: three dense full-width lines at the bottom
+        _lines(d, rng, m, w - m, int(h * 0.62), h - m, 3, density=1.0)
+    else:
+        d.rectangle([m, m, m + w // 3, h - h // 3], fill=rng.randint(90, 140))
+        _lines(d, rng, m + w // 3 + m, w - m, m, h - h // 3, rng.randint(6, 8))
+        _lines(d, rng, m, w - m, h - h // 3 + m, h - m, 2, density=1.0)
+    return img
+
+def capture(layout: str, angle: int, size: tuple[int, int] = (4000, 3000), seed: int = 0) -> Image.Image:
+    # Camera frame with the card on a table, turned so that rotate(angle) makes it upright.
+    rng = random.Random(f"capture:{layout}:{angle}:{seed}")
+    fw, fh = size
+    c = card(layout, int(fw * rng.uniform(0.6, 0.8)), seed)
+    c = c.rotate(rng.uniform(-4, 4), resample=Image.BICUBIC, expand=True, fillcolor=0)
+    mask = c.point(lambda v: 255 if v else 0)
+    frame = Image.effect_noise((fw // 8, fh // 8), rng.uniform(10, 30)).resize((fw, fh), Image.BILINEAR)
+    frame = frame.point(lambda v, base=rng.randint(60, 140): min(255, base + v // 3))
+    frame.paste(c, ((fw - c.width) // 2 + rng.randint(-fw // 20, fw // 20), (fh - c.height) // 2 + rng.randint(-fh // 20, fh // 20)), mask)
+    frame = frame.filter(ImageFilter.GaussianBlur(rng.uniform(0.5, 2.0)))
+    # Taking the picture turned by -angle is the same as turning the upright scene by -angle
+    return frame.rotate(-angle, expand=True).convert("RGB")
+
+def labelled_set(size: tuple[int, int] = (4000, 3000), seeds: int = 1):
+    # (name, capture, angle that makes it upright) for every layout, angle and seed.
+    for seed in range(seeds):
+        for layout in LAYOUTS:
+            for angle in CAPTURE_ANGLES:
+                yield f"{layout}-{seed}-rot{angle}", capture(layout, angle, size, seed), angle
+
+# Capture faults the quality gate (idcode.quality_issues) must report, by the issue it reports.
+QUALITY_LABELS = {"good": None, "blurry": "borrosa", "glare": "con reflejos", "dark": "muy oscura", "overexposed": "sobreexpuesta"}
+
+def degrade(img: Image.Image, label: str, seed: int = 0) -> Image.Image:
+    # The capture as taken out of focus, under a lamp's reflection, in a dim room or against the light.
+    rng = random.Random(f"{label}:{seed}")
+    w, h = img.size
+    if label == "blurry":
+        return img.filter(ImageFilter.GaussianBlur(max(w, h) * rng.uniform(0.004, 0.01)))
+    if label == "glare":
+        mask = Image.new("L", img.size, 0)
+        cx, cy = w * rng.uniform(0.35, 0.65), h * rng.uniform(0.35, 0.65)
+        rx, ry = w * rng.uniform(0.15, 0.25), h * rng.uniform(0.15, 0.25)
+        ImageDraw.Draw(mask).ellipse([cx - rx, cy - ry, cx + rx, cy + ry], fill=255)
+        mask = mask.filter(ImageFilter.GaussianBlur(max(w, h) / 100))
+        return Image.composite(Image.new(img.mode, img.size, (255,) * len(img.getbands())), img, mask)
+    if label == "dark":
+        return img.point(lambda v, f=rng.uniform(0.12, 0.25): int(v * f))
+    if label == "overexposed":
+        return img.point(lambda v, f=rng.uniform(0.15, 0.3): int(255 - (255 - v) * f))
+    return img
+
+def quality_set(size: tuple[int, int] = (4000, 3000), seeds: int = 1):
+    # (name, capture, label) for every layout, label and seed; captures are upright or sideways.
+    for seed in range(seeds):
+        for layout in LAYOUTS:
+            angle = CAPTURE_ANGLES[seed % len(CAPTURE_ANGLES)]
+            base = capture(layout, angle, size, seed)
+            for label in QUALITY_LABELS:
+                yield f"{layout}-{seed}-{label}", degrade(base, label, seed), label
@@ -0,0 +1,49 @@
+import logging
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(ROOT), str(ROOT / "tests")]
+
+import streamlit as st
+from streamlit.runtime.secrets import Secrets
+
+# Importing the app runs its page once in bare mode; keep that quiet.
+logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").setLevel(logging.ERROR)
+
+from fakegraph import FakeGraph
+
+def use_secrets(values: dict) -> None:
+    # Module-level, so job and replica threads see them too (AppTest only swaps them per run).
+    secrets = Secrets()
+    secrets._secrets = values
+    st.secrets = secrets
+
+@pytest.fixture
+def graph():
+    g = FakeGraph()
+    yield g
+    g.close()
+
+@pytest.fixture
+def app_secrets(graph, tmp_path) -> dict:
+    # Edit before first use of the app fixture's caches to change a setting.
+    return {
+        "azure_app": {**graph.secrets(), "onedrive_base_folder": "fotos_cotizaciones", "upload_workers": 2},
+        "image_pool": {"workers": 0},
+        "photo_store": {"dir": str(tmp_path / "photos")},
+        "jobs": {"dir": str(tmp_path / "jobs"), "workers": 1},
+        "pdf": {"cache_dir": str(tmp_path / "pdf")},
+        "storage": {"dir": str(tmp_path / "storage")},
+    }
+
+@pytest.fixture
+def app(app_secrets):
+    use_secrets(app_secrets)
+    st.cache_resource.clear()
+    import idcode
+    st.cache_resource.clear()
+    yield idcode
+    st.cache_resource.clear()
@@ -0,0 +1,296 @@
+# ----------------------------------------------------
+# FAKE MICROSOFT GRAPH
+# ----------------------------------------------------
+# Local stand-in for the parts of Graph the app uses: client-credentials tokens,
+# drive paths and children, simple PUTs, upload sessions, $batch, /delta and PATCH.
+# Knobs make it misbehave the way the real service does (latency, drops, 429s, 410s,
+# outages); the benchmarks in bench/ run against it too.
+import json
+import random
+import re
+import threading
+import time
+import uuid
+import urllib.parse
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BATCH_MAX = 20
+
+class Drive:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.items = {"root": {"id": "root", "name": "root", "parent": None, "folder": True, "seq": 0}}
+        self.sessions: dict[str, dict] = {}
+        self.seq = 0
+
+    def _bump(self, it: dict) -> None:
+        self.seq += 1
+        it["seq"] = self.seq
+
+    def children(self, parent_id: str) -> list[dict]:
+        return [it for it in self.items.values() if it["parent"] == parent_id and not it.get("deleted")]
+
+    def child(self, parent_id: str, name: str) -> dict | None:
+        return next((it for it in self.children(parent_id) if it["name"] == name), None)
+
+    def by_path(self, path: str) -> dict | None:
+        cur = self.items["root"]
+        for part in [p for p in path.split("/") if p]:
+            cur = self.child(cur["id"], part)
+            if cur is None: return None
+        return cur
+
+    def add(self, parent_id: str, name: str, folder: bool = False, content: bytes = b"", description: str | None = None, conflict: str = "replace") -> dict | None:
+        # None when conflict == "fail" and the name is taken.
+        with self.lock:
+            it = self.child(parent_id, name)
+            if it is not None:
+                if conflict == "fail" or folder or it["folder"]: return None
+                it["content"] = content
+                if description is not None: it["description"] = description
+                self._bump(it)
+                return it
+            it = {"id": uuid.uuid4().hex[:16], "name": name, "parent": parent_id, "folder": folder, "content": content, "description": description}
+            self._bump(it)
+            self.items[it["id"]] = it
+            return it
+
+    def folder(self, path: str) -> dict:
+        # Creates every missing folder on the way, like a user would in the web UI.
+        cur = self.items["root"]
+        for part in [p for p in path.split("/") if p]:
+            cur = self.child(cur["id"], part) or self.add(cur["id"], part, folder=True)
+        return cur
+
+    def delete(self, item_id: str) -> None:
+        with self.lock:
+            it = self.items[item_id]
+            it["deleted"] = True
+            self._bump(it)
+
+    def files(self, parent_id: str) -> dict[str, dict]:
+        return {it["name"]: it for it in self.children(parent_id) if not it["folder"]}
+
+def view(it: dict) -> dict:
+    d = {"id": it["id"], "name": it["name"], "parentReference": {"id": it["parent"]}}
+    if it.get("deleted"):
+        d["deleted"] = {"state": "deleted"}
+        return d
+    if it["folder"]:
+        d["folder"] = {"childCount": 0}
+    else:
+        d.update(file={}, size=len(it["content"]), eTag=f'"{it["id"]},{it["seq"]}"')
+    if it.get("description"): d["description"] = it["description"]
+    return d
+
+class FakeGraph:
+    def __init__(self, simple_limit: int = 4 * 1024 * 1024, delta_page: int = 200):
+        self.drive = Drive()
+        self.calls = Counter()  # "METHOD /path" with ids masked; batched requests count as "BATCHED ..."
+        self.connections = 0
+        self.tokens_issued = 0
+        self.token_ttl = 3599
+        self.simple_limit = simple_limit
+        self.delta_page = delta_page
+        self.delta_supported = True
+        self.down = False  # every Graph call answers 500
+        self.drop_upload_at: int | None = None  # cut the connection once per session at this offset
+        self.lose_session_at: int | None = None  # forget the session (404) once, at this offset
+        self.throttle_batch = 0  # next N batched requests answer 429
+        self.expire_delta = False  # next delta call carrying a token answers 410
+        self.latency = 0.0  # seconds added to every request
+        self.throttle_rate = 0.0  # share of Graph calls answering 429 (Retry-After: 0)
+        self.fail_rate = 0.0  # share of Graph calls answering 503
+        self.rng = random.Random(0)
+        self.lock = threading.Lock()
+        self.bytes_in = 0  # request and response bodies, headers not included
+        self.bytes_out = 0
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                fake.connections += 1
+
+            def send(self, status: int, obj=None, headers: dict | None = None) -> None:
+                raw = obj if isinstance(obj, bytes) else json.dumps(obj).encode() if obj is not None else b""
+                self.send_response(status)
+                for k, v in (headers or {}).items(): self.send_header(k, v)
+                if obj is not None and not isinstance(obj, bytes): self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(raw)))
+                self.end_headers()
+                self.wfile.write(raw)
+                with fake.lock:
+                    fake.bytes_out += len(raw)
+
+            def handle_any(self):
+                n = int(self.headers.get("Content-Length") or 0)
+                fake.dispatch(self, self.command, self.rfile.read(n) if n else b"")
+
+            do_GET = do_POST = do_PUT = do_PATCH = handle_any
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.base = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, name="fake-graph", daemon=True).start()
+
+    def close(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def secrets(self) -> dict:
+        return {
+            "tenant_id": "tenant", "client_id": "client", "client_secret": "secret", "onedrive_user": "fotos@example.com",
+            "authority_url": self.base, "graph_url": self.base + "/v1.0",
+        }
+
+    def dispatch(self, h, method: str, body: bytes) -> None:
+        path, _, qs = h.path.partition("?")
+        path = urllib.parse.unquote(path)
+        with self.lock:
+            self.calls[f"{method} {re.sub(r'[0-9a-f]{16}', '{id}', path)}"] += 1
+            self.bytes_in += len(body)
+            fault = self.rng.random()
+        if self.latency: time.sleep(self.latency)
+        if path.endswith("/oauth2/v2.0/token"):
+            self.tokens_issued += 1
+            return h.send(200, {"access_token": f"tok-{self.tokens_issued}", "expires_in": self.token_ttl})
+        if self.down:
+            return h.send(500, {"error": {"code": "generalException"}})
+        if fault < self.throttle_rate:
+            return h.send(429, {"error": {"code": "TooManyRequests"}}, {"Retry-After": "0"})
+        if fault < self.throttle_rate + self.fail_rate:
+            return h.send(503, {"error": {"code": "serviceNotAvailable"}}, {"Retry-After": "0"})
+        if path.startswith("/upload/"):
+            return self.upload_chunk(h, method, path, body)
+        if not (h.headers.get("Authorization") or "").startswith("Bearer tok-"):
+            return h.send(401, {"error": {"code": "InvalidAuthenticationToken"}})
+        status, obj, headers = self.route(method, path, urllib.parse.parse_qs(qs), body)
+        h.send(status, obj, headers)
+
+    def route(self, method: str, path: str, q: dict, body: bytes) -> tuple[int, object, dict | None]:
+        if path == "/v1.0/$batch" and method == "POST":
+            return 200, {"responses": [self.batched(r) for r in self.batch_requests(body)]}, None
+        m = re.match(r"^/v1\.0/users/[^/]+/drive(.*)$", path)
+        if not m: return not_found(path)
+        rest, d = m.group(1), self.drive
+        if rest == "/root" and method == "GET":
+            return 200, view(d.items["root"]), None
+        if rest == "/root/children" and method == "POST":
+            return self.create(d.items["root"], body)
+        if mm := re.match(r"^/root:/(.+?):/children$", rest):
+            return self.create(d.by_path(mm.group(1)), body) if method == "POST" else not_found(rest)
+        if (mm := re.match(r"^/root:/(.+?):?$", rest)) and method == "GET":
+            it = d.by_path(mm.group(1))
+            return (200, view(it), None) if it else not_found(rest)
+        if mm := re.match(r"^/items/([^/:]+)/children$", rest):
+            if method == "POST": return self.create(d.items.get(mm.group(1)), body)
+            return self.list_children(mm.group(1), q)
+        if mm := re.match(r"^/items/([^/:]+)/delta$", rest):
+            return self.delta(mm.group(1), q)
+        if mm := re.match(r"^/items/([^/:]+):/(.+):/content$", rest):
+            if method == "PUT":
+                if len(body) > self.simple_limit: return 413, {"error": {"code": "requestTooLarge"}}, None
+                return 201, view(d.add(mm.group(1), mm.group(2), content=body)), None
+            it = d.child(mm.group(1), mm.group(2))
+            return (200, it["content"], {"ETag": f'"{it["id"]},{it["seq"]}"'}) if it else not_found(rest)
+        if mm := re.match(r"^/items/([^/:]+):/(.+):/createUploadSession$", rest):
+            sid = uuid.uuid4().hex
+            d.sessions[sid] = {"parent": mm.group(1), "name": mm.group(2), "buf": bytearray(), "dropped": False}
+            return 200, {"uploadUrl": f"{self.base}/upload/{sid}", "expirationDateTime": "2099-01-01T00:00:00Z"}, None
+        if (mm := re.match(r"^/items/([^/:]+):/([^:]+)$", rest)) and method == "GET":
+            it = d.child(mm.group(1), mm.group(2))
+            return (200, view(it), None) if it else not_found(rest)
+        if (mm := re.match(r"^/items/([^/:]+)$", rest)) and method == "PATCH":
+            it = d.items.get(mm.group(1))
+            if it is None: return not_found(rest)
+            it["description"] = json.loads(body).get("description", it.get("description"))
+            return 200, view(it), None
+        return not_found(rest)
+
+    def batch_requests(self, body: bytes) -> list[dict]:
+        reqs = json.loads(body)["requests"]
+        if len(reqs) > BATCH_MAX: raise AssertionError(f"$batch with {len(reqs)} requests")
+        ids = {r["id"] for r in reqs}
+        for r in reqs:
+            # Graph rejects dependsOn pointing outside the same $batch call.
+            if not set(r.get("dependsOn") or []) <= ids: raise AssertionError(f"dependsOn {r['dependsOn']} outside the batch")
+        return reqs
+
+    def batched(self, r: dict) -> dict:
+        self.calls[f"BATCHED {r['method']}"] += 1
+        if self.throttle_batch:
+            self.throttle_batch -= 1
+            return {"id": r["id"], "status": 429, "headers": {"Retry-After": "0"}, "body": {"error": {"code": "TooManyRequests"}}}
+        u = urllib.parse.urlsplit(r["url"])
+        body = json.dumps(r["body"]).encode() if "body" in r else b""
+        status, obj, headers = self.route(r["method"], "/v1.0" + urllib.parse.unquote(u.path), urllib.parse.parse_qs(u.query), body)
+        return {"id": r["id"], "status": status, "headers": headers or {}, "body": obj}
+
+    def create(self, parent: dict | None, body: bytes) -> tuple[int, object, None]:
+        if parent is None: return not_found("parent")
+        p = json.loads(body)
+        it = self.drive.add(parent["id"], p["name"], folder="folder" in p, conflict=p.get("@microsoft.graph.conflictBehavior", "fail"))
+        if it is None: return 409, {"error": {"code": "nameAlreadyExists"}}, None
+        return 201, view(it), None
+
+    def list_children(self, parent_id: str, q: dict) -> tuple[int, dict, None]:
+        kids = self.drive.children(parent_id)
+        top, skip = int(q.get("$top", ["200"])[0]), int(q.get("$skip", ["0"])[0])
+        res = {"value": [view(k) for k in kids[skip:skip + top]]}
+        if skip + top < len(kids):
+            res["@odata.nextLink"] = f"{self.base}/v1.0/users/u/drive/items/{parent_id}/children?$top={top}&$skip={skip + top}"
+        return 200, res, None
+
+    def delta(self, folder_id: str, q: dict) -> tuple[int, object, None]:
+        # Changes under the folder since token, delta_page per page; like Graph, the
+        # folder itself comes first in a full enumeration.
+        if not self.delta_supported: return 400, {"error": {"code": "invalidRequest"}}, None
+        if "token" in q and self.expire_delta:
+            self.expire_delta = False
+            return 410, {"error": {"code": "resyncRequired"}}, None
+        token, skip = int(q.get("token", ["0"])[0]), int(q.get("skip", ["0"])[0])
+        with self.drive.lock:
+            changed = sorted((it for it in self.drive.items.values() if it["parent"] == folder_id and it["seq"] > token), key=lambda it: it["seq"])
+            if not token: changed.insert(0, self.drive.items[folder_id])
+            now = self.drive.seq
+        page = changed[skip:skip + self.delta_page]
+        res = {"value": [view(it) for it in page]}
+        link = f"{self.base}/v1.0/users/u/drive/items/{folder_id}/delta?token="
+        if skip + self.delta_page < len(changed):
+            res["@odata.nextLink"] = f"{link}{token}&skip={skip + self.delta_page}"
+        else:
+            res["@odata.deltaLink"] = f"{link}{now}"
+        return 200, res, None
+
+    def upload_chunk(self, h, method: str, path: str, body: bytes) -> None:
+        s = self.drive.sessions.get(path.rsplit("/", 1)[1])
+        if s is None: return h.send(404, {"error": {"code": "itemNotFound"}})
+        if method == "GET":
+            return h.send(200, {"nextExpectedRanges": [f"{len(s['buf'])}-"]})
+        start, _, total = map(int, re.match(r"bytes (\d+)-(\d+)/(\d+)", h.headers["Content-Range"]).groups())
+        if start != len(s["buf"]): return h.send(416, {"error": {"code": "invalidRange"}})
+        if self.lose_session_at is not None and start >= self.lose_session_at:
+            self.lose_session_at = None
+            del self.drive.sessions[path.rsplit("/", 1)[1]]
+            return h.send(404, {"error": {"code": "itemNotFound"}})
+        if self.drop_upload_at is not None and not s["dropped"] and start >= self.drop_upload_at:
+            # Half the chunk arrives, then the connection dies without a response.
+            s["dropped"] = True
+            s["buf"] += body[: len(body) // 2]
+            h.close_connection = True
+            h.connection.shutdown(2)
+            return
+        s["buf"] += body
+        if len(s["buf"]) < total:
+            return h.send(202, {"nextExpectedRanges": [f"{len(s['buf'])}-"]})
+        h.send(201, view(self.drive.add(s["parent"], s["name"], content=bytes(s["buf"]))))
+
+def not_found(what: str) -> tuple[int, dict, None]:
+    return 404, {"error": {"code": "itemNotFound", "message": what}}, None
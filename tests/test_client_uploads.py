@@ -0,0 +1,24 @@
+import base64
+
+def picked(*payloads: bytes) -> dict:
+    photos = [{"name": f"f{i}.jpg", "type": "image/jpeg", "data": base64.b64encode(p).decode(), "normalized": True} for i, p in enumerate(payloads)]
+    return {"batch": "b1", "photos": photos}
+
+def test_photos_become_uploaded_files(app):
+    files = app.client_uploads(picked(b"one", b"two"))
+    assert [f.file_id for f in files] == ["client-b1-0", "client-b1-1"]
+    assert [f.read() for f in files] == [b"one", b"two"]
+    assert all(f.normalized for f in files)
+
+def test_known_photos_are_not_decoded_again(app):
+    value = picked(b"one", b"two")
+    value["photos"][0]["data"] = "not base64 at all!"  # would fail if decoded
+    record = app.PhotoRecord("d" * 64, 3, "image/jpeg", "upload", None, name="f0.jpg", file_id="client-b1-0")
+    files = app.client_uploads(value, {"client-b1-0": record})
+    assert files[0] is record
+    assert files[1].read() == b"two"
+
+def test_invalid_photos_are_skipped(app):
+    value = picked(b"one")
+    value["photos"].append({"name": "bad.jpg", "data": "%%%"})
+    assert [f.read() for f in app.client_uploads(value)] == [b"one"]
@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+from uploads import records, wait
+
+BASE = "fotos_cotizaciones"
+DIGEST = "0123456789abcdef" * 4
+
+@pytest.mark.parametrize("item,found", [
+    ({"name": f"F001_upload_101010__sha256_{DIGEST}.png"}, {DIGEST}),
+    ({"name": f"F001_upload_101010__sha256_{DIGEST[:12]}.jpg"}, {DIGEST[:12]}),  # legacy, prefix only
+    ({"name": f"F001_camera_101010__{DIGEST[:12]}.jpg"}, {DIGEST[:12]}),
+    ({"name": f"F001_camera_101010__sha256_{DIGEST[:12]}"}, {DIGEST[:12]}),
+    ({"name": "foto.jpg", "description": f"sha256:{DIGEST}"}, {DIGEST}),
+    ({"name": f"F001_upload_101010__sha256_{DIGEST[:12]}.jpg", "description": f"sha256:{DIGEST}"}, {DIGEST[:12], DIGEST}),
+    ({"name": f"F001_upload_101010__sha256_{DIGEST[:13]}.jpg"}, set()),  # neither length
+    ({"name": f"F001_upload_101010_sha256_{DIGEST}.jpg"}, set()),
+    ({"name": "F001_fotos_20250101_101010.pdf", "description": None}, set()),
+])
+def test_hashes_from_item(app, item, found):
+    assert app.hashes_from_item(item) == found
+
+def test_legacy_prefix_counts_as_known(app):
+    assert app.is_known_hash(DIGEST, {DIGEST[:12]})
+    assert app.is_known_hash(DIGEST, {DIGEST})
+    assert not app.is_known_hash(DIGEST, {DIGEST[:11], "f" * 64})
+
+def test_unique_photos_keeps_the_first_of_each(app):
+    a, b = records(app, 2)
+    camera = app.PhotoRecord(a.sha256, a.size, a.mime, "camera", a.path)
+    assert app.unique_photos([a, b, camera, b]) == [a, b]
+
+def stored_photos(graph, folio: str) -> dict:
+    files = graph.drive.files(graph.drive.by_path(f"{BASE}/{folio}")["id"])
+    return {n: it for n, it in files.items() if not n.endswith((".json", ".pdf"))}
+
+def manifest_of(app, graph, folio: str, job_id: str) -> dict:
+    files = graph.drive.files(graph.drive.by_path(f"{BASE}/{folio}")["id"])
+    return json.loads(files[app.batch_names(folio, job_id)[0]]["content"])
+
+def photo_states(app, graph, folio: str, job_id: str) -> list[str]:
+    return [e["state"] for e in manifest_of(app, graph, folio, job_id)["photos"]]
+
+def test_identical_photo_is_not_uploaded_again(app, graph):
+    runner = app.job_runner()
+    first = records(app, 2)
+    wait(runner, runner.submit(BASE, "F400", first))
+    before = stored_photos(graph, "F400")
+    # A later batch on the folio repeats one photo; only the new one goes up.
+    second = [first[1], *records(app, 1, first=5)]
+    job_id = runner.submit(BASE, "F400", second)
+    assert wait(runner, job_id)["status"] == "done"
+    after = stored_photos(graph, "F400")
+    assert len(after) == 3 and set(before) < set(after)
+    assert photo_states(app, graph, "F400", job_id) == ["existing", "uploaded"]
+    assert app.metrics().counters["idphotos_dedup_hits_total"][()] == 1
+    # The repeated photo is still a page of the new batch's PDF.
+    assert manifest_of(app, graph, "F400", job_id)["pdf"] == app.batch_names("F400", job_id)[1]
+
+def test_dedup_survives_a_cold_hash_index(app, graph, tmp_path):
+    recs = records(app, 2)
+    store = app.JobStore(tmp_path / "cold")
+    app.run_upload_job(store, store.get(store.enqueue(BASE, "F410", recs)))
+    app._hash_index.clear()  # a new process: the folder is listed from Graph again
+    job_id = store.enqueue(BASE, "F410", [*recs, *records(app, 1, first=7)])
+    app.run_upload_job(store, store.get(job_id))
+    assert len(stored_photos(graph, "F410")) == 3
+    assert photo_states(app, graph, "F410", job_id) == ["existing", "existing", "uploaded"]
+
+def test_legacy_named_photo_is_recognised(app, graph):
+    rec, = records(app, 1)
+    folder = graph.drive.folder(f"{BASE}/F420")
+    legacy = f"F420_upload_093000__sha256_{rec.sha256[:12]}.jpg"
+    graph.drive.add(folder["id"], legacy, content=rec.path.read_bytes())  # no description, like old uploads
+    runner = app.job_runner()
+    job_id = runner.submit(BASE, "F420", [rec])
+    assert wait(runner, job_id)["status"] == "done"
+    assert list(stored_photos(graph, "F420")) == [legacy]
+    assert photo_states(app, graph, "F420", job_id) == ["existing"]
@@ -0,0 +1,84 @@
+import hashlib
+
+import pytest
+
+def digest(i: int) -> str:
+    return hashlib.sha256(str(i).encode()).hexdigest()
+
+@pytest.fixture
+def folio(app, graph):
+    graph.delta_page = 2  # several pages per sync
+    f = graph.drive.folder("fotos_cotizaciones/251215-0FF480")
+    for i in range(5):
+        graph.drive.add(f["id"], app.hashed_filename("251215-0FF480", "camera", digest(i), ".png"), content=b"x")
+    # Older uploads: digest only in the description, or a 12-digit legacy name.
+    graph.drive.add(f["id"], "foto_vieja.jpg", content=b"x", description="sha256:" + digest(5))
+    graph.drive.add(f["id"], f"legacy__{digest(6)[:12]}.jpg", content=b"x")
+    return f
+
+def delta_calls(graph) -> int:
+    return sum(v for k, v in graph.calls.items() if k.endswith("/delta"))
+
+def test_full_enumeration_over_several_pages(app, graph, folio):
+    hashes = app.existing_hashes(folio["id"])
+    assert all(app.is_known_hash(digest(i), hashes) for i in range(7))
+    assert not app.is_known_hash(digest(7), hashes)
+    assert delta_calls(graph) == 4  # the folder itself plus 7 files, two per page
+
+def test_cached_within_max_age(app, graph, folio):
+    app.existing_hashes(folio["id"])
+    calls = delta_calls(graph)
+    app.existing_hashes(folio["id"])
+    assert delta_calls(graph) == calls
+
+def test_later_syncs_only_fetch_changes(app, graph, folio):
+    app.existing_hashes(folio["id"])
+    calls = delta_calls(graph)
+    graph.drive.add(folio["id"], app.hashed_filename("251215-0FF480", "upload", digest(8), ".jpg"), content=b"x")
+    gone = next(it for it in graph.drive.children(folio["id"]) if digest(0) in it["name"])
+    graph.drive.delete(gone["id"])
+    hashes = app.existing_hashes(folio["id"], max_age_s=0)
+    assert app.is_known_hash(digest(8), hashes)
+    assert not app.is_known_hash(digest(0), hashes)
+    assert delta_calls(graph) == calls + 1
+
+def test_expired_token_resyncs_from_scratch(app, graph, folio):
+    app.existing_hashes(folio["id"])
+    gone = next(it for it in graph.drive.children(folio["id"]) if digest(1) in it["name"])
+    graph.drive.delete(gone["id"])
+    graph.expire_delta = True
+    hashes = app.existing_hashes(folio["id"], max_age_s=0)
+    assert not app.is_known_hash(digest(1), hashes)
+    assert all(app.is_known_hash(digest(i), hashes) for i in (0, 2, 3, 4, 5, 6))
+    assert app.metrics().counters["idphotos_delta_resyncs_total"][()] == 1
+
+def test_expired_token_on_a_next_page_resyncs(app, graph, folio):
+    app.existing_hashes(folio["id"])
+    for i in range(10, 15):
+        graph.drive.add(folio["id"], app.hashed_filename("251215-0FF480", "camera", digest(i), ".png"), content=b"x")
+    real, expired = graph.delta, []
+    def expire_on_second_page(folder_id, q):
+        if "skip" in q and not expired:
+            expired.append(q)
+            graph.expire_delta = True
+        return real(folder_id, q)
+    graph.delta = expire_on_second_page
+    hashes = app.existing_hashes(folio["id"], max_age_s=0)
+    assert expired
+    assert all(app.is_known_hash(digest(i), hashes) for i in (*range(7), *range(10, 15)))
+    assert app.metrics().counters["idphotos_delta_resyncs_total"][()] == 1
+
+def test_uploads_count_until_a_sync_sees_them(app, graph, folio):
+    app.existing_hashes(folio["id"])
+    app.remember_hash(folio["id"], digest(9))
+    assert app.is_known_hash(digest(9), app.existing_hashes(folio["id"]))
+    # Not on the drive (the upload was lost): the next sync forgets it only once it has it.
+    assert app.is_known_hash(digest(9), app.existing_hashes(folio["id"], max_age_s=0))
+
+def test_falls_back_to_listing_without_delta(app, graph, folio):
+    graph.delta_supported = False
+    hashes = app.existing_hashes(folio["id"])
+    assert all(app.is_known_hash(digest(i), hashes) for i in range(7))
+    assert app._hash_index().delta_ok is False
+    app.existing_hashes(folio["id"], max_age_s=0)
+    assert delta_calls(graph) == 1
@@ -0,0 +1,129 @@
+import json
+import threading
+import time
+
+import pytest
+
+from uploads import records, wait
+
+BASE = "fotos_cotizaciones"
+
+def folder_files(graph, folio: str) -> dict:
+    return graph.drive.files(graph.drive.by_path(f"{BASE}/{folio}")["id"])
+
+def manifest_of(graph, folio: str, name: str) -> dict:
+    return json.loads(folder_files(graph, folio)[name]["content"])
+
+def run(app, store, folio: str, recs: list) -> str:
+    job_id = store.enqueue(BASE, folio, recs)
+    app.run_upload_job(store, store.get(job_id))
+    return job_id
+
+def puts(graph) -> int:
+    return sum(v for k, v in graph.calls.items() if k.startswith(("PUT", "POST", "BATCHED PUT")))
+
+@pytest.fixture
+def store(app, tmp_path):
+    return app.JobStore(tmp_path / "batches")
+
+def spans(app, folios: list[str], hold: float = 0.2) -> list[tuple[float, float]]:
+    out, lock = [], threading.Lock()
+    def enter(folio):
+        with app.folio_lock(BASE, folio):
+            t = time.monotonic()
+            time.sleep(hold)
+            with lock: out.append((t, time.monotonic()))
+    threads = [threading.Thread(target=enter, args=(f,)) for f in folios]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return sorted(out)
+
+@pytest.mark.parametrize("file_locks", [False, True])
+def test_folio_lock_serializes_one_folio(app_secrets, request, file_locks):
+    app_secrets["jobs"]["file_locks"] = file_locks
+    app = request.getfixturevalue("app")
+    (_, end), (start, _) = spans(app, ["F100", "F100"])
+    assert start >= end
+    (_, end), (start, _) = spans(app, ["F100", "F101"])
+    assert start < end  # other folios do not wait
+    assert not app._folio_locks().held
+
+def test_two_jobs_on_one_folio_run_one_after_the_other(app_secrets, request, graph):
+    app_secrets["jobs"]["workers"] = 2
+    app = request.getfixturevalue("app")
+    active, overlaps = [], []
+    upload_batch = app.upload_batch
+    def slow_batch(target_id, folio, *args, **kw):
+        active.append(folio)
+        if len(active) > 1: overlaps.append(list(active))
+        time.sleep(0.3)
+        try:
+            return upload_batch(target_id, folio, *args, **kw)
+        finally:
+            active.remove(folio)
+    app.upload_batch = slow_batch
+    try:
+        runner = app.job_runner()
+        first = runner.submit(BASE, "F110", records(app, 2))
+        second = runner.submit(BASE, "F110", records(app, 2, first=2))
+        assert first != second
+        assert wait(runner, first)["status"] == wait(runner, second)["status"] == "done"
+    finally:
+        app.upload_batch = upload_batch
+    assert overlaps == []
+    assert sum(n.endswith(".json") for n in folder_files(graph, "F110")) == 2
+
+def test_batch_names_follow_the_batch(app):
+    a = app.batch_id(BASE, "F120", ["a" * 64, "b" * 64])
+    assert a == app.batch_id(BASE, "F120", ["b" * 64, "a" * 64])
+    manifest, pdf = app.batch_names("F120", a)
+    assert manifest == f"F120_lote_{a.rsplit('-', 1)[-1]}.json" and pdf == f"F120_fotos_{a.rsplit('-', 1)[-1]}.pdf"
+    assert app.batch_names("F120", app.batch_id(BASE, "F120", ["c" * 64])) != (manifest, pdf)
+
+def test_retried_batch_overwrites_its_own_files(app, graph, store):
+    recs = records(app)
+    job_id = run(app, store, "F130", recs)
+    manifest_name, pdf_name = app.batch_names("F130", job_id)
+    first = manifest_of(graph, "F130", manifest_name)
+    # Crashed before the final manifest write: the retry redoes the batch under the same names.
+    app.write_manifest(graph.drive.by_path(f"{BASE}/F130")["id"], manifest_name, {**first, "state": "uploading"})
+    run(app, store, "F130", recs)
+    files = folder_files(graph, "F130")
+    assert sorted(n for n in files if n.endswith((".json", ".pdf"))) == sorted([manifest_name, pdf_name])
+    assert sum(n.endswith(".jpg") or n.endswith(".png") for n in files) == 3
+    assert manifest_of(graph, "F130", manifest_name)["state"] == "done"
+
+def test_replay_merges_into_the_existing_manifest(app, graph, store):
+    recs = records(app, 3)
+    run(app, store, "F140", recs[:2])  # an earlier batch already stored two of them
+    job_id = store.enqueue(BASE, "F140", recs)
+    manifest_name, pdf_name = app.batch_names("F140", job_id)
+    folder_id = graph.drive.by_path(f"{BASE}/F140")["id"]
+    app.write_manifest(folder_id, manifest_name, {"batch": job_id, "state": "uploading", "created": "2025-01-02T03:04:05", "photos": []})
+    app.run_upload_job(store, store.get(job_id))
+    manifest = manifest_of(graph, "F140", manifest_name)
+    assert manifest["created"] == "2025-01-02T03:04:05"
+    assert [e["state"] for e in manifest["photos"]] == ["existing", "existing", "uploaded"]
+    assert [e["sha256"] for e in manifest["photos"]] == [r.sha256 for r in recs]
+    assert (manifest["state"], manifest["pdf"]) == ("done", pdf_name)
+    assert sum(n.endswith(".jpg") or n.endswith(".png") for n in folder_files(graph, "F140")) == 3
+
+def test_finished_batch_replays_without_uploading(app, graph, store):
+    recs = records(app)
+    job_id = run(app, store, "F150", recs)
+    manifest_name, _ = app.batch_names("F150", job_id)
+    before, written = puts(graph), manifest_of(graph, "F150", manifest_name)
+    app.run_upload_job(store, store.get(job_id))
+    assert puts(graph) == before
+    assert manifest_of(graph, "F150", manifest_name) == written
+    assert store.get(job_id)["done"] == 3
+
+def test_unreadable_manifest_is_rewritten(app, graph, store):
+    recs = records(app, 1)
+    job_id = store.enqueue(BASE, "F160", recs)
+    manifest_name, _ = app.batch_names("F160", job_id)
+    folder_id = app.storage_backend().ensure_folder([BASE, "F160"])
+    app.storage_backend().put(folder_id, manifest_name, b"{not json", "application/json")
+    assert app.read_manifest(folder_id, manifest_name) is None
+    app.run_upload_job(store, store.get(job_id))
+    assert app.read_manifest(folder_id, manifest_name)["state"] == "done"
@@ -0,0 +1,79 @@
+import pytest
+
+def batch_posts(graph) -> int:
+    return graph.calls["POST /v1.0/$batch"]
+
+def test_requests_are_split_into_calls_of_twenty(app, graph):
+    b = app.GraphBatch()
+    auth = {"Authorization": f"Bearer {app.graph_token()}"}
+    ids = [b.add("GET", f"{app.drive_base_url()}/root:/f{i}?$select=id", headers=auth) for i in range(45)]
+    b.execute()
+    assert batch_posts(graph) == 3
+    assert {b.result(i)["status"] for i in ids} == {404}
+
+def test_dependency_in_an_earlier_call_is_dropped(app, graph):
+    # The child is request 21, so it travels in the second call while its parent went in the first.
+    b = app.GraphBatch()
+    auth = {"Authorization": f"Bearer {app.graph_token()}"}
+    for i in range(19):
+        b.add("GET", f"{app.drive_base_url()}/root:/x{i}", headers=auth)
+    parent = b.add("POST", f"{app.drive_base_url()}/root/children", body={"name": "p", "folder": {}}, headers=auth)
+    child = b.add("POST", f"{app.drive_base_url()}/root:/p:/children", body={"name": "c", "folder": {}}, headers=auth, depends_on=[parent])
+    b.execute()
+    assert b.result(parent)["status"] == 201
+    assert b.result(child)["status"] == 201
+    assert graph.drive.by_path("p/c")["folder"]
+
+def test_failed_dependency_fails_its_dependents(app, graph):
+    graph.drive.folder("taken")
+    b = app.GraphBatch()
+    auth = {"Authorization": f"Bearer {app.graph_token()}"}
+    for i in range(19):
+        b.add("GET", f"{app.drive_base_url()}/root:/x{i}", headers=auth)
+    parent = b.add("POST", f"{app.drive_base_url()}/root/children", body={"name": "taken", "folder": {}, "@microsoft.graph.conflictBehavior": "fail"}, headers=auth)
+    child = b.add("POST", f"{app.drive_base_url()}/root:/taken:/children", body={"name": "c", "folder": {}}, headers=auth, depends_on=[parent])
+    b.execute()
+    assert b.result(parent)["status"] == 409
+    assert b.result(child)["status"] == 424
+    assert graph.drive.by_path("taken/c") is None
+
+def test_throttled_requests_are_retried(app, graph):
+    graph.throttle_batch = 3
+    b = app.GraphBatch()
+    auth = {"Authorization": f"Bearer {app.graph_token()}"}
+    ids = [b.add("POST", f"{app.drive_base_url()}/root/children", body={"name": f"n{i}", "folder": {}}, headers=auth) for i in range(5)]
+    b.execute()
+    assert [b.result(i)["status"] for i in ids] == [201] * 5
+    assert batch_posts(graph) == 2
+    assert app.metrics().counters["idphotos_graph_retries_total"][(("status", 429),)] >= 3
+
+def test_dependency_must_come_first(app):
+    b = app.GraphBatch()
+    with pytest.raises(ValueError):
+        b.add("GET", "/x", depends_on=["7"])
+
+def test_ensure_paths_creates_missing_folders_in_two_round_trips(app, graph):
+    graph.drive.folder("fotos_cotizaciones")
+    ids = app.ensure_paths([["fotos_cotizaciones", "251215-0FF480"], ["fotos_cotizaciones", "251215-0FF481"], ["otra", "251215-0FF482"]])
+    assert ids == [graph.drive.by_path(p)["id"] for p in ("fotos_cotizaciones/251215-0FF480", "fotos_cotizaciones/251215-0FF481", "otra/251215-0FF482")]
+    assert batch_posts(graph) == 2
+    # Cached afterwards.
+    assert app.ensure_path(["otra", "251215-0FF482"]) == ids[2]
+    assert batch_posts(graph) == 2
+
+def test_ensure_paths_recovers_from_a_create_race(app, graph, monkeypatch):
+    graph.drive.folder("fotos_cotizaciones")
+    real = app.GraphBatch.execute
+    def racing(self):
+        # Someone creates the folio between our lookup and our create.
+        if any(r["method"] == "POST" for r in self.requests): graph.drive.folder("fotos_cotizaciones/251215-0FF480")
+        return real(self)
+    monkeypatch.setattr(app.GraphBatch, "execute", racing)
+    assert app.ensure_path(["fotos_cotizaciones", "251215-0FF480"]) == graph.drive.by_path("fotos_cotizaciones/251215-0FF480")["id"]
+
+def test_ensure_paths_rejects_a_file_in_the_way(app, graph):
+    base = graph.drive.folder("fotos_cotizaciones")
+    graph.drive.add(base["id"], "251215-0FF480", content=b"not a folder")
+    with pytest.raises(ValueError, match="no es una carpeta"):
+        app.ensure_path(["fotos_cotizaciones", "251215-0FF480"])
+    assert app.lookup_path(["fotos_cotizaciones"]) == base["id"]
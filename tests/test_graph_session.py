@@ -0,0 +1,32 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+def test_token_is_fetched_once_and_reused(app, graph):
+    tokens = {app.graph_token() for _ in range(20)}
+    assert tokens == {"tok-1"}
+    assert graph.tokens_issued == 1
+
+def test_concurrent_callers_share_one_token_fetch(app, graph):
+    with ThreadPoolExecutor(8) as ex:
+        tokens = set(ex.map(lambda _: app.graph_token(), range(32)))
+    assert tokens == {"tok-1"}
+    assert graph.tokens_issued == 1
+
+def test_token_is_refreshed_before_expiry(app, graph):
+    graph.token_ttl = 2  # refresh margin shrinks to half the lifetime
+    assert app.graph_token() == "tok-1"
+    time.sleep(1.1)
+    assert app.graph_token() == "tok-2"
+
+def test_requests_reuse_one_keep_alive_connection(app, graph):
+    root = app.root_id()
+    for _ in range(10):
+        assert app.lookup_path(["fotos_cotizaciones"]) is None
+    assert root == "root"
+    assert graph.connections == 1  # token, root and the ten lookups on the same socket
+
+def test_parallel_requests_stay_within_the_pool(app, graph):
+    app.graph_token()
+    with ThreadPoolExecutor(6) as ex:
+        list(ex.map(lambda _: app.lookup_path(["x"]), range(60)))
+    assert graph.connections <= 6 + 1
@@ -0,0 +1,51 @@
+import io
+import os
+
+import pytest
+from PIL import Image
+
+import imaging
+
+def photo_jpeg(size=(1600, 1200)) -> bytes:
+    img = Image.effect_noise(size, 60).convert("RGB")
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=95)
+    return buf.getvalue()
+
+def shm_segments() -> set[str]:
+    # SharedMemory segments only; the pool keeps its own semaphores there too.
+    return {n for n in os.listdir("/dev/shm") if n.startswith("psm_")} if os.path.isdir("/dev/shm") else set()
+
+STORAGE = {"mode": "original", "quality": 85, "max_dim": 0, "format": "jpeg", "target_bytes": 0}
+PDF = {"dpi": 150, "quality": 85}
+
+def test_large_encodings_come_back_through_shared_memory():
+    data = photo_jpeg()
+    before = shm_segments()
+    state = imaging.encode_photo(data, "image/jpeg", "upload", False, False, STORAGE, PDF, 64 * 1024)
+    assert all(isinstance(v[0], tuple) for v in state["encodings"].values())
+    imaging.unshare_encodings(state)
+    assert shm_segments() == before
+    p = imaging.ProcessedImage(data, "image/jpeg", "upload")
+    p.adopt(state)
+    assert p.storage(STORAGE)[0] == data
+    assert p.pdf_page(PDF) == imaging.ProcessedImage(data, "image/jpeg", "upload").pdf_page(PDF)
+    assert p.counts["encode"] == 2  # nothing redone after adopting
+
+def test_small_encodings_stay_inline():
+    state = imaging.encode_photo(photo_jpeg((64, 48)), "image/jpeg", "upload", False, False, STORAGE, PDF, 64 * 1024)
+    assert all(isinstance(v[0], bytes) for v in state["encodings"].values())
+
+@pytest.fixture
+def pooled_app(app_secrets, request):
+    app_secrets["image_pool"] = {"workers": 1, "shm_min_bytes": 64 * 1024}
+    return request.getfixturevalue("app")
+
+def test_encode_in_pool_frees_segments(pooled_app):
+    data = photo_jpeg()
+    before = shm_segments()
+    photo = imaging.ProcessedImage(data, "image/jpeg", "upload")
+    pooled_app.encode_in_pool(photo, storage=True)
+    assert shm_segments() == before
+    assert photo.cached_storage() is not None and photo.pdf_page(pooled_app.pdf_policy())[0]
+    assert photo._raw is None  # decoded and encoded in the worker only
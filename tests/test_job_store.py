@@ -0,0 +1,104 @@
+import time
+from pathlib import Path
+
+import pytest
+
+from uploads import records, wait
+
+BASE = "fotos_cotizaciones"
+
+@pytest.fixture
+def store(app, app_secrets):
+    # Same place job_runner() keeps its queue, as a second process would see it.
+    return app.JobStore(Path(app_secrets["jobs"]["dir"]))
+
+def rows(store) -> int:
+    with store._db() as db:
+        return db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+def test_same_batch_enqueued_twice_is_one_job(app, store):
+    recs = records(app)
+    job_id = store.enqueue(BASE, "F200", recs)
+    payload = sorted(p.name for p in store.job_dir(job_id).iterdir())
+    assert store.enqueue(BASE, "F200", recs[::-1]) == job_id
+    assert rows(store) == 1 and store.get(job_id)["total"] == 3
+    assert sorted(p.name for p in store.job_dir(job_id).iterdir()) == payload
+    # Another folio or another set of photos is another job.
+    assert store.enqueue(BASE, "F201", recs) != job_id
+    assert store.enqueue(BASE, "F200", recs[:2]) != job_id
+    assert rows(store) == 3
+
+def test_payload_round_trips(app, store):
+    recs = records(app)
+    recs[1].source, recs[1].mobile, recs[2].normalized = "camera", True, True
+    loaded = store.load_photos(store.enqueue(BASE, "F210", recs))
+    assert [(p.sha256, p.size, p.mime, p.source, p.mobile, p.normalized) for p in loaded] == [
+        (p.sha256, p.size, p.mime, p.source, p.mobile, p.normalized) for p in recs
+    ]
+    assert all(p.path.read_bytes() == r.path.read_bytes() for p, r in zip(loaded, recs))
+
+def test_claim_takes_each_job_once(app, store):
+    recs = records(app, 1)
+    job_id = store.enqueue(BASE, "F220", recs)
+    job = store.claim()
+    assert (job["id"], job["status"], job["attempts"]) == (job_id, "queued", 1)
+    assert store.get(job_id)["status"] == "running"
+    assert store.claim() is None
+    # Still running: enqueueing it again does not reset it.
+    assert store.enqueue(BASE, "F220", recs) == job_id
+    assert store.get(job_id)["status"] == "running"
+
+def test_job_killed_mid_run_is_requeued_and_finishes(app, store, graph):
+    job_id = store.enqueue(BASE, "F230", records(app))
+    assert store.claim()["id"] == job_id  # the process died here, with the job 'running'
+    runner = app.job_runner()  # the next process recovers the queue on start
+    job = wait(runner, job_id)
+    assert (job["status"], job["attempts"], job["done"]) == ("done", 2, 3)
+    assert not store.job_dir(job_id).exists()
+    names = graph.drive.files(graph.drive.by_path(f"{BASE}/F230")["id"])
+    assert sum(n.endswith((".jpg", ".png")) for n in names) == 3
+
+def test_recover_requeues_waiting_and_prunes_old_rows(app, store):
+    waiting = store.enqueue(BASE, "F240", records(app, 1))
+    store.claim()
+    store.wait(waiting)
+    old = store.enqueue(BASE, "F241", records(app, 1, first=1))
+    store.finish(old)
+    with store._db() as db:
+        db.execute("UPDATE jobs SET updated_at = ? WHERE id = ?", (time.time() - (app.JOB_KEEP_DAYS + 1) * 86400, old))
+    store.recover()
+    assert store.get(waiting)["status"] == "queued"
+    assert store.get(old) is None
+
+@pytest.fixture
+def failing(app_secrets, request, monkeypatch):
+    app_secrets["jobs"]["max_attempts"] = 3
+    app = request.getfixturevalue("app")
+    attempts = []
+    def run_upload_job(store, job):
+        attempts.append(job["attempts"])
+        raise RuntimeError("Graph no responde")
+    monkeypatch.setattr(app, "run_upload_job", run_upload_job)
+    monkeypatch.setattr(app, "JOB_RETRY_BACKOFF_S", 0.0)
+    return app, attempts
+
+def test_exhausted_retries_mark_the_job_failed(failing):
+    app, attempts = failing
+    runner = app.job_runner()
+    job_id = runner.submit(BASE, "F250", records(app, 1))
+    job = wait(runner, job_id, until=("failed",))
+    assert attempts == [1, 2, 3]
+    assert (job["attempts"], job["error"]) == (3, "Graph no responde")
+    # The payload stays for a manual retry, which starts the count again.
+    assert runner.store.job_dir(job_id).exists()
+    runner.retry(job_id)
+    wait(runner, job_id, until=("failed",))
+    assert attempts == [1, 2, 3, 1, 2, 3]
+
+def test_failed_attempt_waits_for_the_backoff(app, store):
+    job_id = store.enqueue(BASE, "F260", records(app, 1))
+    store.claim()
+    store.fail(job_id, "boom", retry=True)
+    job = store.get(job_id)
+    assert job["status"] == "queued" and job["not_before"] > time.time() + app.JOB_RETRY_BACKOFF_S - 5
+    assert store.claim() is None
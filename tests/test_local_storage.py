@@ -0,0 +1,75 @@
+import io
+import os
+
+import pytest
+
+from uploads import records, wait
+
+BASE = "fotos_cotizaciones"
+DIGEST = "0123456789abcdef" * 4
+
+@pytest.fixture
+def local(app, tmp_path):
+    return app.LocalStorage(tmp_path / "local")
+
+@pytest.fixture
+def folder(local):
+    return local.ensure_folder([BASE, "F500"])
+
+def test_ensure_folder_is_a_path_under_root(local):
+    assert local.ensure_folder([BASE, "F500"]) == f"{BASE}/F500"
+    assert (local.root / BASE / "F500").is_dir()
+    assert local.ensure_folder([BASE, "F500"]) == f"{BASE}/F500"  # already there
+
+@pytest.mark.parametrize("wrap", [bytes, bytearray, memoryview, io.BytesIO])
+def test_put_then_get_round_trips(local, folder, wrap):
+    item = local.put(folder, "a.jpg", wrap(b"foto"), "image/jpeg")
+    assert local.get(folder, "a.jpg") == b"foto"
+    assert (item["id"], item["name"], item["size"]) == (f"{folder}/a.jpg", "a.jpg", 4)
+
+def test_file_objects_are_read_from_the_start(local, folder):
+    f = io.BytesIO(b"manifiesto")
+    f.seek(5)
+    local.put(folder, "m.json", f, "application/json")
+    assert local.get(folder, "m.json") == b"manifiesto"
+
+def test_put_replaces_and_leaves_no_temporaries(local, folder):
+    first = local.put(folder, "a.pdf", b"v1", "application/pdf")
+    second = local.put(folder, "a.pdf", b"version 2", "application/pdf")
+    assert local.get(folder, "a.pdf") == b"version 2"
+    assert second["eTag"] != first["eTag"] and second["size"] == 9
+    assert os.listdir(local.root / folder) == ["a.pdf"]
+
+def test_missing_files(local, folder):
+    assert local.get(folder, "nada.jpg") is None
+    assert local.stat(folder, "nada.jpg") is None
+
+def test_stat_matches_put(local, folder):
+    item = local.put(folder, "a.jpg", b"foto", "image/jpeg")
+    assert local.stat(folder, "a.jpg") == item
+
+def test_hashes_lists_the_folder(app, local, folder):
+    assert local.hashes(folder) == set()
+    local.put(folder, app.hashed_filename("F500", "upload", DIGEST, ".jpg"), b"x", "image/jpeg")
+    local.put(folder, f"F500_camera_101010__{DIGEST[:12]}.jpg", b"x", "image/jpeg")  # legacy name
+    local.put(folder, "F500_fotos.pdf", b"x", "application/pdf")
+    (local.root / folder / f".in-{DIGEST}").write_bytes(b"")  # a put that never finished
+    assert local.hashes(folder) == {DIGEST, DIGEST[:12]}
+
+def test_download_copies_the_file(local, folder, tmp_path):
+    local.put(folder, "a.pdf", b"%PDF-1.4", "application/pdf")
+    dest = tmp_path / "cache.pdf"
+    local.download(folder, "a.pdf", dest)
+    assert dest.read_bytes() == b"%PDF-1.4"
+    assert not (tmp_path / "cache.pdf.part").exists()
+
+def test_job_lands_on_disk_without_graph(app_secrets, graph, request):
+    app_secrets["storage"]["backend"] = "local"
+    app = request.getfixturevalue("app")
+    runner = app.job_runner()
+    recs = records(app)
+    assert wait(runner, runner.submit(BASE, "F510", recs))["status"] == "done"
+    folder = app.storage_backend().root / BASE / "F510"
+    assert app.storage_backend().hashes(f"{BASE}/F510") == {r.sha256 for r in recs}
+    assert any(p.suffix == ".pdf" for p in folder.iterdir())
+    assert not graph.calls
@@ -0,0 +1,121 @@
+import re
+
+import pytest
+
+from uploads import records, wait
+
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (\S+)$')
+LABEL = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"(?:,|$)')
+
+def unescape(v: str) -> str:
+    return re.sub(r"\\(.)", lambda m: {"n": "\n"}.get(m.group(1), m.group(1)), v)
+
+def parse(text: str) -> dict:
+    # family -> {"help", "type", "samples": [(name, labels, value)]}, checking the text
+    # format's ordering rules on the way.
+    assert text.endswith("\n")
+    families, current = {}, None
+    for line in text.splitlines():
+        if line.startswith("# HELP "):
+            _, _, name, doc = line.split(" ", 3)
+            assert name not in families, f"{name} described twice"
+            current = families[name] = {"help": doc, "type": None, "samples": []}
+        elif line.startswith("# TYPE "):
+            _, _, name, kind = line.split(" ")
+            assert current is families.get(name) and current["type"] is None, f"TYPE {name} without its HELP"
+            current["type"] = kind
+        else:
+            m = SAMPLE.match(line)
+            assert m, line
+            name, raw, value = m.groups()
+            labels = {k: unescape(v) for k, v in LABEL.findall(raw or "")}
+            assert raw is None or ",".join(f'{k}="{v}"' for k, v in LABEL.findall(raw)) == raw, raw
+            family = next(f for f in families if name == f or (current["type"] == "histogram" and name in (f"{f}_bucket", f"{f}_sum", f"{f}_count")))
+            assert families[family] is current, f"{name} outside its family"
+            current["samples"].append((name, labels, float(value)))
+    return families
+
+@pytest.fixture
+def m(app):
+    return app.Metrics(None)
+
+def test_counters_have_help_and_type(app, m):
+    m.inc("idphotos_graph_requests_total", method="PUT", status=201)
+    m.inc("idphotos_graph_requests_total", 2, method="GET", status=200)
+    m.inc("idphotos_photos_uploaded_total", 3)
+    m.inc("idphotos_something_new_total")
+    families = parse(m.render())
+    assert families["idphotos_graph_requests_total"]["help"] == app.METRIC_HELP["idphotos_graph_requests_total"]
+    assert families["idphotos_something_new_total"]["help"] == "Something new."
+    assert all(f["type"] == "counter" for f in families.values())
+    assert families["idphotos_graph_requests_total"]["samples"] == [
+        ("idphotos_graph_requests_total", {"method": "GET", "status": "200"}, 2.0),
+        ("idphotos_graph_requests_total", {"method": "PUT", "status": "201"}, 1.0),
+    ]
+    assert families["idphotos_photos_uploaded_total"]["samples"] == [("idphotos_photos_uploaded_total", {}, 3.0)]
+
+def test_label_values_are_escaped(m):
+    nasty = 'C:\\fotos\n"folio"'
+    m.inc("idphotos_graph_errors_total", method="PUT", error=nasty)
+    text = m.render()
+    assert r'error="C:\\fotos\n\"folio\""' in text
+    assert len(text.splitlines()) == 3
+    (_, labels, _), = parse(text)["idphotos_graph_errors_total"]["samples"]
+    assert labels == {"error": nasty, "method": "PUT"}
+
+def test_help_text_is_escaped(app, m, monkeypatch):
+    monkeypatch.setitem(app.METRIC_HELP, "idphotos_odd_total", "línea\\uno\nlínea dos")
+    m.inc("idphotos_odd_total")
+    assert "# HELP idphotos_odd_total línea\\\\uno\\nlínea dos" in m.render().splitlines()
+
+def test_histogram_is_consistent(app, m):
+    observed = {"put": [0.001, 0.1, 0.3, 7.0, 500.0], "pdf_build": [1.0, 1.5]}
+    for stage, values in observed.items():
+        for v in values: m.observe(stage, v)
+    family = parse(m.render())["idphotos_stage_seconds"]
+    assert family["type"] == "histogram" and family["help"] == app.METRIC_HELP["idphotos_stage_seconds"]
+    for stage, values in observed.items():
+        samples = [(n, l, v) for n, l, v in family["samples"] if l["stage"] == stage]
+        buckets = [(l["le"], v) for n, l, v in samples if n.endswith("_bucket")]
+        assert [le for le, _ in buckets] == [str(b) for b in app.STAGE_BUCKETS] + ["+Inf"]
+        # Cumulative: each bucket counts the observations at or below its bound.
+        for le, n in buckets:
+            assert n == sum(v <= (float("inf") if le == "+Inf" else float(le)) for v in values), (stage, le)
+        (count,) = [v for n, _, v in samples if n.endswith("_count")]
+        (total,) = [v for n, _, v in samples if n.endswith("_sum")]
+        assert count == buckets[-1][1] == len(values)
+        assert total == pytest.approx(sum(values))
+
+def test_empty_registry_renders_nothing(m):
+    assert m.render() == "\n"
+
+def test_upload_trace_records_into_the_stage_histogram(app):
+    trace = app.UploadTrace("job-1", "F300", 2)
+    with trace.stage("put"):
+        pass
+    trace.add_time("put", 0.3)
+    trace.add_time("pdf_build", 2.0)
+    trace.count("photos_uploaded", 2)
+    family = parse(app.metrics().render())
+    counts = {l["stage"]: v for n, l, v in family["idphotos_stage_seconds"]["samples"] if n.endswith("_count")}
+    assert counts == {"put": 2, "pdf_build": 1}
+    le = {(l["stage"], l["le"]): v for n, l, v in family["idphotos_stage_seconds"]["samples"] if n.endswith("_bucket")}
+    assert (le[("put", "0.005")], le[("put", "0.25")], le[("put", "0.5")]) == (1, 1, 2)
+    assert (le[("pdf_build", "1.0")], le[("pdf_build", "2.5")]) == (0, 1)
+    assert family["idphotos_photos_uploaded_total"]["samples"] == [("idphotos_photos_uploaded_total", {}, 2.0)]
+    assert trace.record["stages"]["pdf_build"] == 2.0 and trace.record["counts"] == {"photos_uploaded": 2}
+
+def test_job_metrics_parse(app, graph):
+    runner = app.job_runner()
+    wait(runner, runner.submit("fotos_cotizaciones", "F310", records(app)))
+    families = parse(app.metrics().render())
+    assert families["idphotos_jobs_total"]["samples"] == [("idphotos_jobs_total", {"status": "ok"}, 1.0)]
+    assert {"put", "pdf_build", "manifest"} <= {l["stage"] for _, l, _ in families["idphotos_stage_seconds"]["samples"]}
+    assert all(f["help"] and f["type"] for f in families.values())
+
+def test_flush_writes_the_exposition(app, tmp_path):
+    m = app.Metrics(str(tmp_path / "idphotos.prom"))
+    m.inc("idphotos_token_fetches_total")
+    m.flush()
+    assert (tmp_path / "idphotos.prom").read_text() == m.render()
+    assert [p.name for p in tmp_path.iterdir()] == ["idphotos.prom"]
@@ -0,0 +1,36 @@
+import pytest
+
+import cards
+import imaging
+
+SAMPLES = list(cards.labelled_set((800, 600), seeds=2))
+
+def projection_rotation(img) -> int:
+    # The heuristic camera_rotation replaced (bench/orientation.py has the timing side).
+    import numpy as np
+    from PIL import Image
+    def score(im):
+        g = im.convert("L")
+        g.thumbnail((480, 480), Image.BILINEAR)
+        arr = np.asarray(g, dtype=np.float32) / 255.0
+        return arr.mean(axis=1).var() - arr.mean(axis=0).var()
+    return 270 if score(img.rotate(270, expand=True)) > score(img) else 0
+
+@pytest.mark.parametrize("name,img,angle", SAMPLES, ids=[s[0] for s in SAMPLES])
+def test_text_axis_is_found(name, img, angle):
+    rotation, confidence = imaging.detect_orientation(img)
+    assert (angle - rotation) % 180 == 0
+    assert confidence > 0.1
+
+@pytest.mark.parametrize("layout", cards.LAYOUTS)
+def test_upright_captures_are_never_turned(layout):
+    # An INE back has its dense MRZ lines at the bottom; that must not read as "upside down".
+    for seed in range(3):
+        assert imaging.camera_rotation(cards.capture(layout, 0, (1200, 900), seed)) == 0
+        assert imaging.camera_rotation(cards.capture(layout, 180, (1200, 900), seed)) == 0
+
+def test_only_the_old_heuristics_angles_are_chosen():
+    assert {imaging.camera_rotation(img) for _, img, _ in SAMPLES} == set(imaging.ORIENTATION_ANGLES)
+
+def test_matches_projection_score_heuristic():
+    assert [imaging.camera_rotation(img) for _, img, _ in SAMPLES] == [projection_rotation(img) for _, img, _ in SAMPLES]
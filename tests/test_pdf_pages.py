@@ -0,0 +1,46 @@
+import io
+
+from PIL import Image, ImageStat
+
+import imaging
+
+POLICY = {"dpi": 150, "quality": 85}
+
+def camera_jpeg(size=(640, 480)) -> bytes:
+    img = Image.new("RGB", size, (230, 230, 230))
+    img.paste((20, 20, 20), (0, 0, size[0] // 4, size[1] // 4))  # dark corner marks the top left
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+def dark_corner(jpeg: bytes) -> tuple[int, int]:
+    img = Image.open(io.BytesIO(jpeg)).convert("L")
+    w, h = img.size
+    corners = {(0, 0): (0, 0, w // 8, h // 8), (1, 0): (w - w // 8, 0, w, h // 8),
+               (0, 1): (0, h - h // 8, w // 8, h), (1, 1): (w - w // 8, h - h // 8, w, h)}
+    return min(corners, key=lambda c: ImageStat.Stat(img.crop(corners[c])).mean[0])
+
+def test_unrotated_jpeg_is_embedded_as_is():
+    data = camera_jpeg()
+    p = imaging.ProcessedImage(data, "image/jpeg", "camera", mobile=True)
+    p._rotation = 0
+    jpeg, size, gray, upright = p.pdf_page(POLICY)
+    assert jpeg == data and size == upright == (640, 480) and not gray
+
+def test_rotated_jpeg_of_the_same_size_is_reencoded():
+    data = camera_jpeg((480, 480))
+    p = imaging.ProcessedImage(data, "image/jpeg", "camera", mobile=True)
+    p._rotation = 270
+    jpeg, size, _, upright = p.pdf_page(POLICY)
+    assert jpeg != data
+    assert size == upright == (480, 480)
+    assert dark_corner(jpeg) == (1, 0)
+
+def test_rotated_storage_encoding_can_be_embedded():
+    data = camera_jpeg()
+    p = imaging.ProcessedImage(data, "image/jpeg", "camera", mobile=True)
+    p._rotation = 270
+    stored, _, _ = p.storage({"mode": "jpeg", "quality": 85, "max_dim": 0, "format": "jpeg", "target_bytes": 0})
+    jpeg, *_ = p.pdf_page(POLICY)
+    assert jpeg == stored
+    assert dark_corner(jpeg) == (1, 0)
@@ -0,0 +1,102 @@
+import io
+import mmap
+import os
+import time
+
+import pytest
+
+def payload(i: int, size: int = 1000) -> bytes:
+    return bytes([i]) * size
+
+@pytest.fixture
+def store(app, tmp_path):
+    return app.PhotoStore(tmp_path / "store", ttl_s=3600, quota_bytes=3500, max_bytes=0)
+
+def age(store, digest: str, seconds: float) -> None:
+    t = time.time() - seconds
+    os.utime(store.path(digest), (t, t))
+
+def collect(store) -> None:
+    store.next_gc = 0.0
+    store.gc()
+
+def test_put_is_content_addressed(store):
+    a, size = store.put("s1", io.BytesIO(payload(1)))
+    assert (a, size) == (store.put("s2", io.BytesIO(payload(1)))[0], 1000)
+    assert store.path(a).parent.name == a[:2]
+    assert [p.name for p in store.root.glob("*/*")] == [a]
+    assert not list(store.root.glob(".in-*"))
+
+def test_session_quota(store):
+    first = [store.put("s1", io.BytesIO(payload(i)))[0] for i in range(3)][0]
+    with pytest.raises(ValueError, match="límite de fotos"):
+        store.put("s1", io.BytesIO(payload(3)))
+    # A photo the session already holds costs nothing; other sessions have their own quota.
+    store.put("s1", io.BytesIO(payload(0)))
+    store.put("s2", io.BytesIO(payload(3)))
+    # Releasing a photo makes room again.
+    store.touch("s1", [first])
+    store.put("s1", io.BytesIO(payload(4)))
+
+def test_gc_keeps_touched_photos_past_the_ttl(store):
+    held, dropped = (store.put("s1", io.BytesIO(payload(i)))[0] for i in range(2))
+    store.touch("s1", [held])
+    for d in (held, dropped): age(store, d, 2 * store.ttl_s)
+    collect(store)
+    assert store.has(held) and not store.has(dropped)
+
+def test_gc_keeps_recent_unheld_photos(store):
+    d, _ = store.put("s1", io.BytesIO(payload(1)))
+    store.touch("s1", [])
+    collect(store)
+    assert store.has(d)
+
+def test_gc_forgets_idle_sessions(store):
+    d, _ = store.put("s1", io.BytesIO(payload(1)))
+    age(store, d, 2 * store.ttl_s)
+    store.sessions["s1"]["seen"] -= 2 * store.ttl_s
+    collect(store)
+    assert "s1" not in store.sessions and not store.has(d)
+
+def test_gc_runs_at_most_once_per_interval(app, store):
+    d, _ = store.put("s1", io.BytesIO(payload(1)))
+    store.touch("s1", [])
+    store.gc()
+    age(store, d, 2 * store.ttl_s)
+    store.gc()
+    assert store.has(d)
+    assert store.next_gc == pytest.approx(time.time() + app.PHOTO_GC_INTERVAL_S, abs=5)
+
+def test_over_max_bytes_evicts_the_oldest_unheld_first(app, tmp_path):
+    store = app.PhotoStore(tmp_path / "store", ttl_s=3600, quota_bytes=10_000, max_bytes=2500)
+    digests = [store.put("s1", io.BytesIO(payload(i)))[0] for i in range(4)]
+    for i, d in enumerate(digests): age(store, d, 100 - i)  # digests[0] stored first
+    store.touch("s1", [digests[0]])
+    collect(store)
+    # 4000 bytes against 2500: the two oldest it does not hold go, the held one stays.
+    assert [store.has(d) for d in digests] == [True, False, False, True]
+
+def test_held_photos_are_never_evicted(app, tmp_path):
+    store = app.PhotoStore(tmp_path / "store", ttl_s=3600, quota_bytes=10_000, max_bytes=500)
+    digests = [store.put("s1", io.BytesIO(payload(i)))[0] for i in range(3)]
+    collect(store)
+    assert all(store.has(d) for d in digests)
+
+def test_reads_back_through_mmap(app, store):
+    data = os.urandom(3 * app.HASH_BLOCK + 17)
+    store.quota_bytes = len(data)
+    d, size = store.put("s1", io.BytesIO(data))
+    view = store.read(d)
+    assert size == len(data) and view == data
+    assert isinstance(view.obj, mmap.mmap) and view.readonly
+    view.release()
+
+def test_empty_photo(store):
+    d, size = store.put("s1", io.BytesIO(b""))
+    assert size == 0 and bytes(store.read(d)) == b""
+
+def test_configured_from_secrets(app_secrets, request):
+    app_secrets["photo_store"].update(ttl_s=60, session_quota_mb=1, max_mb=2)
+    app = request.getfixturevalue("app")
+    store = app.photo_store()
+    assert (store.ttl_s, store.quota_bytes, store.max_bytes) == (60, 1024 * 1024, 2 * 1024 * 1024)
@@ -0,0 +1,91 @@
+import io
+import json
+import uuid
+from pathlib import Path
+
+import pytest
+from streamlit.testing.v1 import AppTest
+
+import cards
+import imaging
+from uploads import wait
+
+ROOT = Path(__file__).resolve().parent.parent
+SAMPLES = list(cards.quality_set((2000, 1500)))
+FOLIO = "251215-0FF480"
+
+def jpeg_of(img) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+def photo(label: str) -> bytes:
+    return jpeg_of(cards.degrade(cards.capture("ine_front", 0, (2000, 1500)), label))
+
+def stored(app, *payloads: bytes) -> list:
+    store, session = app.photo_store(), uuid.uuid4().hex
+    out = []
+    for data in payloads:
+        digest, size = store.put(session, io.BytesIO(data))
+        out.append(app.PhotoRecord(digest, size, "image/jpeg", "upload", store.path(digest)))
+    return out
+
+@pytest.mark.parametrize("name,img,label", SAMPLES, ids=[s[0] for s in SAMPLES])
+def test_labelled_captures(app, name, img, label):
+    issues = app.quality_issues(imaging.capture_quality(img), app.quality_gate_policy())
+    if cards.QUALITY_LABELS[label] is None:
+        assert issues == []
+    else:
+        assert cards.QUALITY_LABELS[label] in issues
+
+def test_off_reports_nothing(app):
+    q = imaging.capture_quality(cards.degrade(cards.capture("passport", 0, (2000, 1500)), "blurry"))
+    assert app.quality_issues(q, {**app.quality_gate_policy(), "mode": "off"}) == []
+    assert app.quality_issues(None, app.quality_gate_policy()) == []
+
+def run_page(app, app_secrets, records: list) -> AppTest:
+    at = AppTest.from_file(str(ROOT / "idcode.py"), default_timeout=60)
+    for key, value in app_secrets.items(): at.secrets[key] = value
+    at.session_state["gallery_photos"] = records
+    at.run()
+    return at.text_input[0].input(FOLIO).run()
+
+def upload_button(at: AppTest):
+    return next(b for b in at.button if b.label == "💾 Subir fotos")
+
+@pytest.fixture
+def gate(app_secrets, request):
+    app_secrets["quality_gate"] = {"mode": request.param}
+    return request.getfixturevalue("app")
+
+@pytest.mark.parametrize("gate", ["block"], indirect=True)
+@pytest.mark.parametrize("label", ["blurry", "glare", "dark"])
+def test_block_mode_disables_the_upload(gate, app_secrets, label):
+    at = run_page(gate, app_secrets, stored(gate, photo("good"), photo(label)))
+    assert upload_button(at).disabled
+    assert len(at.error) == 1
+    flagged = [line for line in at.error[0].value.splitlines() if line.startswith("- ")]
+    assert len(flagged) == 1 and flagged[0].startswith("- Galería #2: ")
+    assert cards.QUALITY_LABELS[label] in flagged[0]
+
+@pytest.mark.parametrize("gate", ["block"], indirect=True)
+def test_block_mode_lets_good_captures_through(gate, app_secrets):
+    at = run_page(gate, app_secrets, stored(gate, photo("good")))
+    assert not upload_button(at).disabled
+    assert not at.error and not at.warning
+
+@pytest.mark.parametrize("gate", ["warn"], indirect=True)
+def test_warn_mode_flags_but_uploads(gate, app_secrets, graph):
+    at = run_page(gate, app_secrets, stored(gate, photo("glare")))
+    assert not upload_button(at).disabled
+    assert "Galería #1: con reflejos" in at.warning[0].value
+    # The job uploads it anyway and records why it was flagged.
+    runner = gate.job_runner()
+    records = stored(gate, photo("good"), photo("dark"))
+    assert wait(runner, runner.submit("fotos_cotizaciones", FOLIO, records))["status"] == "done"
+    files = graph.drive.files(graph.drive.by_path(f"fotos_cotizaciones/{FOLIO}")["id"])
+    manifest = json.loads(next(it["content"] for name, it in files.items() if name.endswith(".json")))
+    assert manifest["state"] == "done"
+    assert [e["state"] for e in manifest["photos"]] == ["uploaded", "uploaded"]
+    assert manifest["photos"][0]["issues"] == []
+    assert "muy oscura" in manifest["photos"][1]["issues"]
@@ -0,0 +1,114 @@
+import io
+import sys
+
+import pytest
+from PIL import Image
+
+import imaging
+
+def noisy_jpeg(size=(1200, 900), exif_orientation: int = 1) -> bytes:
+    # Noise barely compresses, so the budget search has work to do.
+    img = Image.effect_noise(size, 50).convert("RGB")
+    img.paste((20, 20, 20), (0, 0, size[0] // 4, size[1] // 4))  # dark corner marks the top left
+    buf = io.BytesIO()
+    kw = {}
+    if exif_orientation != 1:
+        exif = Image.Exif()
+        exif[0x0112] = exif_orientation
+        kw["exif"] = exif.tobytes()
+    img.save(buf, format="JPEG", quality=95, **kw)
+    return buf.getvalue()
+
+def policy(mode: str, **kw) -> dict:
+    return {"mode": mode, "format": "jpeg", "quality": 85, "max_dim": 0, "target_bytes": 0, **kw}
+
+def camera(data: bytes, rotation: int = 0, normalized: bool = False) -> imaging.ProcessedImage:
+    p = imaging.ProcessedImage(data, "image/jpeg", "camera", mobile=True, normalized=normalized)
+    p._rotation = rotation
+    return p
+
+@pytest.mark.parametrize("fmt", ["jpeg", "webp"])
+@pytest.mark.parametrize("target", [200_000, 60_000])
+def test_budget_stays_under_target(fmt, target):
+    data, mime, suffix = camera(noisy_jpeg()).storage(policy("budget", format=fmt, target_bytes=target))
+    assert len(data) <= target
+    assert (mime, suffix) == imaging.STORAGE_ENCODINGS[fmt][1:]
+    assert Image.open(io.BytesIO(data)).format == imaging.STORAGE_ENCODINGS[fmt][0]
+
+@pytest.mark.parametrize("target", [150_000, 15_000, 2_000])
+def test_budget_shrinks_the_image_when_no_quality_fits(target):
+    data, _, _ = camera(noisy_jpeg()).storage(policy("budget", target_bytes=target))
+    assert len(data) <= target
+    assert Image.open(io.BytesIO(data)).width < 1200
+
+def test_budget_takes_the_highest_quality_that_fits():
+    img = Image.open(io.BytesIO(noisy_jpeg())).convert("RGB")
+    data = imaging._encode_for_budget(img, "jpeg", 450_000)
+    lo, hi = imaging.BUDGET_QUALITY_RANGE
+    sizes = {q: len(imaging._encode_lossy(img, "jpeg", q)) for q in range(lo, hi + 1)}
+    best = max(q for q, n in sizes.items() if n <= 450_000)
+    assert lo < best < hi
+    assert len(data) == sizes[best]
+
+def test_original_passes_the_bytes_through():
+    data = noisy_jpeg(exif_orientation=6)  # left for viewers to turn
+    assert camera(data).storage(policy("original")) == (data, "image/jpeg", ".jpg")
+
+def test_normalized_jpeg_is_stored_as_is():
+    data = noisy_jpeg((800, 600))
+    assert camera(data, normalized=True).storage(policy("jpeg", max_dim=1000))[0] is data
+    # Too big for the policy: re-encoded after all.
+    assert camera(data, normalized=True).storage(policy("jpeg", max_dim=400))[0] != data
+
+def fake_jpegtran(tmp_path, body: str) -> str:
+    exe = tmp_path / "jpegtran"
+    exe.write_text(f"#!{sys.executable}\n{body}")
+    exe.chmod(0o755)
+    return str(exe)
+
+ROTATING = """
+import io, sys
+from PIL import Image
+args = sys.argv[1:]
+open(sys.argv[0] + ".args", "w").write(" ".join(args))
+img = Image.open(io.BytesIO(sys.stdin.buffer.read()))
+buf = io.BytesIO()
+img.rotate(-int(args[args.index("-rotate") + 1]), expand=True).save(buf, format="JPEG", quality=95)
+sys.stdout.buffer.write(buf.getvalue())
+"""
+
+def test_rotation_goes_through_jpegtran(tmp_path, monkeypatch):
+    exe = fake_jpegtran(tmp_path, ROTATING)
+    monkeypatch.setattr(imaging.shutil, "which", lambda name: exe if name == "jpegtran" else None)
+    data = noisy_jpeg()
+    out, mime, suffix = camera(data, rotation=270).storage(policy("original"))
+    # PIL's 270° counter-clockwise is jpegtran's 90° clockwise.
+    assert open(exe + ".args").read() == "-copy all -rotate 90 -trim"
+    assert (mime, suffix) == ("image/jpeg", ".jpg")
+    assert Image.open(io.BytesIO(out)).size == (900, 1200)
+
+@pytest.mark.parametrize("which", ["missing", "failing"])
+def test_rotation_falls_back_to_reencoding(tmp_path, monkeypatch, which):
+    exe = None if which == "missing" else fake_jpegtran(tmp_path, "import sys\nsys.exit(1)\n")
+    monkeypatch.setattr(imaging.shutil, "which", lambda name: exe)
+    data = noisy_jpeg()
+    p = camera(data, rotation=270)
+    out, mime, suffix = p.storage(policy("original"))
+    assert (mime, suffix) == ("image/jpeg", ".jpg")
+    img = Image.open(io.BytesIO(out))
+    assert img.size == (900, 1200)
+    assert p.counts["decode"] == 1  # the pixels were rotated here instead
+
+def test_rotation_with_an_exif_orientation_is_reencoded(tmp_path, monkeypatch):
+    # jpegtran would rotate the stored pixels but keep the tag, turning it twice in viewers.
+    exe = fake_jpegtran(tmp_path, ROTATING)
+    monkeypatch.setattr(imaging.shutil, "which", lambda name: exe)
+    out, _, _ = camera(noisy_jpeg(exif_orientation=6), rotation=270).storage(policy("original"))
+    assert not (tmp_path / "jpegtran.args").exists()
+    assert imaging._exif_orientation(Image.open(io.BytesIO(out))) == 1
+
+@pytest.mark.skipif(not imaging.shutil.which("jpegtran"), reason="jpegtran not installed")
+def test_real_jpegtran_rotates_losslessly():
+    data = noisy_jpeg((1024, 768))  # multiples of the MCU size: nothing trimmed
+    out, _, _ = camera(data, rotation=270).storage(policy("original"))
+    assert Image.open(io.BytesIO(out)).size == (768, 1024)
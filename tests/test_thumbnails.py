@@ -0,0 +1,85 @@
+import io
+
+import pytest
+from PIL import Image
+
+import cards
+
+def jpeg_of(img) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+PHOTOS = [jpeg_of(cards.capture(layout, 0, (1600, 1200), seed=i)) for i, layout in enumerate(cards.LAYOUTS[:3])]
+
+@pytest.fixture
+def tasks(app, monkeypatch):
+    # Every make_thumbnail that reaches the image workers.
+    calls = []
+    run = app.run_image_task
+    def counting(fn, data, *args):
+        calls.append(fn.__name__)
+        return run(fn, data, *args)
+    monkeypatch.setattr(app, "run_image_task", counting)
+    return calls
+
+def test_second_call_is_served_from_the_cache(app, tasks):
+    digest = app.sha256_bytes(PHOTOS[0])
+    thumb = app.preview_thumbnail(PHOTOS[0], "upload", digest)
+    assert tasks == ["make_thumbnail"]
+    assert app.preview_thumbnail(PHOTOS[0], "upload", digest) is thumb
+    assert app.preview_thumbnail(PHOTOS[0], "upload") is thumb  # same key when hashed here
+    assert tasks == ["make_thumbnail"]
+    img = Image.open(io.BytesIO(thumb))
+    assert img.format == "JPEG" and max(img.size) == app.THUMB_MAX_SIDE
+    # Measured on the way: the quality gate reads it without decoding again.
+    assert app._quality_cache().get(digest) is not None
+
+def test_source_is_part_of_the_key(app, tasks):
+    digest = app.sha256_bytes(PHOTOS[0])
+    app.preview_thumbnail(PHOTOS[0], "upload", digest)
+    app.preview_thumbnail(PHOTOS[0], "camera", digest)
+    assert tasks == ["make_thumbnail"] * 2
+
+def test_failures_are_not_cached(app, tasks):
+    assert app.preview_thumbnail(b"not an image", "upload", "f" * 64) is None
+    assert app.preview_thumbnail(b"not an image", "upload", "f" * 64) is None
+    assert tasks == ["make_thumbnail"] * 2
+    assert app._thumb_cache().get(("f" * 64, "upload", False)) is None
+
+def test_eviction_recomputes_the_least_recently_used(app, tasks, monkeypatch):
+    small = app._LRUCache(2)
+    monkeypatch.setattr(app, "_thumb_cache", lambda: small)
+    digests = [app.sha256_bytes(p) for p in PHOTOS]
+    for data, digest in zip(PHOTOS[:2], digests): app.preview_thumbnail(data, "upload", digest)
+    app.preview_thumbnail(PHOTOS[0], "upload", digests[0])  # refreshes the first
+    app.preview_thumbnail(PHOTOS[2], "upload", digests[2])  # evicts the second
+    assert len(tasks) == 3 and len(small.items) == 2
+    app.preview_thumbnail(PHOTOS[0], "upload", digests[0])
+    assert len(tasks) == 3
+    app.preview_thumbnail(PHOTOS[1], "upload", digests[1])
+    assert len(tasks) == 4
+
+def test_lru_entry_cap(app):
+    cache = app._LRUCache(3)
+    for k in "abc": cache.put(k, k.encode())
+    assert cache.get("a") == b"a"
+    cache.put("d", b"d")
+    assert list(cache.items) == ["c", "a", "d"]
+    assert cache.get("b") is None
+
+def test_lru_byte_cap(app):
+    cache = app._LRUCache(100, max_bytes=10)
+    for k in "abc": cache.put(k, b"x" * 4)
+    assert list(cache.items) == ["b", "c"] and cache.nbytes == 8
+    cache.put("b", b"x" * 6)  # replacing counts the new size only
+    assert list(cache.items) == ["c", "b"] and cache.nbytes == 10
+    cache.put("big", b"x" * 50)  # bigger than the cap on its own: kept, alone
+    assert list(cache.items) == ["big"] and cache.nbytes == 50
+    cache.discard("big")
+    cache.discard("missing")
+    assert not cache.items and cache.nbytes == 0
+
+def test_thumb_cache_is_bounded(app):
+    cache = app._thumb_cache()
+    assert (cache.max_entries, cache.max_bytes) == (4096, app.THUMB_CACHE_BYTES)
@@ -0,0 +1,18 @@
+from uploads import records, wait
+
+def test_job_uploads_photos_manifest_and_pdf(app, graph):
+    runner = app.job_runner()
+    job = wait(runner, runner.submit("fotos_cotizaciones", "F001", records(app)))
+    assert job["status"] == "done" and job["done"] == 3
+    names = graph.drive.files(graph.drive.by_path("fotos_cotizaciones/F001")["id"])
+    assert sum(n.endswith(".png") or n.endswith(".jpg") for n in names) == 3
+    assert any(n.endswith(".pdf") for n in names) and any(n.endswith(".json") for n in names)
+
+def test_job_survives_latency_throttling_and_failures(app, graph):
+    graph.latency, graph.throttle_rate, graph.fail_rate = 0.002, 0.3, 0.1
+    runner = app.job_runner()
+    recs = records(app)
+    job = wait(runner, runner.submit("fotos_cotizaciones", "F002", recs))
+    assert job["status"] == "done"
+    assert sum(app.metrics().counters["idphotos_graph_retries_total"].values()) > 0
+    assert graph.bytes_in > sum(r.size for r in recs)
@@ -0,0 +1,49 @@
+import io
+import os
+
+import pytest
+
+def payload(n: int) -> bytes:
+    return os.urandom(n)
+
+@pytest.fixture
+def folder(graph):
+    return graph.drive.folder("fotos_cotizaciones/251215-0FF480")["id"]
+
+def resumes(app) -> float:
+    return app.metrics().counters.get("idphotos_upload_resumes_total", {}).get((), 0)
+
+def test_small_payload_is_one_put(app, graph, folder):
+    data = payload(1024 * 1024)
+    item = app.upload_file_to_folder(folder, "a.png", data, "image/png")
+    assert graph.drive.items[item["id"]]["content"] == data
+    assert not any("createUploadSession" in k for k in graph.calls)
+
+@pytest.mark.parametrize("as_file", [False, True])
+def test_large_payload_goes_through_a_session(app, graph, folder, as_file):
+    data = payload(2 * app.UPLOAD_CHUNK + 12345)  # above SIMPLE_UPLOAD_MAX, three chunks
+    item = app.upload_file_to_folder(folder, "big.pdf", io.BytesIO(data) if as_file else data, "application/pdf")
+    assert graph.drive.items[item["id"]]["content"] == data
+    assert sum(v for k, v in graph.calls.items() if "createUploadSession" in k) == 1
+
+@pytest.mark.parametrize("as_file", [False, True])
+def test_dropped_connection_resumes_at_the_server_offset(app, graph, folder, as_file):
+    graph.drop_upload_at = app.UPLOAD_CHUNK  # second chunk half-arrives, then the socket dies
+    data = payload(3 * app.UPLOAD_CHUNK)
+    item = app.upload_large_file_to_folder(folder, "big.pdf", io.BytesIO(data) if as_file else data)
+    assert graph.drive.items[item["id"]]["content"] == data
+    assert resumes(app) == 1
+    assert sum(v for k, v in graph.calls.items() if "createUploadSession" in k) == 1
+
+def test_lost_session_starts_over(app, graph, folder):
+    graph.lose_session_at = app.UPLOAD_CHUNK
+    data = payload(2 * app.UPLOAD_CHUNK + 1)
+    item = app.upload_large_file_to_folder(folder, "big.pdf", data)
+    assert graph.drive.items[item["id"]]["content"] == data
+    assert sum(v for k, v in graph.calls.items() if "createUploadSession" in k) == 2
+
+def test_gives_up_after_max_resumes(app, graph, folder, monkeypatch):
+    monkeypatch.setattr(app, "UPLOAD_MAX_RESUMES", 0)
+    graph.drop_upload_at = 0
+    with pytest.raises(IOError):
+        app.upload_large_file_to_folder(folder, "big.pdf", payload(app.UPLOAD_CHUNK + 1))
@@ -0,0 +1,90 @@
+import io
+import json
+
+import pytest
+
+from uploads import eventually, jpeg, records, wait
+
+FOLDER = "fotos_cotizaciones"
+
+@pytest.fixture
+def wb_app(app_secrets, graph, request, monkeypatch):
+    app_secrets["storage"]["backend"] = "write_behind"
+    app_secrets["storage"]["replicate_workers"] = 1
+    app_secrets["pdf"]["incremental"] = True
+    app = request.getfixturevalue("app")
+    monkeypatch.setattr(app, "JOB_RETRY_BACKOFF_S", 0.1)  # replica retries back off from here
+    monkeypatch.setattr(app, "JOB_IDLE_WAIT_S", 0.1)
+    yield app
+    # The replicator threads outlive the test; leave them nothing to send to the next one.
+    graph.down = False
+    eventually(lambda: app.storage_backend().queue.pending() == 0)
+
+def online_pdf(app, graph, folio: str, digest: str) -> None:
+    # A folio PDF uploaded before write-behind: only the drive has it.
+    buf = io.BytesIO()
+    writer = app.PdfPageWriter(buf)
+    writer.add_jpeg_page(jpeg(99), (320, 240), False, (320, 240), digest=digest)
+    writer.close()
+    folder = graph.drive.folder(f"{FOLDER}/{folio}")
+    graph.drive.add(folder["id"], f"{folio}_fotos.pdf", content=buf.getvalue())
+
+def pages(app, path) -> list[str]:
+    with open(path, "r+b") as f:
+        return app.PdfPageWriter.append_to(f).digests
+
+def app_pages(app, content: bytes) -> list[str]:
+    return app.PdfPageWriter.append_to(io.BytesIO(content)).digests
+
+def manifest_states(app, folio: str) -> set[str]:
+    folder = app.storage_backend().root / FOLDER / folio
+    return {json.loads(p.read_text())["state"] for p in folder.glob(f"{folio}_lote_*.json")}
+
+def test_stat_never_calls_graph(wb_app, graph):
+    backend = wb_app.storage_backend()
+    folder_id = backend.ensure_folder([FOLDER, "F200"])
+    before = sum(graph.calls.values())
+    with pytest.raises(wb_app.SeedPending):
+        backend.stat(folder_id, "F200_fotos.pdf")
+    assert sum(graph.calls.values()) == before
+
+def test_pages_wait_for_the_online_pdf_while_graph_is_down(wb_app, graph):
+    online_pdf(wb_app, graph, "F100", "a" * 64)
+    graph.down = True
+    runner = wb_app.job_runner()
+    recs = records(wb_app, 2)
+    job_id = runner.submit(FOLDER, "F100", recs)
+
+    # Photos are safe on disk and the session moves on, but the batch is not done.
+    wait(runner, job_id, until=("waiting", "done", "failed"))
+    assert runner.store.get(job_id)["status"] == "waiting"
+    assert manifest_states(wb_app, "F100") == {"pdf_pending"}
+    local_pdf = wb_app.storage_backend().root / FOLDER / "F100" / "F100_fotos.pdf"
+    assert not local_pdf.exists()  # not started from scratch over the online one
+
+    graph.down = False
+    wait(runner, job_id)
+    assert runner.store.get(job_id)["status"] == "done"
+    assert manifest_states(wb_app, "F100") == {"done"}
+    assert pages(wb_app, local_pdf) == ["a" * 64] + [r.sha256 for r in recs]
+
+    # And the replica catches up with every page.
+    eventually(lambda: wb_app.storage_backend().queue.pending() == 0)
+    online = graph.drive.child(graph.drive.by_path(f"{FOLDER}/F100")["id"], "F100_fotos.pdf")
+    assert app_pages(wb_app, online["content"]) == ["a" * 64] + [r.sha256 for r in recs]
+
+def test_new_folio_gets_its_pdf_once_the_seed_finds_nothing(wb_app, graph):
+    runner = wb_app.job_runner()
+    recs = records(wb_app, 2)
+    job = wait(runner, runner.submit(FOLDER, "F300", recs))
+    assert job["status"] == "done"
+    assert pages(wb_app, wb_app.storage_backend().root / FOLDER / "F300" / "F300_fotos.pdf") == [r.sha256 for r in recs]
+
+def test_next_batch_appends_without_another_seed(wb_app, graph):
+    runner = wb_app.job_runner()
+    wait(runner, runner.submit(FOLDER, "F400", records(wb_app, 1)))
+    graph.down = True
+    more = records(wb_app, 2, first=5)
+    job = wait(runner, runner.submit(FOLDER, "F400", more), until=("waiting", "done", "failed"))
+    assert job["status"] == "done"  # seeded once per file, Graph not needed again
+    assert pages(wb_app, wb_app.storage_backend().root / FOLDER / "F400" / "F400_fotos.pdf")[1:] == [r.sha256 for r in more]
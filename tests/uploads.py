@@ -0,0 +1,33 @@
+# Photos and job helpers shared by the upload tests.
+import io
+import time
+import uuid
+
+import pytest
+from PIL import Image
+
+def jpeg(seed: int, size=(320, 240)) -> bytes:
+    buf = io.BytesIO()
+    Image.effect_noise(size, 40 + seed).convert("RGB").save(buf, format="JPEG")
+    return buf.getvalue()
+
+def records(app, n: int = 3, first: int = 0) -> list:
+    store, session = app.photo_store(), uuid.uuid4().hex
+    out = []
+    for i in range(first, first + n):
+        digest, size = store.put(session, io.BytesIO(jpeg(i)))
+        out.append(app.PhotoRecord(digest, size, "image/jpeg", "upload", store.path(digest)))
+    return out
+
+def wait(runner, job_id: str, until=("done", "failed"), timeout: float = 60) -> dict:
+    deadline = time.monotonic() + timeout
+    while (job := runner.store.get(job_id))["status"] not in until:
+        if time.monotonic() > deadline: pytest.fail(f"job {job_id} still {job['status']}")
+        time.sleep(0.02)
+    return job
+
+def eventually(check, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while not check():
+        if time.monotonic() > deadline: pytest.fail("timed out")
+        time.sleep(0.05)